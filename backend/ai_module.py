@@ -8,8 +8,24 @@ from google.cloud import translate_v2 as translate
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import logging
-from openai import OpenAI  # 新用法
+import queue
+import hashlib
+import functools
+import threading
+import contextlib
+import unicodedata
+import numpy as np
+import openai
+from openai import AsyncOpenAI
+import requests
+from google.api_core import exceptions as google_exceptions
 from google.oauth2 import service_account
+from vector_index import LocalVectorIndex
+from cache import LRUCache, SQLiteCache, TwoTierCache
+from batching import MicroBatcher
+from topic_classifier import TopicClassifier
+from answer_cache import SemanticAnswerCache
+from upstreams import Upstream, HTTPUpstream, UpstreamRegistry, pooled_authorized_session
 
 # 載入環境變數
 load_dotenv()
@@ -25,8 +41,45 @@ vertexai.init(
     credentials=credentials
 )
 
-# 初始化翻譯客戶端
-translate_client = translate.Client(credentials=credentials)
+# 對外呼叫：每個上游共用連線池、逾時、重試與斷路器設定，統計由 /admin/metrics 回報
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BREAKER_THRESHOLD = int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", "5"))
+UPSTREAM_BREAKER_RESET = float(os.getenv("UPSTREAM_BREAKER_RESET", "30"))
+GOOGLE_API_TIMEOUT = float(os.getenv("GOOGLE_API_TIMEOUT", "30"))
+GOOGLE_API_POOL_SIZE = int(os.getenv("GOOGLE_API_POOL_SIZE", "10"))
+
+outbound = UpstreamRegistry()
+
+def upstream_policy(**kwargs):
+    return dict(
+        retries=UPSTREAM_RETRIES,
+        failure_threshold=UPSTREAM_BREAKER_THRESHOLD,
+        reset_timeout=UPSTREAM_BREAKER_RESET,
+        **kwargs
+    )
+
+# Google 的 SDK 以 requests（Translate）或 gRPC（Vertex AI）連線，錯誤類型相同
+GOOGLE_RETRYABLE = (google_exceptions.ServerError, google_exceptions.TooManyRequests, requests.exceptions.Timeout)
+GOOGLE_CONNECT_ERRORS = (requests.exceptions.ConnectionError,)
+translate_upstream = outbound.register(Upstream(
+    "google_translate",
+    **upstream_policy(retryable=GOOGLE_RETRYABLE, connect_errors=GOOGLE_CONNECT_ERRORS)
+))
+vertex_upstream = outbound.register(Upstream(
+    "vertex_ai",
+    **upstream_policy(retryable=GOOGLE_RETRYABLE, connect_errors=GOOGLE_CONNECT_ERRORS)
+))
+
+# 初始化翻譯客戶端：共用 keep-alive 連線池並套用逾時
+translate_client = translate.Client(
+    credentials=credentials,
+    _http=pooled_authorized_session(
+        credentials,
+        pool_size=GOOGLE_API_POOL_SIZE,
+        connect_timeout=10.0,
+        read_timeout=GOOGLE_API_TIMEOUT
+    )
+)
 
 # 初始化 ThreadPoolExecutor
 executor = ThreadPoolExecutor(max_workers=4)  # 從 10 降到 4
@@ -34,11 +87,52 @@ executor = ThreadPoolExecutor(max_workers=4)  # 從 10 降到 4
 # 初始化 Logger
 logger = logging.getLogger('uvicorn.error')
 
-# 建立 OpenAI 客戶端，使用 OpenRouter API
-client = OpenAI(
-  base_url="https://openrouter.ai/api/v1",
-  api_key=os.getenv("OPENROUTER_API_KEY"),
-)
+# 非同步 OpenRouter 客戶端：共用連線池，串流直接在事件迴圈上讀取，不佔用執行緒
+OPENROUTER_MAX_CONNECTIONS = int(os.getenv("OPENROUTER_MAX_CONNECTIONS", "100"))
+OPENROUTER_TIMEOUT = float(os.getenv("OPENROUTER_TIMEOUT", "120"))
+# 每個 worker 同時進行的生成串流上限，超過時排隊等待
+MAX_CONCURRENT_STREAMS = int(os.getenv("MAX_CONCURRENT_STREAMS", "64"))
+# 生成串流中途失敗時送給前端的 error 事件內容
+STREAM_ERROR_MESSAGE = "回答生成失敗，請稍後再試"
+
+# 生成按次計費，不是冪等呼叫：只有請求尚未被處理（連線失敗、429）時才重試，
+# 逾時（APITimeoutError 繼承自 APIConnectionError）可能已開始生成，不重試；重試交給 upstream，關閉 SDK 內建的重試
+openrouter_upstream = outbound.register(HTTPUpstream(
+    "openrouter",
+    max_connections=OPENROUTER_MAX_CONNECTIONS,
+    connect_timeout=10.0,
+    read_timeout=OPENROUTER_TIMEOUT,
+    **upstream_policy(
+        retryable=(openai.APITimeoutError, openai.RateLimitError, openai.InternalServerError),
+        connect_errors=(openai.APIConnectionError, openai.RateLimitError),
+        read_errors=(openai.APITimeoutError,)
+    )
+))
+
+_async_client = None
+
+def get_async_client():
+    """取得使用 openrouter 上游連線池的 AsyncOpenAI 客戶端（應用程式啟動時建立）。"""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(
+            base_url="https://openrouter.ai/api/v1",
+            api_key=os.getenv("OPENROUTER_API_KEY"),
+            http_client=openrouter_upstream.client,
+            max_retries=0
+        )
+    return _async_client
+
+def start_outbound_clients():
+    """建立所有上游的連線池；由 main 的 startup 事件呼叫。"""
+    outbound.start()
+    get_async_client()
+
+async def close_outbound_clients():
+    """關閉所有上游的連線池；由 main 的 shutdown 事件呼叫。"""
+    global _async_client
+    _async_client = None
+    await outbound.aclose()
 
 # 定義額外請求標頭（可依需求設定）
 EXTRA_HEADERS = {
@@ -46,6 +140,104 @@ EXTRA_HEADERS = {
     "X-Title": os.getenv("SITE_NAME", "Ausexticity")  # 選填：您的網站名稱
 }
 
+# RAG 檢索後端：bigquery（預設）、local（本地 mmap 向量快照，精確檢索）
+# 或 ivf（本地快照的 IVF 近似檢索，需以 --ivf-nlist 建立快照）
+RAG_BACKEND = os.getenv("RAG_BACKEND", "bigquery").lower()
+VECTOR_INDEX_DIR = os.getenv(
+    "VECTOR_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "vector_snapshots")
+)
+VECTOR_INDEX_RELOAD_INTERVAL = float(os.getenv("VECTOR_INDEX_RELOAD_INTERVAL", "30"))
+VECTOR_INDEX_NPROBE = int(os.getenv("VECTOR_INDEX_NPROBE", "8"))
+
+_local_index = None
+
+def get_local_index():
+    """
+    取得（必要時建立）本地向量索引的單例。
+
+    Returns:
+        LocalVectorIndex: 本地向量索引。
+    """
+    global _local_index
+    if _local_index is None:
+        _local_index = LocalVectorIndex(
+            VECTOR_INDEX_DIR,
+            reload_interval=VECTOR_INDEX_RELOAD_INTERVAL,
+            nprobe=VECTOR_INDEX_NPROBE if RAG_BACKEND == "ivf" else None
+        )
+    return _local_index
+
+# 持久快取存放目錄
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+
+# 查詢嵌入快取：行程內 LRU + SQLite 持久層，空字串的 EMBEDDING_CACHE_PATH 表示停用持久層
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", str(30 * 24 * 3600)))
+EMBEDDING_CACHE_MEMORY_SIZE = int(os.getenv("EMBEDDING_CACHE_MEMORY_SIZE", "2048"))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(CACHE_DIR, "embeddings.sqlite"))
+
+embedding_cache = TwoTierCache(
+    LRUCache(maxsize=EMBEDDING_CACHE_MEMORY_SIZE, ttl=EMBEDDING_CACHE_TTL),
+    SQLiteCache(
+        EMBEDDING_CACHE_PATH,
+        ttl=EMBEDDING_CACHE_TTL,
+        max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+        # 以 float32 位元組保存，體積約為 JSON 的四分之一
+        dumps=lambda values: np.asarray(values, dtype=np.float32).tobytes(),
+        loads=lambda blob: np.frombuffer(blob, dtype=np.float32).tolist()
+    ) if EMBEDDING_CACHE_PATH else None
+)
+
+def normalize_query_text(text):
+    """
+    正規化查詢文字：統一全半形、忽略大小寫並合併多餘空白，
+    讓只差在格式的重複問題能命中同一筆快取。
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+def embedding_cache_key(query, model_name):
+    normalized = normalize_query_text(query)
+    return hashlib.sha256(f"{model_name}\n{normalized}".encode("utf-8")).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def get_embedding_model(model_name):
+    """
+    載入並快取嵌入模型，每個行程只建立一次。
+
+    Args:
+        model_name (str): 嵌入模型名稱。
+
+    Returns:
+        TextEmbeddingModel: 嵌入模型。
+    """
+    return TextEmbeddingModel.from_pretrained(model_name)
+
+def load_query_embeddings_sync(queries, model_name="text-multilingual-embedding-002"):
+    """
+    使用 Vertex AI 嵌入模型將多個查詢轉換為向量（同步批次版本），
+    先查詢嵌入快取，未命中的查詢合併為一次 get_embeddings 呼叫。
+
+    Args:
+        queries (list): 用戶的查詢列表。
+        model_name (str): 嵌入模型名稱。
+
+    Returns:
+        list: 與 queries 等長的嵌入向量列表。
+    """
+    keys = [embedding_cache_key(query, model_name) for query in queries]
+    results = [embedding_cache.get(key) for key in keys]
+    missing = [i for i, values in enumerate(results) if values is None]
+    if missing:
+        model = get_embedding_model(model_name)
+        embeddings = vertex_upstream.call_sync(
+            model.get_embeddings, [queries[i] for i in missing], idempotent=True
+        )
+        for i, embedding in zip(missing, embeddings):
+            results[i] = embedding.values
+            embedding_cache.set(keys[i], embedding.values)
+    return results
+
 def load_query_embedding_sync(query, model_name="text-multilingual-embedding-002"):
     """
     使用 Vertex AI 嵌入模型將查詢轉換為向量（同步版本）。
@@ -57,13 +249,39 @@ def load_query_embedding_sync(query, model_name="text-multilingual-embedding-002
     Returns:
         list: 查詢的嵌入向量。
     """
-    model = TextEmbeddingModel.from_pretrained(model_name)
-    embeddings = model.get_embeddings([query])
-    return embeddings[0].values
+    return load_query_embeddings_sync([query], model_name)[0]
+
+# 嵌入請求微批次：在時間窗內合併同時到達的查詢，一次送出 get_embeddings
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "10"))
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "16"))
+
+embedding_batchers = {}
+
+def get_embedding_batcher(model_name):
+    """
+    取得指定嵌入模型的微批次合併器。
+
+    Args:
+        model_name (str): 嵌入模型名稱。
+
+    Returns:
+        MicroBatcher: 微批次合併器。
+    """
+    batcher = embedding_batchers.get(model_name)
+    if batcher is None:
+        batcher = MicroBatcher(
+            functools.partial(load_query_embeddings_sync, model_name=model_name),
+            executor,
+            max_batch_size=EMBEDDING_BATCH_MAX_SIZE,
+            max_wait=EMBEDDING_BATCH_WINDOW_MS / 1000
+        )
+        embedding_batchers[model_name] = batcher
+    return batcher
 
 async def load_query_embedding_async(query, model_name="text-multilingual-embedding-002"):
     """
-    使用 Vertex AI 嵌入模型將查詢轉換為向量（非同步版本）。
+    使用 Vertex AI 嵌入模型將查詢轉換為向量（非同步版本），
+    透過微批次合併器與其他同時到達的查詢共用一次 API 呼叫。
 
     Args:
         query (str): 用戶的查詢。
@@ -72,17 +290,87 @@ async def load_query_embedding_async(query, model_name="text-multilingual-embedd
     Returns:
         list: 查詢的嵌入向量。
     """
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        executor,
-        load_query_embedding_sync,
-        query,
-        model_name
-    )
+    return await get_embedding_batcher(model_name).submit(query)
+
+class BigQueryClientPool:
+    """
+    長期存活的 BigQuery 客戶端池，避免每次查詢都重新建立與關閉客戶端。
+    客戶端在首次需要時建立，最多 size 個；全部借出時等待歸還。
+
+    Args:
+        project_id (str): GCP 專案 ID。
+        size (int): 客戶端數量上限。
+    """
+
+    def __init__(self, project_id, size=4):
+        self.project_id = project_id
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def client(self):
+        try:
+            client_bq = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    client_bq = bigquery.Client(project=self.project_id, credentials=credentials)
+                except Exception:
+                    # 建立失敗時釋放名額，否則池的容量會永久減少
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                client_bq = self._idle.get()
+        try:
+            yield client_bq
+        finally:
+            self._idle.put(client_bq)
+
+BIGQUERY_POOL_SIZE = int(os.getenv("BIGQUERY_POOL_SIZE", "4"))
+_bigquery_pools = {}
+_bigquery_pools_lock = threading.Lock()
+
+def get_bigquery_pool(project_id):
+    with _bigquery_pools_lock:
+        pool = _bigquery_pools.get(project_id)
+        if pool is None:
+            pool = BigQueryClientPool(project_id, size=BIGQUERY_POOL_SIZE)
+            _bigquery_pools[project_id] = pool
+        return pool
+
+def _cosine_similarity_sql(param):
+    """產生查詢參數 @param 與 t.embedding 的餘弦相似度 SQL 運算式。"""
+    return f"""(
+        (SELECT SUM(q * d)
+         FROM UNNEST(@{param}) AS q WITH OFFSET i
+         JOIN UNNEST(t.embedding) AS d WITH OFFSET j
+         ON i = j)
+        /
+        (SQRT((SELECT SUM(POWER(q, 2)) FROM UNNEST(@{param}) AS q)) *
+         SQRT((SELECT SUM(POWER(d, 2)) FROM UNNEST(t.embedding) AS d)))
+      )"""
+
+def _row_to_document(row):
+    return {
+        "id": row.id,
+        "title": row.title,
+        "url": row.url,
+        "content": row.content,
+        "cosine_similarity": row.cosine_similarity
+    }
 
 def retrieve_similar_documents_sync(query_embedding, dataset_id, table_id, project_id, top_n=10):
     """
     同步使用 BigQuery 查找與查詢向量相似的文檔。
+    查詢向量以 ARRAY<FLOAT64> 參數傳入，查詢文字固定，可利用 BigQuery 查詢快取；
+    結果不包含 embedding 欄位，減少傳輸量。
 
     Args:
         query_embedding (list): 查詢的嵌入向量。
@@ -94,55 +382,101 @@ def retrieve_similar_documents_sync(query_embedding, dataset_id, table_id, proje
     Returns:
         list: 相似文檔的列表。
     """
-    client_bq = bigquery.Client(
-        project=project_id,
-        credentials=credentials
-    )
-    embedding_str = ", ".join(map(str, query_embedding))
     query = f"""
-    WITH query AS (
-      SELECT
-        [{embedding_str}] AS embedding
-    )
     SELECT
       t.id,
       t.title,
       t.url,
       t.content,
-      t.embedding,
-      (
-        (SELECT SUM(q * d) 
-         FROM UNNEST(qry.embedding) AS q WITH OFFSET i 
-         JOIN UNNEST(t.embedding) AS d WITH OFFSET j 
-         ON i = j)
-        /
-        (SQRT((SELECT SUM(POWER(q, 2)) FROM UNNEST(qry.embedding) AS q)) * 
-         SQRT((SELECT SUM(POWER(d, 2)) FROM UNNEST(t.embedding) AS d)))
-      ) AS cosine_similarity
+      {_cosine_similarity_sql("query_embedding")} AS cosine_similarity
     FROM
-      `{project_id}.{dataset_id}.{table_id}` AS t,
-      query AS qry
+      `{project_id}.{dataset_id}.{table_id}` AS t
     ORDER BY
       cosine_similarity DESC
-    LIMIT {top_n}
-    """
-    query_job = client_bq.query(query)
-    results = query_job.result()
-    documents = []
-    for row in results:
-        documents.append({
-            "id": row.id,
-            "title": row.title,
-            "url": row.url,
-            "content": row.content,
-            "cosine_similarity": row.cosine_similarity
-        })
-    client_bq.close()
-    return documents
+    LIMIT @top_n
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("query_embedding", "FLOAT64", list(query_embedding)),
+        bigquery.ScalarQueryParameter("top_n", "INT64", top_n),
+    ])
+    with get_bigquery_pool(project_id).client() as client_bq:
+        results = client_bq.query(query, job_config=job_config).result()
+        return [_row_to_document(row) for row in results]
+
+def retrieve_similar_documents_combined_sync(query_embedding_cn, query_embedding_en, dataset_id, table_id,
+                                             project_id, top_n_cn=2, top_n_en=3):
+    """
+    同步使用單一 BigQuery 查詢同時取得中文與英文查詢向量的相似文檔，
+    只掃描一次資料表、只送出一個查詢工作。
+
+    Args:
+        query_embedding_cn (list): 中文查詢的嵌入向量。
+        query_embedding_en (list): 英文查詢的嵌入向量。
+        dataset_id (str): BigQuery 資料集 ID。
+        table_id (str): BigQuery 資料表 ID。
+        project_id (str): GCP 專案 ID。
+        top_n_cn (int): 中文查詢返回的相似文檔數量。
+        top_n_en (int): 英文查詢返回的相似文檔數量。
+
+    Returns:
+        tuple: (中文相似文檔列表, 英文相似文檔列表)。
+    """
+    query = f"""
+    WITH scored AS (
+      SELECT
+        t.id,
+        t.title,
+        t.url,
+        t.content,
+        {_cosine_similarity_sql("query_embedding_cn")} AS similarity_cn,
+        {_cosine_similarity_sql("query_embedding_en")} AS similarity_en
+      FROM
+        `{project_id}.{dataset_id}.{table_id}` AS t
+    )
+    (SELECT 'cn' AS lang, id, title, url, content, similarity_cn AS cosine_similarity
+     FROM scored ORDER BY similarity_cn DESC LIMIT @top_n_cn)
+    UNION ALL
+    (SELECT 'en' AS lang, id, title, url, content, similarity_en AS cosine_similarity
+     FROM scored ORDER BY similarity_en DESC LIMIT @top_n_en)
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("query_embedding_cn", "FLOAT64", list(query_embedding_cn)),
+        bigquery.ArrayQueryParameter("query_embedding_en", "FLOAT64", list(query_embedding_en)),
+        bigquery.ScalarQueryParameter("top_n_cn", "INT64", top_n_cn),
+        bigquery.ScalarQueryParameter("top_n_en", "INT64", top_n_en),
+    ])
+    with get_bigquery_pool(project_id).client() as client_bq:
+        results = client_bq.query(query, job_config=job_config).result()
+        documents = {"cn": [], "en": []}
+        for row in results:
+            documents[row.lang].append(_row_to_document(row))
+    for docs in documents.values():
+        docs.sort(key=lambda doc: doc["cosine_similarity"], reverse=True)
+    return documents["cn"], documents["en"]
+
+def retrieve_similar_documents_local_sync(query_embedding, top_n=10):
+    """
+    同步使用本地 mmap 向量快照查找與查詢向量相似的文檔。
+    建立索引與檢查、載入新快照都涉及檔案 I/O，須在執行緒池中呼叫。
+
+    Args:
+        query_embedding (list): 查詢的嵌入向量。
+        top_n (int): 返回的相似文檔數量。
+
+    Returns:
+        list: 相似文檔的列表；尚無可用快照時回傳 None。
+    """
+    index = get_local_index()
+    index.maybe_reload()
+    if not index.available:
+        return None
+    return index.search(query_embedding, top_n)
 
 async def retrieve_similar_documents_async(query_embedding, dataset_id, table_id, project_id, top_n=10):
     """
-    非同步使用 ThreadPoolExecutor 執行同步 BigQuery 查詢，查找與查詢向量相似的文檔。
+    非同步使用 ThreadPoolExecutor 查找與查詢向量相似的文檔。
+    依 RAG_BACKEND 設定選擇 BigQuery 或本地向量快照（精確或 IVF 近似）；
+    本地快照尚未建立時自動退回 BigQuery。
 
     Args:
         query_embedding (list): 查詢的嵌入向量。
@@ -155,6 +489,16 @@ async def retrieve_similar_documents_async(query_embedding, dataset_id, table_id
         list: 相似文檔的列表。
     """
     loop = asyncio.get_event_loop()
+    if RAG_BACKEND in ("local", "ivf"):
+        documents = await loop.run_in_executor(
+            executor,
+            retrieve_similar_documents_local_sync,
+            query_embedding,
+            top_n
+        )
+        if documents is not None:
+            return documents
+        logger.warning("本地向量快照不可用，改用 BigQuery 檢索")
     return await loop.run_in_executor(
         executor,
         retrieve_similar_documents_sync,
@@ -165,6 +509,132 @@ async def retrieve_similar_documents_async(query_embedding, dataset_id, table_id
         top_n
     )
 
+async def retrieve_similar_documents_combined_async(query_embedding_cn, query_embedding_en, dataset_id, table_id,
+                                                    project_id, top_n_cn=2, top_n_en=3):
+    """
+    非同步取得中文與英文查詢向量的相似文檔。
+    BigQuery 後端合併為單一查詢工作；本地快照則分別查詢。
+
+    Returns:
+        tuple: (中文相似文檔列表, 英文相似文檔列表)。
+    """
+    loop = asyncio.get_event_loop()
+    if RAG_BACKEND in ("local", "ivf"):
+        return await asyncio.gather(
+            retrieve_similar_documents_async(query_embedding_cn, dataset_id, table_id, project_id, top_n=top_n_cn),
+            retrieve_similar_documents_async(query_embedding_en, dataset_id, table_id, project_id, top_n=top_n_en)
+        )
+    return await loop.run_in_executor(
+        executor,
+        retrieve_similar_documents_combined_sync,
+        query_embedding_cn,
+        query_embedding_en,
+        dataset_id,
+        table_id,
+        project_id,
+        top_n_cn,
+        top_n_en
+    )
+
+# 語意回答快取：相似問題直接重播先前的完整回答
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600)))
+ANSWER_CACHE_CHUNK_SIZE = int(os.getenv("ANSWER_CACHE_CHUNK_SIZE", "16"))
+
+answer_cache = SemanticAnswerCache(
+    threshold=ANSWER_CACHE_THRESHOLD,
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    ttl=ANSWER_CACHE_TTL
+)
+
+# RAG 檢索參數
+RAG_PROJECT_ID = "eros-ai-446307"
+RAG_DATASET_ID = "Eros_AI_RAG"
+RAG_TABLE_ID = "combined_embeddings"
+# 合併查詢模式：翻譯完成後以單一 BigQuery 工作同時檢索中英文，
+# 關閉時中文檢索會在判斷語句期間推測性地先行開始
+RAG_COMBINED_QUERY = os.getenv("RAG_COMBINED_QUERY", "false").lower() == "true"
+
+async def retrieve_bilingual_async(query_embedding_cn, query_embedding_en, top_n_cn=2, top_n_en=3):
+    """
+    以合併查詢模式檢索中英文相似文檔。
+
+    Returns:
+        tuple: (中文相似文檔列表, 英文相似文檔列表)。
+    """
+    return await retrieve_similar_documents_combined_async(
+        query_embedding_cn, query_embedding_en, RAG_DATASET_ID, RAG_TABLE_ID, RAG_PROJECT_ID,
+        top_n_cn=top_n_cn, top_n_en=top_n_en
+    )
+
+async def retrieve_for_query_async(query, top_n=10):
+    """
+    產生查詢嵌入並檢索相似文檔，作為 RAG 流程中可獨立排程的單一階段。
+
+    Args:
+        query (str): 用戶的查詢。
+        top_n (int): 返回的相似文檔數量。
+
+    Returns:
+        list: 相似文檔的列表。
+    """
+    query_embedding = await load_query_embedding_async(query)
+    return await retrieve_similar_documents_async(
+        query_embedding, RAG_DATASET_ID, RAG_TABLE_ID, RAG_PROJECT_ID, top_n=top_n
+    )
+
+# 翻譯快取：以正規化後的原文為鍵；設定 TRANSLATION_CACHE_PATH 後
+# 持久層可在 gunicorn 回收 worker（--max-requests）後繼續沿用，空字串表示停用
+TRANSLATION_CACHE_TTL = float(os.getenv("TRANSLATION_CACHE_TTL", str(30 * 24 * 3600)))
+TRANSLATION_CACHE_MEMORY_SIZE = int(os.getenv("TRANSLATION_CACHE_MEMORY_SIZE", "2048"))
+TRANSLATION_CACHE_MAX_ENTRIES = int(os.getenv("TRANSLATION_CACHE_MAX_ENTRIES", "200000"))
+TRANSLATION_CACHE_PATH = os.getenv("TRANSLATION_CACHE_PATH", os.path.join(CACHE_DIR, "translations.sqlite"))
+TRANSLATION_BATCH_WINDOW_MS = float(os.getenv("TRANSLATION_BATCH_WINDOW_MS", "10"))
+TRANSLATION_BATCH_MAX_SIZE = int(os.getenv("TRANSLATION_BATCH_MAX_SIZE", "32"))
+
+translation_cache = TwoTierCache(
+    LRUCache(maxsize=TRANSLATION_CACHE_MEMORY_SIZE, ttl=TRANSLATION_CACHE_TTL),
+    SQLiteCache(
+        TRANSLATION_CACHE_PATH,
+        ttl=TRANSLATION_CACHE_TTL,
+        max_entries=TRANSLATION_CACHE_MAX_ENTRIES
+    ) if TRANSLATION_CACHE_PATH else None
+)
+
+def translation_cache_key(text, target_language='en'):
+    normalized = normalize_query_text(text)
+    return hashlib.sha256(f"{target_language}\n{normalized}".encode("utf-8")).hexdigest()
+
+def translate_texts_sync(texts):
+    """
+    同步使用 Google Translate API 將多段文本翻譯為英文，
+    先查詢翻譯快取，未命中的文本合併為一次 translate 呼叫。
+
+    Args:
+        texts (list): 原始文本（中文）列表。
+
+    Returns:
+        list: 與 texts 等長的英文翻譯列表，翻譯失敗者為空字串。
+    """
+    keys = [translation_cache_key(text) for text in texts]
+    results = [translation_cache.get(key) for key in keys]
+    missing = [i for i, translated in enumerate(results) if translated is None]
+    if missing:
+        try:
+            translations = translate_upstream.call_sync(
+                translate_client.translate, [texts[i] for i in missing], target_language='en', idempotent=True
+            )
+            for i, result in zip(missing, translations):
+                results[i] = result['translatedText']
+                translation_cache.set(keys[i], results[i])
+        except Exception as e:
+            logger.error(f"翻譯失敗：{str(e)}")
+            for i in missing:
+                results[i] = ""
+    return results
+
 def translate_text_sync(text):
     """
     同步使用 Google Translate API 將文本翻譯為英文。
@@ -175,16 +645,18 @@ def translate_text_sync(text):
     Returns:
         str: 翻譯後的英文文本。
     """
-    try:
-        result = translate_client.translate(text, target_language='en')
-        return result['translatedText']
-    except Exception as e:
-        logger.error(f"翻譯失敗：{str(e)}")
-        return ""
+    return translate_texts_sync([text])[0]
+
+translation_batcher = MicroBatcher(
+    translate_texts_sync,
+    executor,
+    max_batch_size=TRANSLATION_BATCH_MAX_SIZE,
+    max_wait=TRANSLATION_BATCH_WINDOW_MS / 1000
+)
 
 async def translate_text_async(text):
     """
-    非同步使用 ThreadPoolExecutor 執行同步翻譯函式。
+    非同步翻譯文本，透過微批次合併器與其他同時到達的請求共用一次 API 呼叫。
 
     Args:
         text (str): 原始文本（中文）。
@@ -192,48 +664,96 @@ async def translate_text_async(text):
     Returns:
         str: 翻譯後的英文文本。
     """
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        executor,
-        translate_text_sync,
-        text
-    )
+    return await translation_batcher.submit(text)
 
 
 
 # 在檔案末尾新增以下 SSE 版本的流式回應相關函式
 
+_stream_semaphore = None
+stream_counters = {"active": 0, "waiting": 0, "total": 0}
+
+def get_stream_semaphore():
+    # 延遲建立，確保綁定到實際執行的事件迴圈
+    global _stream_semaphore
+    if _stream_semaphore is None:
+        _stream_semaphore = asyncio.Semaphore(MAX_CONCURRENT_STREAMS)
+    return _stream_semaphore
+
+def stream_stats():
+    return dict(stream_counters, limit=MAX_CONCURRENT_STREAMS)
+
 async def stream_response_async(params):
     """
-    非同步地從 OpenAI API 取得串流回應，並利用 asyncio.Queue 將同步迭代包裝成非同步產生器。
+    非同步地從 OpenAI API 取得串流回應。
+    產生器被關閉或取消（例如用戶中斷連線）時會一併關閉上游串流，停止消耗 token。
     """
-    loop = asyncio.get_event_loop()
-    q = asyncio.Queue()
-
-    def run():
-        try:
-            # 使用 OpenAI API 產生器逐塊讀取回應
-            for chunk in client.chat.completions.create(**params):
-                # 由於 delta 現在是一個物件，因此使用屬性存取
-                delta = chunk.choices[0].delta
-                content = delta.content if hasattr(delta, "content") else ""
-                asyncio.run_coroutine_threadsafe(q.put(content), loop)
-        except Exception as e:
-            logger.error(f"流式回應錯誤: {e}")
-        finally:
-            asyncio.run_coroutine_threadsafe(q.put(None), loop)
-
-    executor.submit(run)
+    stream_counters["waiting"] += 1
+    try:
+        await get_stream_semaphore().acquire()
+    finally:
+        stream_counters["waiting"] -= 1
+    stream_counters["active"] += 1
+    stream_counters["total"] += 1
+    stream = None
+    try:
+        stream = await openrouter_upstream.call(
+            get_async_client().chat.completions.create, **params
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if content:
+                yield content
+    except Exception as e:
+        # 交由呼叫端送出 error 事件，避免中斷的回答被當成完整回答
+        logger.error(f"流式回應錯誤: {e}")
+        raise
+    finally:
+        if stream is not None:
+            await stream.close()
+        stream_counters["active"] -= 1
+        get_stream_semaphore().release()
+
+async def ask_sex_related_async(query: str, model) -> bool:
+    """
+    以非同步客戶端進行 LLM 判斷，不阻塞事件迴圈，發生錯誤時直接拋出例外。
+    """
+    prompt = f"問題：{query}\n回覆："
+    response = await openrouter_upstream.call(
+        get_async_client().chat.completions.create,
+        extra_headers=EXTRA_HEADERS,
+        model=model,
+        max_tokens=3,
+        temperature=0.4,
+        messages=[
+            {"role": "system", "content": "請判斷以下問題是否與性或性知識或身體有任何關聯。請僅回覆「是」或「否」。"},
+            {"role": "user", "content": prompt}
+        ],
+    )
+    answer = response.choices[0].message.content
+    return answer.strip() == "是"
+
+# 主題分類器：關鍵字 / 嵌入相似度能判斷的問題不需呼叫 LLM
+TOPIC_CLASSIFIER_CACHE_SIZE = int(os.getenv("TOPIC_CLASSIFIER_CACHE_SIZE", "4096"))
+TOPIC_CLASSIFIER_CACHE_TTL = float(os.getenv("TOPIC_CLASSIFIER_CACHE_TTL", str(7 * 24 * 3600)))
+TOPIC_CLASSIFIER_POSITIVE_THRESHOLD = float(os.getenv("TOPIC_CLASSIFIER_POSITIVE_THRESHOLD", "0.75"))
+TOPIC_CLASSIFIER_MARGIN = float(os.getenv("TOPIC_CLASSIFIER_MARGIN", "0.08"))
+
+topic_classifier = TopicClassifier(
+    embed_fn=load_query_embedding_async,
+    llm_fn=ask_sex_related_async,
+    cache=LRUCache(maxsize=TOPIC_CLASSIFIER_CACHE_SIZE, ttl=TOPIC_CLASSIFIER_CACHE_TTL),
+    normalize_fn=normalize_query_text,
+    positive_threshold=TOPIC_CLASSIFIER_POSITIVE_THRESHOLD,
+    margin=TOPIC_CLASSIFIER_MARGIN
+)
 
-    while True:
-        content = await q.get()
-        if content is None:
-            break
-        yield content
-        
-def is_sex_related(query: str, model) -> bool:
+async def is_sex_related_async(query: str, model) -> bool:
     """
-    判斷問題是否與性相關，使用串流模式以取得回應後判斷。
+    非同步判斷問題是否與性相關，依序使用快取、關鍵字、嵌入相似度，
+    只有模糊的問題才呼叫 LLM。
 
     Args:
         query (str): 用戶的查詢。
@@ -242,23 +762,7 @@ def is_sex_related(query: str, model) -> bool:
     Returns:
         bool: 如果問題與性相關，返回 True，否則返回 False。
     """
-    prompt = f"問題：{query}\n回覆："
-    try:
-        response = client.chat.completions.create(
-            extra_headers=EXTRA_HEADERS,
-            model=model,
-            max_tokens=3,
-            temperature=0.4,
-            messages=[
-                {"role": "system", "content": "請判斷以下問題是否與性或性知識或身體有任何關聯。請僅回覆「是」或「否」。"},
-                {"role": "user", "content": prompt}
-            ],
-        )
-        answer = response.choices[0].message.content
-        return answer.strip() == "是"
-    except Exception as e:
-        logger.error(f"判斷性相關性時出錯：{e}")
-        return False 
+    return await topic_classifier.classify(query, model)
 
 
 async def generate_response_stream(documents_cn, documents_en, user_query, additional_context, model, web_search: bool = False):
@@ -304,8 +808,17 @@ async def generate_response_stream(documents_cn, documents_en, user_query, addit
         "stream": True
     }
     
-    async for chunk in stream_response_async(params):
-        yield {"event": "message", "data": chunk}
+    stream = stream_response_async(params)
+    try:
+        async for chunk in stream:
+            yield {"event": "message", "data": chunk}
+    except Exception:
+        # 上游失敗時以 error 事件結束，不送出 end
+        yield {"event": "error", "data": STREAM_ERROR_MESSAGE}
+        return
+    finally:
+        # 下游中斷時立即關閉上游串流
+        await stream.aclose()
     yield {"event": "end", "data": ""}
 
 async def generate_direct_response_stream(user_query: str, additional_context: list, model: str, web_search: bool = False):
@@ -340,6 +853,15 @@ async def generate_direct_response_stream(user_query: str, additional_context: l
         "stream": True
     }
     
-    async for chunk in stream_response_async(params):
-        yield {"event": "message", "data": chunk}
+    stream = stream_response_async(params)
+    try:
+        async for chunk in stream:
+            yield {"event": "message", "data": chunk}
+    except Exception:
+        # 上游失敗時以 error 事件結束，不送出 end
+        yield {"event": "error", "data": STREAM_ERROR_MESSAGE}
+        return
+    finally:
+        # 下游中斷時立即關閉上游串流
+        await stream.aclose()
     yield {"event": "end", "data": ""} 
\ No newline at end of file
@@ -0,0 +1,209 @@
+"""
+語意回答快取。
+
+以（查詢嵌入、模型、是否啟用 RAG、對話上下文）為鍵保存完整的生成回答；
+新問題與快取中同組別的問題餘弦相似度超過門檻時，直接以相同的 SSE 事件格式分段重播，
+前端的呈現方式與即時生成相同。回答會參考使用者最近的對話，因此只有上下文相同時才會共用。
+"""
+import json
+import time
+import asyncio
+import hashlib
+import threading
+
+import numpy as np
+
+
+def context_fingerprint(user_context):
+    """
+    對話上下文的雜湊，作為快取組別的一部分；沒有上下文時回傳空字串。
+
+    Args:
+        user_context (list): 最近的對話記錄（含 message 與 is_bot）。
+    """
+    if not user_context:
+        return ""
+    payload = json.dumps(
+        [[bool(msg.get("is_bot")), msg.get("message", "")] for msg in user_context],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SemanticAnswerCache:
+    """
+    依餘弦相似度查找的回答快取。
+
+    Args:
+        threshold (float): 命中所需的最低餘弦相似度。
+        max_entries (int): 所有組別合計的最大項目數，超過時淘汰最舊的項目。
+        ttl (float): 項目存活秒數。
+    """
+
+    def __init__(self, threshold=0.95, max_entries=2000, ttl=24 * 3600):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # (model, rag, context) -> {"vectors": np.ndarray, "answers": list, "created": np.ndarray}
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _size(self):
+        return sum(len(bucket["answers"]) for bucket in self._buckets.values())
+
+    def _drop_expired(self, now):
+        for key, bucket in list(self._buckets.items()):
+            keep = bucket["created"] > now - self.ttl
+            if not keep.all():
+                self._buckets[key] = {
+                    "vectors": bucket["vectors"][keep],
+                    "answers": [a for a, k in zip(bucket["answers"], keep) if k],
+                    "created": bucket["created"][keep],
+                }
+
+    def _evict_oldest(self, count):
+        for _ in range(count):
+            oldest_key = min(
+                (key for key, bucket in self._buckets.items() if bucket["answers"]),
+                key=lambda key: self._buckets[key]["created"][0],
+                default=None
+            )
+            if oldest_key is None:
+                return
+            bucket = self._buckets[oldest_key]
+            bucket["vectors"] = bucket["vectors"][1:]
+            bucket["answers"] = bucket["answers"][1:]
+            bucket["created"] = bucket["created"][1:]
+
+    def lookup(self, embedding, model, rag, context=""):
+        """
+        查找相似問題的快取回答。
+
+        Args:
+            embedding (list): 查詢的嵌入向量。
+            model (str): 使用的模型。
+            rag (bool): 是否啟用 RAG。
+            context (str): 對話上下文的雜湊（context_fingerprint）。
+
+        Returns:
+            str: 命中時回傳快取的完整回答，否則為 None。
+        """
+        vector = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get((model, rag, context))
+            if bucket is not None and bucket["answers"]:
+                scores = bucket["vectors"] @ vector
+                scores[bucket["created"] <= now - self.ttl] = -1.0
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.hits += 1
+                    return bucket["answers"][best]
+            self.misses += 1
+            return None
+
+    def store(self, embedding, model, rag, answer, context=""):
+        """
+        保存一筆完整的生成回答。
+        """
+        vector = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            self._drop_expired(now)
+            bucket = self._buckets.get((model, rag, context))
+            if bucket is None:
+                bucket = {
+                    "vectors": np.empty((0, vector.shape[0]), dtype=np.float32),
+                    "answers": [],
+                    "created": np.empty(0, dtype=np.float64),
+                }
+                self._buckets[(model, rag, context)] = bucket
+            bucket["vectors"] = np.vstack([bucket["vectors"], vector[None, :]])
+            bucket["answers"] = bucket["answers"] + [answer]
+            bucket["created"] = np.append(bucket["created"], now)
+            overflow = self._size() - self.max_entries
+            if overflow > 0:
+                self._evict_oldest(overflow)
+
+    def purge(self):
+        """
+        清空快取。
+
+        Returns:
+            int: 被清除的項目數量。
+        """
+        with self._lock:
+            count = self._size()
+            self._buckets = {}
+        return count
+
+    def stats(self):
+        with self._lock:
+            size = self._size()
+        lookups = self.hits + self.misses
+        return {
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+async def replay_answer_stream(answer, chunk_size=16, delay=0.01):
+    """
+    以與即時生成相同的 SSE 事件格式分段重播快取的回答。
+
+    Args:
+        answer (str): 完整回答。
+        chunk_size (int): 每段的字元數。
+        delay (float): 每段之間的間隔秒數，讓前端維持逐字顯示的效果。
+
+    Yields:
+        dict: 包含 SSE 事件的訊息。
+    """
+    for start in range(0, len(answer), chunk_size):
+        yield {"event": "message", "data": answer[start:start + chunk_size]}
+        await asyncio.sleep(delay)
+    yield {"event": "end", "data": ""}
+
+
+async def collect_answer_stream(stream, on_complete, on_abort=None):
+    """
+    轉送 SSE 事件並累積 message 片段，收到 end 事件時以完整回答呼叫 on_complete。
+    串流中途被中斷或收到 error 事件（上游失敗）時不會呼叫 on_complete；
+    若有提供 on_abort，則以已產生的部分回答呼叫之。
+
+    Args:
+        stream: 產生 SSE 事件的非同步產生器。
+        on_complete (callable): 接收完整回答字串的函式。
+        on_abort (callable): 接收部分回答字串的函式（可選）。
+
+    Yields:
+        與 stream 相同的事件。
+    """
+    chunks = []
+    completed = False
+    failed = False
+    try:
+        async for event in stream:
+            if isinstance(event, dict):
+                if event.get("event") == "message":
+                    chunks.append(event["data"])
+                elif event.get("event") == "error":
+                    failed = True
+                elif event.get("event") == "end" and chunks and not failed:
+                    completed = True
+                    on_complete("".join(chunks))
+            yield event
+    finally:
+        await stream.aclose()
+        if on_abort is not None and not completed and chunks:
+            on_abort("".join(chunks))
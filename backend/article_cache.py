@@ -0,0 +1,219 @@
+"""
+行程內文章快取。
+
+啟動時以 Firestore on_snapshot 監聽 articles 集合：第一次回呼載入全部文章，
+之後的新增 / 修改 / 刪除會即時套用到快取，並維護 user_id、tag、category 的次要索引。
+文章的新增、編輯與刪除端點也會直接寫入快取，讓使用者立即讀到自己的修改，
+監聽器稍後送達的同一筆變更只會覆寫成 Firestore 上的最終值。
+"""
+import datetime
+import logging
+import threading
+
+logger = logging.getLogger('uvicorn.error')
+
+
+def _normalize(data):
+    """將不含時區的 datetime 視為 UTC，讓寫入端與監聽器的時間可以互相比較。"""
+    published_at = data.get("published_at")
+    if isinstance(published_at, datetime.datetime) and published_at.tzinfo is None:
+        data = dict(data, published_at=published_at.replace(tzinfo=datetime.timezone.utc))
+    return data
+
+
+def _sort_key(item):
+    article_id, data = item
+    published_at = data.get("published_at")
+    # 依 published_at 由新到舊，沒有時間的文章排在最後；同時間以 ID 排序以保持穩定
+    if isinstance(published_at, datetime.datetime):
+        return (1, published_at.timestamp(), article_id)
+    return (0, 0.0, article_id)
+
+
+class ArticleCache:
+    """
+    以 Firestore 快照監聽器維持最新狀態的文章快取。
+
+    Args:
+        collection (firestore.CollectionReference): 文章集合。
+        ready_timeout (float): start() 等待第一次快照的秒數。
+    """
+
+    def __init__(self, collection, ready_timeout=10):
+        self.collection = collection
+        self.ready_timeout = ready_timeout
+        self._articles = {}
+        self._by_user = {}
+        self._by_tag = {}
+        self._by_category = {}
+        self._ordered = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._watch = None
+        self.version = 0
+        self.snapshots = 0
+        self.reads = 0
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def start(self):
+        """
+        開始監聽文章集合，並等待第一次快照載入完成（逾時則由呼叫端退回直接查詢）。
+        """
+        if self._watch is None:
+            self._watch = self.collection.on_snapshot(self._on_snapshot)
+        if not self._ready.wait(self.ready_timeout):
+            logger.warning(f"文章快取未在 {self.ready_timeout} 秒內完成載入，暫時改為直接查詢 Firestore")
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+        self._ready.clear()
+
+    def _on_snapshot(self, collection_snapshot, changes, read_time):
+        with self._lock:
+            if not self._ready.is_set():
+                # 第一次快照包含整個集合
+                for doc in collection_snapshot:
+                    self._put(doc.id, doc.to_dict())
+            else:
+                for change in changes:
+                    if change.type.name == "REMOVED":
+                        self._remove(change.document.id)
+                    else:
+                        self._put(change.document.id, change.document.to_dict())
+            self.snapshots += 1
+        if not self._ready.is_set():
+            logger.info(f"文章快取載入完成，共 {len(self._articles)} 篇")
+            self._ready.set()
+
+    def _index(self, article_id, data, add):
+        keys = [
+            (self._by_user, data.get("user_id")),
+            (self._by_category, data.get("category")),
+        ] + [(self._by_tag, tag) for tag in data.get("tags") or []]
+        for index, key in keys:
+            if key is None:
+                continue
+            if add:
+                index.setdefault(key, set()).add(article_id)
+            else:
+                ids = index.get(key)
+                if ids is not None:
+                    ids.discard(article_id)
+                    if not ids:
+                        del index[key]
+
+    def _put(self, article_id, data):
+        previous = self._articles.get(article_id)
+        if previous is not None:
+            self._index(article_id, previous, add=False)
+        data = _normalize(data)
+        self._articles[article_id] = data
+        self._index(article_id, data, add=True)
+        self._ordered = None
+        self.version += 1
+
+    def _remove(self, article_id):
+        previous = self._articles.pop(article_id, None)
+        if previous is not None:
+            self._index(article_id, previous, add=False)
+            self._ordered = None
+            self.version += 1
+
+    def put(self, article_id, data):
+        """寫入整篇文章（新增文章後呼叫）。"""
+        with self._lock:
+            self._put(article_id, dict(data))
+
+    def merge(self, article_id, fields):
+        """合併部分欄位（編輯文章後呼叫）。"""
+        with self._lock:
+            self._put(article_id, dict(self._articles.get(article_id, {}), **fields))
+
+    def remove(self, article_id):
+        """移除文章（刪除文章後呼叫）。"""
+        with self._lock:
+            self._remove(article_id)
+
+    def get(self, article_id):
+        """
+        取得單篇文章的複本；快取未就緒或找不到時回傳 None。
+        """
+        if not self.ready:
+            return None
+        with self._lock:
+            data = self._articles.get(article_id)
+            return dict(data) if data is not None else None
+
+    def list(self, user_id=None, tag=None, category=None, limit=None, cursor=None, fields=None):
+        """
+        依條件列出文章，依 published_at 由新到舊排序。
+
+        Args:
+            user_id (str): 只列出此使用者的文章。
+            tag (str): 只列出含此標籤的文章。
+            category (str): 只列出此分類的文章。
+            limit (int): 每頁數量；None 表示全部。
+            cursor (str): 上一頁最後一篇文章的 ID。
+            fields (list): 要回傳的欄位；None 表示全部。
+
+        Returns:
+            tuple: (文章列表, 下一頁游標或 None)。
+        """
+        with self._lock:
+            if self._ordered is None:
+                self._ordered = [
+                    article_id for article_id, _ in
+                    sorted(self._articles.items(), key=_sort_key, reverse=True)
+                ]
+            ordered = self._ordered
+            candidates = None
+            for index, key in ((self._by_user, user_id), (self._by_tag, tag), (self._by_category, category)):
+                if key is None:
+                    continue
+                ids = index.get(key, set())
+                candidates = ids if candidates is None else candidates & ids
+            if candidates is None:
+                matched = ordered
+            elif not candidates:
+                matched = []
+            else:
+                matched = [article_id for article_id in ordered if article_id in candidates]
+
+            start = 0
+            if cursor:
+                try:
+                    start = matched.index(cursor) + 1
+                except ValueError:
+                    raise KeyError(cursor)
+            page = matched[start:start + limit] if limit is not None else matched[start:]
+
+            articles = []
+            for article_id in page:
+                data = self._articles[article_id]
+                article = {field: data[field] for field in fields if field in data} if fields else dict(data)
+                article['id'] = article_id
+                articles.append(article)
+            self.reads += 1
+
+        next_cursor = None
+        if limit is not None and start + limit < len(matched):
+            next_cursor = page[-1]
+        return articles, next_cursor
+
+    def stats(self):
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "articles": len(self._articles),
+                "users": len(self._by_user),
+                "tags": len(self._by_tag),
+                "categories": len(self._by_category),
+                "version": self.version,
+                "snapshots": self.snapshots,
+                "reads": self.reads,
+            }
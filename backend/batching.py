@@ -0,0 +1,86 @@
+"""
+非同步微批次合併器。
+
+在短時間窗內收集多個呼叫端的請求，合併成一次批次呼叫送到執行緒池，
+再把結果分送回各自等待的呼叫端，以減少上游往返次數與執行緒池壓力。
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger('uvicorn.error')
+
+
+class MicroBatcher:
+    """
+    將單筆請求合併為批次呼叫。
+
+    Args:
+        batch_fn (callable): 同步批次函式，接收項目列表並回傳等長的結果列表。
+        executor (Executor): 執行 batch_fn 的執行緒池。
+        max_batch_size (int): 單一批次的最大項目數，達到時立即送出。
+        max_wait (float): 第一筆請求進入後最多等待的秒數。
+    """
+
+    def __init__(self, batch_fn, executor, max_batch_size=16, max_wait=0.01):
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item):
+        """
+        提交單筆項目並等待其結果。
+
+        Args:
+            item: 要處理的項目，需可作為 dict 鍵以合併重複項目。
+
+        Returns:
+            batch_fn 對此項目的結果。
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        if pending:
+            asyncio.ensure_future(self._run_batch(pending))
+
+    async def _run_batch(self, pending):
+        # 同一批次內的重複項目只送出一次
+        unique_items = list(dict.fromkeys(item for item, _ in pending))
+        self.batches += 1
+        self.items += len(pending)
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.batch_fn, unique_items)
+            by_item = dict(zip(unique_items, results))
+        except Exception as e:
+            logger.error(f"批次呼叫失敗（{len(unique_items)} 筆）：{e}")
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for item, future in pending:
+            if not future.done():
+                future.set_result(by_item[item])
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0.0,
+            "pending": len(self._pending),
+        }
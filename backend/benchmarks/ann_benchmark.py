@@ -0,0 +1,138 @@
+"""
+IVF 近似檢索基準測試。
+
+以合成的群聚向量比較 IVF（int8 殘差）與精確檢索的 recall@k、每秒查詢數與常駐記憶體，
+協助挑選 nlist / nprobe / rerank 的運作點。
+
+用法（於 backend 目錄下執行）：
+
+    python benchmarks/ann_benchmark.py --sizes 10000 100000 1000000 --nprobe 4 8 16 32
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vector_index import IVFIndex, _normalize_rows  # noqa: E402
+
+
+def resident_memory_mb():
+    """目前行程的常駐記憶體（MB）；非 Linux 平台回傳峰值。"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def synthetic_matrix(path, n, dim, n_topics, seed=0, chunk_size=65536):
+    """
+    產生具群聚結構的合成向量並寫入 mmap 檔案，模擬真實文檔嵌入的主題分布。
+
+    Returns:
+        tuple: (mmap 矩陣, 主題中心)
+    """
+    rng = np.random.default_rng(seed)
+    topics = _normalize_rows(rng.standard_normal((n_topics, dim)).astype(np.float32))
+    matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n, dim))
+    for start in range(0, n, chunk_size):
+        size = min(chunk_size, n - start)
+        block = topics[rng.integers(0, n_topics, size)]
+        block = block + rng.standard_normal((size, dim)).astype(np.float32) * (0.6 / np.sqrt(dim))
+        matrix[start:start + size] = _normalize_rows(block)
+    matrix.flush()
+    return matrix, topics
+
+
+def exact_top_k(matrix, queries, k, chunk_size=65536):
+    """分塊精確計算每個查詢的 top-k 列號。"""
+    best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), k), dtype=np.int64)
+    for start in range(0, matrix.shape[0], chunk_size):
+        scores = queries @ np.asarray(matrix[start:start + chunk_size]).T
+        all_scores = np.concatenate([best_scores, scores], axis=1)
+        all_ids = np.concatenate(
+            [best_ids, np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)], axis=1
+        )
+        top = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(all_scores, top, axis=1)
+        best_ids = np.take_along_axis(all_ids, top, axis=1)
+    return best_ids
+
+
+def run(size, args, workdir):
+    rng = np.random.default_rng(size)
+    matrix, _ = synthetic_matrix(
+        os.path.join(workdir, f"bench_{size}.npy"), size, args.dim, max(16, size // 500)
+    )
+    picks = rng.integers(0, size, args.queries)
+    queries = _normalize_rows(
+        np.asarray(matrix[np.sort(picks)]) + rng.standard_normal((args.queries, args.dim)).astype(np.float32) * 0.02
+    )
+
+    truth = exact_top_k(matrix, queries, args.k)
+
+    # 精確檢索：與 Snapshot.search 相同，整個矩陣一次內積
+    start = time.perf_counter()
+    for q in queries:
+        scores = matrix @ q
+        np.argpartition(-scores, args.k - 1)[:args.k]
+    exact_qps = len(queries) / (time.perf_counter() - start)
+    exact_rss = resident_memory_mb()
+    print(f"\n== n={size:,} dim={args.dim} ==")
+    print(f"exact      qps={exact_qps:9.1f}  matrix={matrix.nbytes / 2 ** 20:8.1f}MB  rss={exact_rss:8.1f}MB")
+
+    # 重新開啟 mmap，讓 IVF 的記憶體量測不受精確檢索已載入的分頁影響
+    del matrix
+    matrix = np.load(os.path.join(workdir, f"bench_{size}.npy"), mmap_mode='r')
+    start = time.perf_counter()
+    ivf = IVFIndex.build(matrix, nlist=args.nlist)
+    build_seconds = time.perf_counter() - start
+    ivf.save(workdir)
+    del ivf
+    ivf = IVFIndex.load(workdir)
+    print(f"ivf build  nlist={ivf.nlist}  {build_seconds:.1f}s  index={ivf.nbytes / 2 ** 20:.1f}MB")
+
+    for rerank in args.rerank:
+        for nprobe in args.nprobe:
+            exact_matrix = matrix if rerank else None
+            hits = 0
+            start = time.perf_counter()
+            for i, q in enumerate(queries):
+                ids, _ = ivf.search(q, args.k, nprobe=nprobe, exact_matrix=exact_matrix, rerank=rerank)
+                hits += len(np.intersect1d(ids, truth[i]))
+            qps = len(queries) / (time.perf_counter() - start)
+            recall = hits / (len(queries) * args.k)
+            print(
+                f"ivf        nprobe={nprobe:<4} rerank={rerank:<2} recall@{args.k}={recall:.3f}  "
+                f"qps={qps:9.1f}  rss={resident_memory_mb():8.1f}MB"
+            )
+    del ivf, matrix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IVF 近似檢索 recall / QPS / 記憶體基準測試")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nlist", type=int, default=None, help="群集數量，預設為 4 * sqrt(n)")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--rerank", type=int, nargs="+", default=[0, 4],
+                        help="候選重新排序倍數，0 表示只用量化分數")
+    parser.add_argument("--workdir", default=None, help="合成資料存放目錄，預設為暫存目錄")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for size in args.sizes:
+            run(size, args, workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+ID token 驗證微基準測試。
+
+以本地產生的 RSA 金鑰簽發模擬的 Firebase ID token，比較每個請求的驗證耗時：
+
+- uncached：每次都做完整的 RSA 驗章與 claim 檢查（等同未快取時的 verify_token）。
+- cached：以 token 雜湊命中快取，只做 SHA-256 與 LRU 查找。
+
+用法（於 backend 目錄下執行）：
+
+    python benchmarks/auth_benchmark.py --users 100 --requests 20000
+"""
+import os
+import sys
+import time
+import argparse
+
+import rsa
+from google.auth import crypt, jwt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from token_verifier import CertificateStore, CachedTokenVerifier, ID_TOKEN_ISSUER_PREFIX  # noqa: E402
+
+PROJECT_ID = "benchmark-project"
+KEY_ID = "benchmark-key"
+
+
+def make_tokens(count):
+    """產生 count 個不同使用者的 token 與對應的憑證。"""
+    public_key, private_key = rsa.newkeys(2048)
+    signer = crypt.RSASigner.from_string(private_key.save_pkcs1().decode(), key_id=KEY_ID)
+    now = int(time.time())
+    tokens = []
+    for i in range(count):
+        payload = {
+            "iss": ID_TOKEN_ISSUER_PREFIX + PROJECT_ID,
+            "aud": PROJECT_ID,
+            "sub": f"user-{i}",
+            "iat": now,
+            "exp": now + 3600,
+            "auth_time": now,
+        }
+        tokens.append(jwt.encode(signer, payload).decode())
+    return tokens, {KEY_ID: public_key.save_pkcs1().decode()}
+
+
+def run(verifier, tokens, requests):
+    start = time.perf_counter()
+    for i in range(requests):
+        verifier.verify(tokens[i % len(tokens)])
+    elapsed = time.perf_counter() - start
+    return elapsed / requests * 1e6, requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比較有無 token 快取時的驗證耗時")
+    parser.add_argument("--users", type=int, default=100, help="不同 token 的數量")
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    tokens, certs = make_tokens(args.users)
+    cert_store = CertificateStore(fetch_fn=lambda: (certs, 3600))
+    cert_store.refresh()
+
+    uncached = CachedTokenVerifier(PROJECT_ID, cert_store, cache_size=0)
+    cached = CachedTokenVerifier(PROJECT_ID, cert_store, cache_size=args.users * 2)
+    # 預熱，讓 cached 的結果反映穩定狀態的命中
+    for token in tokens:
+        cached.verify(token)
+
+    print(f"{'mode':>10} {'us/req':>10} {'req/s':>12}")
+    for name, verifier in (("uncached", uncached), ("cached", cached)):
+        per_request, throughput = run(verifier, tokens, args.requests)
+        print(f"{name:>10} {per_request:>10.1f} {throughput:>12.0f}")
+    print(f"cache: {cached.cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+同時登入時的事件迴圈延遲基準測試。
+
+以一個每 10 ms 喚醒一次的探測協程量測事件迴圈延遲（實際喚醒時間 - 預期時間），
+同時發出多個密碼驗證請求，比較：
+
+- inline：在協程中直接呼叫 bcrypt.checkpw（等同修改前的 /login）。
+- pool：交給 PasswordHasher 的行程池。
+
+探測協程的延遲代表同一個 worker 上 SSE 串流送出下一段資料時會被耽誤多久。
+
+用法（於 backend 目錄下執行）：
+
+    python benchmarks/password_benchmark.py --logins 32 --rounds 12 --workers 2
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+import bcrypt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import LatencyStats  # noqa: E402
+from password_hasher import PasswordHasher  # noqa: E402
+
+PROBE_INTERVAL = 0.01
+
+
+async def probe(lag, stop):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + PROBE_INTERVAL
+        await asyncio.sleep(PROBE_INTERVAL)
+        lag.observe(max(loop.time() - expected, 0.0))
+
+
+async def inline_login(password, hashed):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+async def run(mode, logins, password, hashed, hasher):
+    lag = LatencyStats()
+    stop = asyncio.Event()
+    prober = asyncio.create_task(probe(lag, stop))
+    await asyncio.sleep(PROBE_INTERVAL * 5)
+
+    started = time.perf_counter()
+    if mode == "inline":
+        results = await asyncio.gather(*(inline_login(password, hashed) for _ in range(logins)))
+    else:
+        results = [ok for ok, _ in await asyncio.gather(*(hasher.verify(password, hashed) for _ in range(logins)))]
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await prober
+    assert all(results)
+    return elapsed, lag.stats()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="比較 bcrypt 在事件迴圈內與行程池中執行時的事件迴圈延遲")
+    parser.add_argument("--logins", type=int, default=32, help="同時發出的登入請求數")
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt cost")
+    parser.add_argument("--workers", type=int, default=2, help="行程池大小")
+    args = parser.parse_args()
+
+    password = "correct horse battery staple"
+    hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(args.rounds)).decode('utf-8')
+    hasher = PasswordHasher(workers=args.workers, rounds=args.rounds, max_pending=args.logins)
+    hasher.start()
+    # 預熱工作行程，避免把啟動時間算進結果
+    await hasher.verify(password, hashed)
+
+    print(f"{'mode':>8} {'total_s':>8} {'logins/s':>9} {'lag_p50_ms':>11} {'lag_p95_ms':>11} {'lag_max_ms':>11}")
+    try:
+        for mode in ("inline", "pool"):
+            elapsed, lag = await run(mode, args.logins, password, hashed, hasher)
+            print(
+                f"{mode:>8} {elapsed:>8.2f} {args.logins / elapsed:>9.1f} "
+                f"{lag['p50_ms']:>11.1f} {lag['p95_ms']:>11.1f} {lag['max_ms']:>11.1f}"
+            )
+    finally:
+        hasher.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,252 @@
+"""
+共用快取元件。
+
+- LRUCache：行程內 LRU 快取，支援 TTL 與項目數量上限。
+- SQLiteCache：以 SQLite 檔案保存的持久快取，支援 TTL 與項目數量上限，
+  多個 gunicorn worker 可共用同一個檔案，重啟後依然有效。
+- TwoTierCache：LRU 在前、SQLite 在後的兩層快取，並統計各層命中次數。
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('uvicorn.error')
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    執行緒安全的行程內 LRU 快取。
+
+    Args:
+        maxsize (int): 最多保留的項目數量。
+        ttl (float): 預設存活秒數；None 表示不過期。
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.time():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        """讀取未過期的項目，但不計入命中統計、也不更新 LRU 順序。"""
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                return default
+            return value
+
+    def set(self, key, value, ttl=_MISSING):
+        """
+        寫入快取。
+
+        Args:
+            key: 快取鍵。
+            value: 快取值。
+            ttl (float): 此項目的存活秒數；未指定時使用預設值，None 表示不過期。
+        """
+        ttl = self.ttl if ttl is _MISSING else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+class SQLiteCache:
+    """
+    以 SQLite 保存的持久快取。
+
+    值預設以 JSON 序列化，可傳入 dumps / loads 改用其他格式（例如 float32 位元組）。
+    超過 max_entries 時依最後存取時間淘汰最舊的項目。
+
+    Args:
+        path (str): SQLite 檔案路徑。
+        ttl (float): 存活秒數；None 表示不過期。
+        max_entries (int): 最多保留的項目數量。
+        dumps (callable): 序列化函式。
+        loads (callable): 反序列化函式。
+    """
+
+    def __init__(self, path, ttl=None, max_entries=100000, dumps=json.dumps, loads=json.loads):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._dumps = dumps
+        self._loads = loads
+        self._lock = threading.Lock()
+        self._writes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        with self._lock:
+            # WAL 模式讓多個 worker 行程可同時讀取
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB, expires_at REAL, accessed_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)")
+            self._conn.commit()
+
+    def get(self, key, default=None):
+        now = time.time()
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return default
+                value, expires_at = row
+                if expires_at is not None and expires_at <= now:
+                    self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    self._conn.commit()
+                    return default
+                self._conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+            return self._loads(value)
+        except sqlite3.Error as e:
+            logger.warning(f"讀取持久快取失敗：{e}")
+            return default
+
+    def set(self, key, value, ttl=_MISSING):
+        ttl = self.ttl if ttl is _MISSING else ttl
+        now = time.time()
+        expires_at = now + ttl if ttl is not None else None
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, self._dumps(value), expires_at, now)
+                )
+                self._writes += 1
+                # 每寫入一定次數才做一次淘汰，避免每次都計算筆數
+                if self._writes % 100 == 0:
+                    self._evict(now)
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"寫入持久快取失敗：{e}")
+
+    def pop(self, key):
+        try:
+            with self._lock:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"刪除持久快取失敗：{e}")
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN ("
+                "SELECT key FROM cache ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class TwoTierCache:
+    """
+    行程內 LRU 在前、持久快取在後的兩層快取。
+
+    Args:
+        memory (LRUCache): 第一層快取。
+        disk (SQLiteCache): 第二層快取；None 表示只使用記憶體。
+    """
+
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = self.memory.get(key, _MISSING)
+        if value is not _MISSING:
+            self.memory_hits += 1
+            return value
+        if self.disk is not None:
+            value = self.disk.get(key, _MISSING)
+            if value is not _MISSING:
+                self.disk_hits += 1
+                self.memory.set(key, value)
+                return value
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def pop(self, key):
+        self.memory.pop(key)
+        if self.disk is not None:
+            self.disk.pop(key)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_size": len(self.memory),
+        }
@@ -0,0 +1,708 @@
+"""
+聊天記錄儲存層。
+
+資料結構：
+
+    chat_histories/{uid}                 # 摘要文件：recent（最近訊息）、message_count、updated_at
+    chat_histories/{uid}/messages/{id}   # 每則訊息一份文件，依 timestamp 排序
+
+- 新增訊息只寫入一份訊息文件（文件 ID 為 message_id，重試不會重複寫入）並以 ArrayUnion 追加到摘要的 recent，不需先讀取；
+  recent 超過上限兩倍時才以交易修剪回上限，文件大小維持固定。
+- 每個行程以 LRU 保存各使用者最近訊息的環形緩衝區，/chat 組合上下文時通常不必讀取 Firestore。
+- ChatHistoryWriter 以背景執行緒延後寫入，將多位使用者的訊息合併為 Firestore 批次提交。
+- 讀取與刪除（*_async）以 Firestore AsyncClient 執行，不佔用事件迴圈或執行緒池。
+- 舊版把所有訊息存在摘要文件的 messages 陣列，請以 migrate_chat_histories.py 搬移；
+  摘要標記 migrated 之前，讀取時會把舊陣列與子集合的訊息合併（以 message_id 去除重複）。
+"""
+import json
+import asyncio
+import hashlib
+import datetime
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
+
+from cache import LRUCache
+from metrics import LatencyStats
+
+logger = logging.getLogger('uvicorn.error')
+
+MESSAGE_FIELDS = ("message", "is_bot", "timestamp")
+
+# Firestore 單一批次最多 500 個寫入操作
+BATCH_OPS_LIMIT = 500
+
+
+def _as_utc(timestamp):
+    """將 timestamp 統一為含時區的 UTC datetime，避免與 Firestore 回傳值比較時出錯。"""
+    if isinstance(timestamp, str):
+        timestamp = datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp
+
+
+def _clean_message(data):
+    return {field: data.get(field) for field in MESSAGE_FIELDS}
+
+
+def _sorted_messages(messages):
+    return sorted((_clean_message(m) for m in messages), key=lambda m: _as_utc(m["timestamp"]))
+
+
+def message_id(message):
+    """以訊息內容與時間產生固定的文件 ID；搬移舊版訊息時使用，合併讀取時據此去除重複。"""
+    raw = json.dumps(
+        [_as_utc(message["timestamp"]).isoformat(), bool(message.get("is_bot")), message.get("message")],
+        ensure_ascii=False
+    )
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _legacy_messages(data):
+    """摘要文件中尚未搬移的舊版 messages 陣列；摘要已標記 migrated 時為空列表。"""
+    if data.get("migrated"):
+        return []
+    return _sorted_messages(data.get("messages", []))
+
+
+def format_cursor(position):
+    """將（timestamp, 文件 ID）位置轉為游標字串。"""
+    timestamp, doc_id = position
+    return f"{_as_utc(timestamp).isoformat()}|{doc_id}"
+
+
+def parse_cursor(cursor):
+    """
+    解析 format_cursor 產生的游標；只有 ISO 時間的舊版游標回傳的文件 ID 為 None。
+
+    Raises:
+        ValueError: 游標格式錯誤。
+    """
+    timestamp, _, doc_id = cursor.partition("|")
+    return _as_utc(datetime.datetime.fromisoformat(timestamp)), doc_id or None
+
+
+def _start_after(query, messages_ref, position, descending=False):
+    """讓依（timestamp, 文件 ID）排序的查詢從 position 之後開始。"""
+    timestamp, doc_id = position
+    if doc_id is None:
+        # 舊版游標只有時間：略過同一時間的所有訊息
+        return query.where("timestamp", "<" if descending else ">", timestamp)
+    return query.start_after({
+        "timestamp": timestamp,
+        firestore.FieldPath.document_id(): messages_ref.document(doc_id),
+    })
+
+
+def _entry(doc_id, data):
+    message = _clean_message(data)
+    return (_as_utc(message["timestamp"]), doc_id), message
+
+
+def _legacy_entries(legacy, before=None, after=None):
+    """
+    將舊版訊息轉為以 message_id 為文件 ID 的（位置, 訊息），並依位置排序。
+    before / after 為 parse_cursor 的結果，只保留排在其之前 / 之後的訊息。
+    """
+    entries = sorted((_entry(message_id(message), message) for message in legacy), key=lambda e: e[0])
+    if before is not None:
+        entries = [e for e in entries if _position_cmp(e[0], before) < 0]
+    if after is not None:
+        entries = [e for e in entries if _position_cmp(e[0], after) > 0]
+    return entries
+
+
+def _position_cmp(position, cursor):
+    """比較位置與游標；舊版游標沒有文件 ID，只比較時間。"""
+    if cursor[1] is None:
+        position, cursor = position[0], cursor[0]
+    return (position > cursor) - (position < cursor)
+
+
+def _merge_entries(entries, legacy_entries):
+    """合併子集合與舊版訊息的（位置, 訊息），位置相同（已搬移）的只保留一份。"""
+    merged = dict(legacy_entries)
+    merged.update(entries)
+    return sorted(merged.items(), key=lambda item: item[0])
+
+
+def _merge_messages(messages, legacy):
+    """合併訊息與舊版訊息並依時間排序，相同內容與時間的訊息只保留一則。"""
+    merged = {}
+    for message in list(messages) + list(legacy):
+        merged.setdefault(message_id(message), message)
+    return _sorted_messages(merged.values())
+
+
+class _RecentBuffer:
+    """單一使用者的最近訊息環形緩衝區，並估計摘要文件中 recent 陣列目前的長度。"""
+
+    def __init__(self, messages, size, summary_length):
+        self.messages = deque(messages[-size:], maxlen=size)
+        self.summary_length = summary_length
+        self.lock = threading.Lock()
+
+
+class ChatHistoryStore:
+    """
+    以子集合保存聊天記錄，並維護最近訊息摘要與行程內環形緩衝區。
+
+    Args:
+        db (firestore.Client): Firestore 客戶端。
+        async_db (firestore.AsyncClient): Firestore 非同步客戶端，供 *_async 方法使用。
+        collection (str): 聊天記錄集合名稱。
+        recent_size (int): 摘要與環形緩衝區保留的最近訊息數量。
+        buffer_users (int): 行程內最多保留環形緩衝區的使用者數量。
+        buffer_ttl (float): 環形緩衝區的存活秒數。
+    """
+
+    def __init__(self, db, async_db=None, collection='chat_histories', recent_size=20,
+                 buffer_users=10000, buffer_ttl=600):
+        self.db = db
+        self.async_db = async_db
+        self.collection = db.collection(collection)
+        self.async_collection = async_db.collection(collection) if async_db is not None else None
+        self.recent_size = recent_size
+        # 設定存活時間，讓其他行程寫入的訊息最終也會反映到本行程的緩衝區
+        self._buffers = LRUCache(maxsize=buffer_users, ttl=buffer_ttl)
+
+    def summary_ref(self, uid):
+        return self.collection.document(uid)
+
+    def messages_ref(self, uid):
+        return self.summary_ref(uid).collection('messages')
+
+    def async_summary_ref(self, uid):
+        return self.async_collection.document(uid)
+
+    def async_messages_ref(self, uid):
+        return self.async_summary_ref(uid).collection('messages')
+
+    async def _legacy_messages_async(self, uid):
+        """讀取尚未搬移的舊版 messages 陣列。"""
+        snapshot = await self.async_summary_ref(uid).get()
+        return _legacy_messages(snapshot.to_dict() if snapshot.exists else {})
+
+    def _build_buffer(self, uid, snapshot):
+        """
+        由摘要文件建立環形緩衝區。
+
+        Returns:
+            tuple: (環形緩衝區, 摘要是否需要修剪)
+        """
+        data = snapshot.to_dict() if snapshot.exists else {}
+        # 尚未搬移的文件可能同時有舊陣列與搬移前就寫入新結構的 recent
+        recent = _merge_messages(data.get("recent", []), _legacy_messages(data))
+        buffer = _RecentBuffer(recent, self.recent_size, len(data.get("recent", [])))
+        self._buffers.set(uid, buffer)
+        needs_trim = buffer.summary_length > self.recent_size * 2
+        if needs_trim:
+            buffer.summary_length = self.recent_size
+        return buffer, needs_trim
+
+    async def recent_async(self, uid, n=5):
+        """
+        取得使用者最近 n 則訊息（依時間由舊到新），優先使用行程內環形緩衝區。
+
+        Args:
+            uid (str): 使用者 UID。
+            n (int): 訊息數量，不可超過 recent_size。
+
+        Returns:
+            list: 訊息列表。
+        """
+        buffer = self._buffers.get(uid)
+        if buffer is None:
+            buffer, needs_trim = self._build_buffer(uid, await self.async_summary_ref(uid).get())
+            if needs_trim:
+                # 修剪很少發生，沿用同步交易並交給執行緒池
+                asyncio.get_running_loop().run_in_executor(None, self.trim, uid)
+        with buffer.lock:
+            return list(buffer.messages)[-n:]
+
+    def add_to_batch(self, batch, uid, messages):
+        """
+        將同一使用者的訊息寫入加入 Firestore 批次（每則一份訊息文件 + 一次摘要追加），不需事先讀取。
+
+        訊息文件以 create 寫入固定的文件 ID：同一則訊息重複提交時整個批次以 AlreadyExists 失敗，
+        不會產生第二份訊息，message_count 也不會重複累加。
+
+        Args:
+            batch (firestore.WriteBatch): Firestore 批次。
+            uid (str): 使用者 UID。
+            messages (list): (文件 ID, 訊息) 列表；文件 ID 通常為 message_id(訊息)。
+
+        Returns:
+            int: 加入批次的寫入操作數量。
+        """
+        return self._add_writes(batch, self.summary_ref(uid), messages)
+
+    @staticmethod
+    def _add_writes(batch, summary_ref, messages):
+        messages_ref = summary_ref.collection('messages')
+        cleaned = []
+        for doc_id, message in messages:
+            message = _clean_message(message)
+            batch.create(messages_ref.document(doc_id), message)
+            cleaned.append(message)
+        batch.set(summary_ref, {
+            "recent": firestore.ArrayUnion(cleaned),
+            "message_count": firestore.Increment(len(cleaned)),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+        return len(cleaned) + 1
+
+    def remember(self, uid, message):
+        """
+        將訊息加入行程內環形緩衝區（若已載入），讓尚未提交的訊息也能作為上下文。
+        """
+        buffer = self._buffers.get(uid)
+        if buffer is None:
+            return
+        with buffer.lock:
+            buffer.messages.append(_clean_message(message))
+
+    def _count_commit(self, uid, count):
+        """更新摘要長度的估計值；回傳摘要是否需要修剪。"""
+        buffer = self._buffers.get(uid)
+        if buffer is None:
+            return False
+        with buffer.lock:
+            buffer.summary_length += count
+            needs_trim = buffer.summary_length > self.recent_size * 2
+            if needs_trim:
+                buffer.summary_length = self.recent_size
+        return needs_trim
+
+    def after_commit(self, uid, count=1):
+        """
+        批次提交後更新摘要長度的估計值，並在摘要過長時修剪。
+        """
+        if self._count_commit(uid, count):
+            self.trim(uid)
+
+    def existing_messages(self, keys):
+        """
+        查詢哪些訊息文件已經存在。
+
+        Args:
+            keys (iterable): (uid, 文件 ID) 列表。
+
+        Returns:
+            set: 已存在的 (uid, 文件 ID)。
+        """
+        refs = [self.messages_ref(uid).document(doc_id) for uid, doc_id in keys]
+        if not refs:
+            return set()
+        return {
+            (snapshot.reference.parent.parent.id, snapshot.id)
+            for snapshot in self.db.get_all(refs)
+            if snapshot.exists
+        }
+
+    async def append_async(self, uid, message):
+        """
+        立即以 AsyncClient 寫入一則訊息（不經過 ChatHistoryWriter）；訊息已存在時不重複寫入。
+
+        Args:
+            uid (str): 使用者 UID。
+            message (dict): 包含 message、is_bot、timestamp 的訊息。
+        """
+        batch = self.async_db.batch()
+        self._add_writes(batch, self.async_summary_ref(uid), [(message_id(message), message)])
+        try:
+            await batch.commit()
+        except AlreadyExists:
+            return
+        if self._count_commit(uid, 1):
+            # 修剪很少發生，沿用同步交易並交給執行緒池
+            asyncio.get_running_loop().run_in_executor(None, self.trim, uid)
+
+    def trim(self, uid):
+        """
+        以交易將摘要的 recent 修剪為最近 recent_size 則訊息。
+        """
+        summary_ref = self.summary_ref(uid)
+        recent_size = self.recent_size
+
+        @firestore.transactional
+        def _trim(transaction):
+            snapshot = summary_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return
+            recent = snapshot.to_dict().get("recent", [])
+            if len(recent) <= recent_size:
+                return
+            recent = sorted(recent, key=lambda m: _as_utc(m["timestamp"]))[-recent_size:]
+            transaction.update(summary_ref, {"recent": recent})
+
+        try:
+            _trim(self.db.transaction())
+        except Exception as e:
+            logger.warning(f"修剪聊天摘要失敗（{uid}）：{e}")
+
+    async def page_async(self, uid, limit=50, before=None):
+        """
+        分頁讀取聊天記錄，由新到舊翻頁，每頁內依時間由舊到新排列。
+
+        Args:
+            uid (str): 使用者 UID。
+            limit (int): 每頁訊息數量。
+            before (str): 上一頁回傳的游標（"{ISO 時間}|{文件 ID}"），只回傳排在其之前的訊息；
+                也接受只有 ISO 時間的舊版游標。
+
+        Returns:
+            tuple: (訊息列表, 下一頁游標或 None)。
+
+        Raises:
+            ValueError: 游標格式錯誤。
+        """
+        position = parse_cursor(before) if before else None
+        docs, legacy = await asyncio.gather(
+            self._page_docs(self._page_query(self.async_messages_ref(uid), limit, position)),
+            self._legacy_messages_async(uid)
+        )
+        return self._page_result(docs, legacy, limit, position)
+
+    @staticmethod
+    async def _page_docs(query):
+        return [doc async for doc in query.stream()]
+
+    @staticmethod
+    def _page_query(messages_ref, limit, position):
+        # 以（timestamp, 文件 ID）排序，同一時間的多則訊息也不會在翻頁時遺漏或重複
+        query = messages_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).order_by(
+            firestore.FieldPath.document_id(), direction=firestore.Query.DESCENDING
+        )
+        if position is not None:
+            query = _start_after(query, messages_ref, position, descending=True)
+        return query.limit(limit)
+
+    @staticmethod
+    def _page_result(docs, legacy, limit, position):
+        entries = [_entry(doc.id, doc.to_dict()) for doc in reversed(docs)]
+        has_more = len(docs) == limit
+        if legacy:
+            # 合併游標之前的舊版訊息，只保留最新的 limit 則
+            entries = _merge_entries(entries, _legacy_entries(legacy, before=position))
+            if len(entries) > limit:
+                has_more = True
+                entries = entries[-limit:]
+        next_cursor = None
+        if has_more and entries:
+            next_cursor = format_cursor(entries[0][0])
+        return [message for _, message in entries], next_cursor
+
+    async def iter_messages_async(self, uid, page_size=500, since=None, until=None, after=None):
+        """
+        依時間由舊到新逐頁讀取使用者的訊息（尚未搬移時讀取舊陣列），可限制時間範圍。
+
+        Args:
+            uid (str): 使用者 UID。
+            page_size (int): 每次查詢的訊息數量。
+            since (datetime): 只回傳此時間（含）之後的訊息。
+            until (datetime): 只回傳此時間之前的訊息。
+            after (tuple): 只回傳排在此位置（parse_cursor 的結果）之後的訊息，用於從游標續傳。
+
+        Yields:
+            tuple: (位置, 訊息)；位置可由 format_cursor 轉為游標。
+        """
+        messages_ref = self.async_messages_ref(uid)
+        query = messages_ref
+        if since is not None:
+            query = query.where("timestamp", ">=", _as_utc(since))
+        if until is not None:
+            query = query.where("timestamp", "<", _as_utc(until))
+        query = query.order_by("timestamp").order_by(firestore.FieldPath.document_id())
+        if after is not None:
+            query = _start_after(query, messages_ref, after)
+
+        # 尚未搬移的舊版訊息依（時間, message_id）穿插在子集合的訊息之間；
+        # 已搬移的訊息文件 ID 即為 message_id，位置相同時只輸出子集合的那一份
+        legacy = deque(
+            (position, message) for position, message in _legacy_entries(
+                await self._legacy_messages_async(uid), after=after
+            )
+            if (since is None or position[0] >= _as_utc(since))
+            and (until is None or position[0] < _as_utc(until))
+        )
+
+        last = None
+        while True:
+            page_query = query.start_after(last) if last is not None else query
+            docs = [doc async for doc in page_query.limit(page_size).stream()]
+            for doc in docs:
+                position, message = _entry(doc.id, doc.to_dict())
+                while legacy and legacy[0][0] <= position:
+                    if legacy[0][0] < position:
+                        yield legacy[0]
+                    legacy.popleft()
+                yield position, message
+            if len(docs) < page_size:
+                break
+            last = docs[-1]
+        for entry in legacy:
+            yield entry
+
+    async def iter_user_ids_async(self, start_at=None, page_size=100):
+        """
+        依 UID 排序逐頁列出有聊天記錄的使用者。
+
+        Args:
+            start_at (str): 從此 UID（含）開始。
+            page_size (int): 每次查詢的使用者數量。
+        """
+        query = self.async_collection.order_by(firestore.FieldPath.document_id())
+        if start_at is not None:
+            query = query.where(firestore.FieldPath.document_id(), ">=", self.async_summary_ref(start_at))
+        last = None
+        while True:
+            page_query = query.start_after(last) if last is not None else query
+            # 只需要文件 ID，不讀取摘要內容
+            docs = [doc async for doc in page_query.select([]).limit(page_size).stream()]
+            for doc in docs:
+                yield doc.id
+            if len(docs) < page_size:
+                return
+            last = docs[-1]
+
+    async def delete_async(self, uid, page_size=400):
+        """
+        刪除使用者所有聊天記錄（訊息子集合與摘要文件）。
+        """
+        messages_ref = self.async_messages_ref(uid)
+        while True:
+            docs = [doc async for doc in messages_ref.limit(page_size).stream()]
+            if not docs:
+                break
+            batch = self.async_db.batch()
+            for doc in docs:
+                batch.delete(doc.reference)
+            await batch.commit()
+        await self.async_summary_ref(uid).delete()
+        self._buffers.pop(uid)
+
+
+_STOP = object()
+
+
+class ChatHistoryWriter:
+    """
+    聊天訊息的延後寫入佇列。
+
+    呼叫端只需把訊息放入佇列即可返回；背景執行緒在累積到批次上限或等待 flush_interval 後，
+    將所有待寫入的訊息（可跨使用者）合併為一次 Firestore 批次提交。
+    另外依使用者記錄尚未寫入的訊息數，刪除聊天記錄前只需等待該使用者的訊息。
+
+    Args:
+        store (ChatHistoryStore): 聊天記錄儲存層。
+        flush_interval (float): 第一則訊息進入後最多等待的秒數。
+        max_queue (int): 佇列上限，滿時 enqueue 放棄新訊息並記錄錯誤（不阻塞事件迴圈）。
+        max_retries (int): 批次提交失敗時的重試次數。
+    """
+
+    def __init__(self, store, flush_interval=0.2, max_queue=10000, max_retries=3):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._closed = False
+        # uid -> 已放入但尚未寫入（或放棄）的訊息數
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._direct_writes = set()
+        self.flush_latency = LatencyStats()
+        self.enqueued = 0
+        self.committed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.batches = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="chat-history-writer", daemon=True)
+            self._thread.start()
+
+    def _track(self, uid, delta):
+        with self._pending_lock:
+            count = self._pending.get(uid, 0) + delta
+            if count > 0:
+                self._pending[uid] = count
+            else:
+                self._pending.pop(uid, None)
+
+    def enqueue(self, uid, message):
+        """
+        將訊息放入寫入佇列，不會阻塞事件迴圈（須在事件迴圈上呼叫）。
+        寫入器未啟動或已關閉時改以 AsyncClient 直接寫入；佇列已滿時放棄此訊息並記錄錯誤。
+
+        Returns:
+            bool: 訊息是否已排入寫入。
+        """
+        self._track(uid, 1)
+        # 文件 ID 在放入佇列時就固定，批次提交重試時沿用，不會寫入第二份
+        doc_id = message_id(message)
+        if self._thread is None or self._closed:
+            self.store.remember(uid, message)
+            task = asyncio.get_running_loop().create_task(self._write_direct(uid, message))
+            self._direct_writes.add(task)
+            task.add_done_callback(self._direct_writes.discard)
+            return True
+        try:
+            self._queue.put_nowait((uid, doc_id, message))
+        except queue.Full:
+            self._track(uid, -1)
+            self.dropped += 1
+            logger.error(f"聊天記錄寫入佇列已滿，放棄一則訊息（{uid}）")
+            return False
+        self.store.remember(uid, message)
+        self.enqueued += 1
+        return True
+
+    async def _write_direct(self, uid, message):
+        try:
+            await self.store.append_async(uid, message)
+            self.committed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"聊天記錄寫入失敗（{uid}）：{e}")
+        finally:
+            self._track(uid, -1)
+
+    async def wait_idle_async(self, uid, timeout=5):
+        """
+        等待此使用者已放入的訊息全部處理完畢（例如刪除聊天記錄前），逾時返回 False。
+        """
+        deadline = time.monotonic() + timeout
+        while uid in self._pending:
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.01)
+        return True
+
+    def close(self, timeout=10):
+        """
+        停止背景執行緒，並在返回前寫入佇列中剩餘的所有訊息。
+        """
+        if self._thread is None or self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f"聊天記錄寫入器未能在 {timeout} 秒內完成，尚有 {self._queue.qsize()} 則訊息未寫入")
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                break
+            pending = [item]
+            ops = 2
+            deadline = time.monotonic() + self.flush_interval
+            # 每則訊息一個寫入操作，每位使用者再加一次摘要更新
+            while ops + 2 <= BATCH_OPS_LIMIT:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.task_done()
+                    stopping = True
+                    break
+                pending.append(item)
+                ops += 2
+            self._commit(pending)
+
+        # 關閉時寫入剩餘的訊息
+        pending = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                pending.append(item)
+            else:
+                self._queue.task_done()
+        for start in range(0, len(pending), BATCH_OPS_LIMIT // 2):
+            self._commit(pending[start:start + BATCH_OPS_LIMIT // 2])
+
+    def _commit(self, pending):
+        try:
+            self._commit_batch(pending)
+        finally:
+            for uid, _, _ in pending:
+                self._track(uid, -1)
+                self._queue.task_done()
+
+    def _commit_batch(self, pending):
+        # uid -> {文件 ID: 訊息}；同一則訊息在批次中只寫一次
+        by_user = {}
+        for uid, doc_id, message in pending:
+            by_user.setdefault(uid, {})[doc_id] = message
+        counts = {uid: len(messages) for uid, messages in by_user.items()}
+
+        start = time.perf_counter()
+        check_existing = False
+        attempt = 0
+        while True:
+            try:
+                if check_existing:
+                    # 上一次提交逾時但其實已寫入，或訊息先前已保存過：略過已存在的訊息，
+                    # 只提交剩下的部分，message_count 不會重複累加
+                    existing = self.store.existing_messages(
+                        (uid, doc_id) for uid, messages in by_user.items() for doc_id in messages
+                    )
+                    by_user = {
+                        uid: {doc_id: m for doc_id, m in messages.items() if (uid, doc_id) not in existing}
+                        for uid, messages in by_user.items()
+                    }
+                    check_existing = False
+                batch = self.store.db.batch()
+                for uid, messages in by_user.items():
+                    if messages:
+                        self.store.add_to_batch(batch, uid, list(messages.items()))
+                if any(by_user.values()):
+                    batch.commit()
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"聊天記錄批次寫入失敗，放棄 {len(pending)} 則訊息：{e}")
+                    self.failed += len(pending)
+                    return
+                if isinstance(e, AlreadyExists):
+                    check_existing = True
+                else:
+                    logger.warning(f"聊天記錄批次寫入失敗，稍後重試：{e}")
+                    time.sleep(0.2 * 2 ** attempt)
+                attempt += 1
+        self.flush_latency.observe(time.perf_counter() - start)
+        self.batches += 1
+        self.committed += len(pending)
+
+        for uid, count in counts.items():
+            self.store.after_commit(uid, count)
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "committed": self.committed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "pending_users": len(self._pending),
+            "batches": self.batches,
+            "avg_batch_size": self.committed / self.batches if self.batches else 0.0,
+            "flush_latency": self.flush_latency.stats(),
+        }
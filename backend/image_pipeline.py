@@ -0,0 +1,184 @@
+"""
+圖片上傳處理管線。
+
+上傳的圖片在獨立的工作行程中解碼（避免大型照片的解碼與縮放佔用事件迴圈與 GIL），
+依長邊尺寸產生 thumb / medium / original 三種版本，每種各輸出 WebP 與 JPEG（後備格式）。
+每次上傳的版本放在同一個前綴下，檔名固定且內容不會再變，因此可以設定長效的 Cache-Control。
+"""
+import io
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from metrics import LatencyStats
+
+logger = logging.getLogger('uvicorn.error')
+
+# 版本名稱 -> 長邊最大像素；小於此尺寸的圖片不會放大
+VARIANT_SIZES = {
+    "thumb": 320,
+    "medium": 1024,
+    "original": 2560,
+}
+
+# 輸出格式 -> (Pillow 格式名稱, Content-Type, 副檔名)
+FORMATS = {
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+}
+
+# 版本檔名固定且不會被覆寫，瀏覽器與 CDN 可以永久快取
+VARIANT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class InvalidImageError(ValueError):
+    """無法解碼的圖片。"""
+
+
+class ImageTooLargeError(InvalidImageError):
+    """圖片像素數超過上限。"""
+
+
+def render_variants(data, sizes=None, quality=80, max_pixels=40_000_000):
+    """
+    解碼圖片並產生各尺寸、各格式的版本（在工作行程中執行）。
+
+    Args:
+        data (bytes): 原始圖片內容。
+        sizes (dict): 版本名稱 -> 長邊最大像素，預設為 VARIANT_SIZES。
+        quality (int): WebP / JPEG 的壓縮品質。
+        max_pixels (int): 允許解碼的最大像素數，防止解壓縮炸彈。
+
+    Returns:
+        dict: 版本名稱 -> {格式: (內容 bytes, 寬, 高)}。
+
+    Raises:
+        ImageTooLargeError: 圖片像素數超過 max_pixels。
+        InvalidImageError: 無法辨識或已損毀的圖片。
+    """
+    sizes = sizes or VARIANT_SIZES
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            width, height = source.size
+            if width * height > max_pixels:
+                raise ImageTooLargeError(f"圖片尺寸過大：{width}x{height}")
+            # 依 EXIF 方向轉正手機照片；動畫圖片只取第一格
+            image = ImageOps.exif_transpose(source)
+            image.load()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise InvalidImageError(f"無法解碼圖片：{e}")
+
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    image = image.convert("RGBA" if has_alpha else "RGB")
+
+    variants = {}
+    # 由大到小縮放，每次從上一個版本縮小，減少重複計算
+    current = image
+    for name, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+        if max(current.size) > size:
+            current = current.copy()
+            current.thumbnail((size, size), Image.LANCZOS)
+        outputs = {}
+        for fmt, (pil_format, _, _) in FORMATS.items():
+            frame = current
+            if pil_format == "JPEG" and frame.mode == "RGBA":
+                # JPEG 不支援透明度，合成到白色背景
+                background = Image.new("RGB", frame.size, (255, 255, 255))
+                background.paste(frame, mask=frame.split()[-1])
+                frame = background
+            buffer = io.BytesIO()
+            options = {"quality": quality}
+            if pil_format == "WEBP":
+                options["method"] = 4
+            else:
+                options.update(optimize=True, progressive=True)
+            frame.save(buffer, pil_format, **options)
+            outputs[fmt] = (buffer.getvalue(), frame.size[0], frame.size[1])
+        variants[name] = outputs
+    return variants
+
+
+class ImagePipeline:
+    """
+    以行程池處理圖片的非同步介面。
+
+    Args:
+        workers (int): 工作行程數量。
+        quality (int): 輸出品質。
+        max_pixels (int): 允許解碼的最大像素數。
+    """
+
+    def __init__(self, workers=2, quality=80, max_pixels=40_000_000):
+        self.workers = workers
+        self.quality = quality
+        self.max_pixels = max_pixels
+        self._executor = None
+        self.processed = 0
+        self.failures = 0
+        self.restarts = 0
+        self.latency = LatencyStats()
+
+    def start(self):
+        if self._executor is None:
+            # 使用 spawn：主行程已有 gRPC 與快照監聽器執行緒，fork 後的子行程可能卡死
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _restart(self, broken):
+        """工作行程異常結束（例如 OOM）後整個行程池都無法再使用，關閉並重新建立。"""
+        if self._executor is broken:
+            broken.shutdown(wait=False)
+            self._executor = None
+            self.restarts += 1
+            logger.warning("圖片處理工作行程異常結束，重新建立行程池")
+        self.start()
+
+    async def render(self, data):
+        """
+        在工作行程中產生圖片的各個版本；行程池損壞時重建並重試一次。
+
+        Returns:
+            dict: 同 render_variants。
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for attempt in range(2):
+            executor = self._executor
+            try:
+                variants = await loop.run_in_executor(
+                    executor, render_variants, data, VARIANT_SIZES, self.quality, self.max_pixels
+                )
+                break
+            except BrokenProcessPool:
+                self._restart(executor)
+                if attempt == 1:
+                    self.failures += 1
+                    raise
+            except Exception:
+                self.failures += 1
+                raise
+        self.processed += 1
+        self.latency.observe(loop.time() - started)
+        return variants
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "running": self._executor is not None,
+            "processed": self.processed,
+            "failures": self.failures,
+            "restarts": self.restarts,
+            "latency": self.latency.stats(),
+        }
@@ -0,0 +1,244 @@
+"""
+行程內背景工作佇列，以 Firestore outbox 持久化。
+
+- 工作先寫入 jobs 集合（可與觸發它的資料變更放在同一個批次提交），再交給事件迴圈上的工作協程執行；
+  成功後刪除 outbox 文件，失敗則以指數退避重試，超過次數標記為 failed 保留原因。
+- 執行前以交易認領工作：status 由 pending 改為 running，並記錄 owner 與租約到期時間 lease_expires。
+  其他行程只會認領 pending 或租約已過期的工作，同一個工作不會被兩個 worker 同時執行。
+- 啟動時只重新載入租約已過期的工作（pending 的工作建立時租約即已到期），
+  行程重啟或當機前未完成的清理工作不會遺失，也不會搶走其他存活 worker 正在執行或重試的工作。
+- 工作處理函式必須是冪等的：持有者當機、或成功後刪除 outbox 失敗時，工作會在租約到期後再執行一次；
+  處理函式會收到工作 ID，可用來辨識重複執行。
+"""
+import os
+import uuid
+import socket
+import asyncio
+import datetime
+import logging
+
+from firebase_admin import firestore, firestore_async
+
+from metrics import LatencyStats
+
+logger = logging.getLogger('uvicorn.error')
+
+
+class JobQueue:
+    """
+    以 outbox 文件保存、在事件迴圈上執行的背景工作佇列。
+
+    Args:
+        db (firestore.AsyncClient): Firestore 非同步客戶端。
+        collection (str): outbox 集合名稱。
+        concurrency (int): 同時執行的工作數量。
+        max_retries (int): 失敗後最多重試次數。
+        retry_delay (float): 第一次重試前等待的秒數，之後每次加倍。
+        max_retry_delay (float): 重試等待秒數上限。
+        lease (float): 認領工作後的租約秒數，須長於單次處理所需時間。
+    """
+
+    def __init__(self, db, collection='jobs', concurrency=4, max_retries=5, retry_delay=1.0,
+                 max_retry_delay=60.0, lease=300.0):
+        self.db = db
+        self.collection = db.collection(collection)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease = lease
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.handlers = {}
+        self._queue = None
+        self._workers = []
+        self._scheduled = set()
+        self.enqueued = 0
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+        self.skipped = 0
+        self.latency = LatencyStats()
+
+    def register(self, kind, handler):
+        """註冊工作處理函式：async handler(payload, job_id)。"""
+        self.handlers[kind] = handler
+
+    def add_to_batch(self, batch, kind, payload):
+        """
+        將工作寫入 outbox 的操作加入批次；批次提交後再呼叫 submit。
+
+        Returns:
+            dict: 工作內容，供 submit 使用。
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"未註冊的工作類型：{kind}")
+        ref = self.collection.document()
+        batch.set(ref, {
+            "kind": kind,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "created_at": firestore.SERVER_TIMESTAMP,
+            # 尚未認領的工作視為租約已到期，任何 worker 都可以認領
+            "lease_expires": firestore.SERVER_TIMESTAMP,
+        })
+        return {"id": ref.id, "kind": kind, "payload": payload, "attempts": 0}
+
+    def submit(self, job):
+        """將已寫入 outbox 的工作排入佇列；佇列尚未啟動時留待 start() 重新載入。"""
+        if self._queue is None or job["id"] in self._scheduled:
+            return
+        self._scheduled.add(job["id"])
+        self._queue.put_nowait(job)
+        self.enqueued += 1
+
+    async def start(self):
+        """啟動工作協程並重新載入未完成的工作。"""
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        try:
+            await self.recover()
+        except Exception as e:
+            logger.error(f"重新載入背景工作時出錯：{e}")
+
+    async def recover(self):
+        """重新載入租約已過期的工作（未認領，或持有者已停止）；failed 的工作沒有租約，不會載入。"""
+        recovered = 0
+        now = datetime.datetime.now(datetime.timezone.utc)
+        async for doc in self.collection.where("lease_expires", "<", now).stream():
+            data = doc.to_dict()
+            if data.get("status") not in ("pending", "running"):
+                continue
+            self.submit({
+                "id": doc.id,
+                "kind": data.get("kind"),
+                "payload": data.get("payload") or {},
+                "attempts": data.get("attempts", 0),
+            })
+            recovered += 1
+        if recovered:
+            logger.info(f"重新載入 {recovered} 個未完成的背景工作")
+
+    async def stop(self, timeout=10):
+        """等待佇列中的工作完成（最多 timeout 秒）後停止；未完成的工作保留在 outbox。"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"仍有 {self._queue.qsize()} 個背景工作未完成，下次啟動時重新執行")
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+        self._queue = None
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            except Exception as e:
+                # 工作仍留在 outbox，租約到期後由 recover 重新載入
+                self._scheduled.discard(job["id"])
+                logger.error(f"背景工作 {job['id']} 更新狀態時出錯：{e}")
+            finally:
+                self._queue.task_done()
+
+    def _lease_until(self, seconds):
+        return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=seconds)
+
+    async def _claim(self, ref):
+        """
+        以交易認領工作：只有 pending、租約已過期，或已由本行程持有的工作可以認領。
+
+        Returns:
+            dict: 認領成功時為工作文件內容；否則為 None。
+        """
+        owner = self.owner
+        lease_until = self._lease_until(self.lease)
+
+        @firestore_async.async_transactional
+        async def _claim_in_transaction(transaction):
+            snapshot = await ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return None
+            data = snapshot.to_dict()
+            status = data.get("status")
+            lease_expires = data.get("lease_expires")
+            expired = lease_expires is not None and lease_expires <= datetime.datetime.now(datetime.timezone.utc)
+            if not (status == "pending" or (status == "running" and (data.get("owner") == owner or expired))):
+                return None
+            transaction.update(ref, {"status": "running", "owner": owner, "lease_expires": lease_until})
+            return data
+
+        return await _claim_in_transaction(self.db.transaction())
+
+    async def _run(self, job):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        ref = self.collection.document(job["id"])
+        if await self._claim(ref) is None:
+            # 已完成、已失敗，或由其他 worker 持有
+            self.skipped += 1
+            self._scheduled.discard(job["id"])
+            return
+        handler = self.handlers.get(job["kind"])
+        try:
+            if handler is None:
+                raise ValueError(f"未註冊的工作類型：{job['kind']}")
+            await handler(job["payload"], job["id"])
+        except Exception as e:
+            job["attempts"] += 1
+            if handler is None or job["attempts"] > self.max_retries:
+                self.failed += 1
+                self._scheduled.discard(job["id"])
+                logger.error(f"背景工作 {job['kind']}（{job['id']}）失敗，不再重試：{e}")
+                await ref.update({
+                    "status": "failed",
+                    "attempts": job["attempts"],
+                    "error": str(e),
+                    "lease_expires": firestore.DELETE_FIELD,
+                })
+                return
+            self.retried += 1
+            delay = min(self.retry_delay * 2 ** (job["attempts"] - 1), self.max_retry_delay)
+            logger.warning(f"背景工作 {job['kind']}（{job['id']}）失敗，{delay:.0f} 秒後重試：{e}")
+            # 重試期間仍由本行程持有，租約延長到重試之後
+            await ref.update({
+                "attempts": job["attempts"],
+                "error": str(e),
+                "lease_expires": self._lease_until(delay + self.lease),
+            })
+            loop.call_later(delay, self._retry, job)
+            return
+        self.succeeded += 1
+        self._scheduled.discard(job["id"])
+        self.latency.observe(loop.time() - started)
+        for attempt in range(3):
+            try:
+                await ref.delete()
+                return
+            except Exception as e:
+                if attempt == 2:
+                    # 租約到期後會再執行一次，由處理函式的冪等性保證結果不變
+                    logger.warning(f"刪除已完成的背景工作 {job['id']} 失敗：{e}")
+                    return
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+    def _retry(self, job):
+        if self._queue is not None:
+            self._queue.put_nowait(job)
+
+    def stats(self):
+        return {
+            "running": self._queue is not None,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "enqueued": self.enqueued,
+            "succeeded": self.succeeded,
+            "retried": self.retried,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "latency": self.latency.stats(),
+        }
@@ -1,31 +1,63 @@
-from fastapi import FastAPI, HTTPException, Depends, status, File, UploadFile, Request
+from fastapi import FastAPI, HTTPException, Depends, status, File, UploadFile, Request, Response, BackgroundTasks
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 import firebase_admin
-from firebase_admin import credentials, auth, firestore, storage
+from firebase_admin import credentials, auth, firestore, firestore_async, storage
 from fastapi.middleware.cors import CORSMiddleware
-import bcrypt
 import datetime
 import os
 from dotenv import load_dotenv
 from google.cloud import bigquery, translate_v2 as translate
 from ai_module import (
     load_query_embedding_async,
-    retrieve_similar_documents_async,
+    retrieve_for_query_async,
+    retrieve_bilingual_async,
+    RAG_COMBINED_QUERY,
     translate_text_async,
-    is_sex_related,
+    is_sex_related_async,
     generate_response_stream,
-    generate_direct_response_stream
+    generate_direct_response_stream,
+    embedding_cache,
+    embedding_batchers,
+    translation_cache,
+    translation_batcher,
+    topic_classifier,
+    stream_stats,
+    answer_cache,
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_CHUNK_SIZE,
+    outbound,
+    upstream_policy,
+    start_outbound_clients,
+    close_outbound_clients
 )
+from answer_cache import replay_answer_stream, collect_answer_stream, context_fingerprint
+from metrics import StageTimings
+from chat_history_store import ChatHistoryStore, ChatHistoryWriter, format_cursor, parse_cursor
+from cache import LRUCache
+from article_cache import ArticleCache
+from token_verifier import CertificateStore, CachedTokenVerifier
+from user_profile_cache import UserProfileCache
+from upstreams import HTTPUpstream, CircuitOpenError
+from image_pipeline import ImagePipeline, InvalidImageError, FORMATS, VARIANT_CACHE_CONTROL
+from job_queue import JobQueue
+from password_hasher import PasswordHasher, HasherBusyError
 import logging
 import asyncio
-from typing import Tuple, Optional, Union
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Optional, Union, List
 from google.api_core.exceptions import NotFound  # 若有需要，可引入對應的例外
 import urllib.parse
 from urllib.parse import urlparse
 from sse_starlette.sse import EventSourceResponse   # 引入 SSE 回應類別
 import json
-import aiohttp
+import hashlib
+import secrets
+import re
+import httpx
 
 app = FastAPI()
 logger = logging.getLogger('uvicorn.error')
@@ -65,13 +97,489 @@ firebase_admin.initialize_app(cred, {
     'storageBucket': 'eros-web-94e22.firebasestorage.app'
 })
 
-# 初始化 Firestore 客戶端
+# 初始化 Firestore 客戶端：端點使用非同步客戶端，快照監聽器與背景批次寫入使用同步客戶端
 db = firestore.client()
-users_collection = db.collection('users')
+db_async = firestore_async.client()
 articles_collection = db.collection('articles')
 
+# 使用者資料快取：權限檢查與 role / avatar 查詢共用；本行程的寫入即時套用，其他來源的修改在 TTL 後生效
+USER_PROFILE_CACHE_SIZE = int(os.getenv("USER_PROFILE_CACHE_SIZE", "10000"))
+USER_PROFILE_CACHE_TTL = float(os.getenv("USER_PROFILE_CACHE_TTL", "300"))
+user_profiles = UserProfileCache(
+    db_async.collection('users'),
+    maxsize=USER_PROFILE_CACHE_SIZE,
+    ttl=USER_PROFILE_CACHE_TTL
+)
+
+# 聊天記錄儲存層：訊息子集合 + 最近訊息摘要 + 行程內環形緩衝區
+CHAT_RECENT_SIZE = int(os.getenv("CHAT_RECENT_SIZE", "20"))
+chat_history_store = ChatHistoryStore(db, db_async, recent_size=CHAT_RECENT_SIZE)
+# 延後寫入：/chat/history 只需放入佇列，背景執行緒合併為批次提交
+CHAT_WRITE_FLUSH_INTERVAL_MS = int(os.getenv("CHAT_WRITE_FLUSH_INTERVAL_MS", "200"))
+CHAT_WRITE_MAX_QUEUE = int(os.getenv("CHAT_WRITE_MAX_QUEUE", "10000"))
+chat_history_writer = ChatHistoryWriter(
+    chat_history_store,
+    flush_interval=CHAT_WRITE_FLUSH_INTERVAL_MS / 1000,
+    max_queue=CHAT_WRITE_MAX_QUEUE
+)
+
+# 最近保存過的訊息（uid, is_bot, 內容雜湊）-> 來源；
+# 舊版前端仍會自行 POST 查詢與回答，與 /chat 串流保存的同一則訊息配對後只寫入一次
+recently_saved_messages = LRUCache(maxsize=10000, ttl=600)
+
+def save_chat_message(uid, text, is_bot, source, timestamp=None):
+    """
+    將一則聊天訊息放入寫入佇列。
+
+    Args:
+        uid (str): 使用者 UID。
+        text (str): 訊息內容。
+        is_bot (bool): 是否為 AI 回答。
+        source (str): "stream"（/chat 串流保存）或 "post"（前端上傳）。
+        timestamp (datetime): 訊息時間，預設為現在。
+
+    Returns:
+        bool: 是否實際寫入；若同一則訊息剛由另一個來源保存過則回傳 False。
+    """
+    key = (uid, is_bot, hashlib.sha1(text.encode("utf-8")).hexdigest())
+    previous_source = recently_saved_messages.pop(key)
+    if previous_source is not None and previous_source != source:
+        return False
+    recently_saved_messages.set(key, source)
+    chat_history_writer.enqueue(uid, {
+        'message': text,
+        'is_bot': is_bot,
+        'timestamp': timestamp or datetime.datetime.now(datetime.timezone.utc),
+    })
+    return True
+
+@app.on_event("startup")
+def start_chat_history_writer():
+    chat_history_writer.start()
+
+# 文章快取：以快照監聽器保持最新，/articles 直接由記憶體回應
+ARTICLE_CACHE_ENABLED = os.getenv("ARTICLE_CACHE_ENABLED", "true").lower() == "true"
+article_cache = ArticleCache(articles_collection)
+
+@app.on_event("startup")
+def start_article_cache():
+    if ARTICLE_CACHE_ENABLED:
+        article_cache.start()
+
+@app.on_event("shutdown")
+def stop_article_cache():
+    article_cache.stop()
+
+@app.on_event("shutdown")
+def flush_chat_history_writer():
+    # gunicorn 回收 worker 時會觸發 shutdown，確保佇列中的訊息都已寫入
+    chat_history_writer.close()
+
 bucket = storage.bucket()
 
+# ==================== 非同步資料存取層 ====================
+# 端點一律透過下列 repository 存取資料：Firestore 使用 AsyncClient；
+# 沒有非同步 API 的 Storage 與 Firebase Auth 呼叫交給專用的執行緒池，不佔用 Starlette 的執行緒池。
+BLOCKING_IO_THREADS = int(os.getenv("BLOCKING_IO_THREADS", "16"))
+blocking_io_executor = ThreadPoolExecutor(max_workers=BLOCKING_IO_THREADS, thread_name_prefix="blocking-io")
+
+async def run_blocking(fn, *args, **kwargs):
+    """在 blocking_io_executor 中執行同步呼叫。"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_io_executor, functools.partial(fn, *args, **kwargs))
+
+
+class UserRepository:
+    """users 集合；個人資料經由 user_profiles 快取讀取。"""
+
+    def __init__(self, db, profiles):
+        self.client = db
+        self.collection = db.collection('users')
+        self.profiles = profiles
+
+    async def get_profile(self, uid):
+        return await self.profiles.get_async(uid)
+
+    async def get_account(self, username):
+        """讀取包含密碼雜湊的完整文件（僅供登入 / 註冊使用，不經過快取）。"""
+        snapshot = await self.collection.document(username).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    async def create(self, uid, data):
+        await self.collection.document(uid).set(data)
+        self.profiles.put(uid, data)
+
+    async def update(self, uid, fields):
+        await self.collection.document(uid).update(fields)
+        self.profiles.update(uid, fields)
+
+    async def get_profiles(self, uids):
+        """以一次 get_all 取得多位使用者的資料（快取命中的不再讀取）。"""
+        return await self.profiles.get_many_async(uids, self.client)
+
+    async def create_many(self, uids, data, batch_size=500):
+        """以批次寫入為多位使用者建立相同內容的文件。"""
+        for start in range(0, len(uids), batch_size):
+            batch = self.client.batch()
+            for uid in uids[start:start + batch_size]:
+                batch.set(self.collection.document(uid), data)
+            await batch.commit()
+        for uid in uids:
+            self.profiles.put(uid, data)
+
+
+class ArticleRepository:
+    """articles 集合；讀取優先使用 article_cache，寫入同步更新快取。"""
+
+    def __init__(self, db, cache, jobs):
+        self.client = db
+        self.collection = db.collection('articles')
+        self.cache = cache
+        self.jobs = jobs
+
+    async def get(self, article_id):
+        data = self.cache.get(article_id)
+        if data is None:
+            snapshot = await self.collection.document(article_id).get()
+            data = snapshot.to_dict() if snapshot.exists else None
+        return data
+
+    async def create(self, data):
+        _, doc_ref = await self.collection.add(data)
+        # 監聽器稍後會以伺服器時間覆寫 published_at
+        self.cache.put(doc_ref.id, dict(data, published_at=datetime.datetime.now(datetime.timezone.utc)))
+        return doc_ref.id
+
+    async def update(self, article_id, fields):
+        await self.collection.document(article_id).update(fields)
+        self.cache.merge(article_id, fields)
+
+    async def delete(self, article_id, jobs=()):
+        """
+        刪除文章；jobs 中的 (類型, 內容) 會與刪除一起提交到 outbox，之後由背景工作佇列執行。
+        """
+        batch = self.client.batch()
+        batch.delete(self.collection.document(article_id))
+        queued = [self.jobs.add_to_batch(batch, kind, payload) for kind, payload in jobs]
+        await batch.commit()
+        self.cache.remove(article_id)
+        for job in queued:
+            self.jobs.submit(job)
+
+    async def list(self, user_id=None, tag=None, category=None, limit=None, cursor=None, fields=None):
+        """
+        列出文章；快取就緒時由記憶體回應，否則直接查詢 Firestore。
+        游標無效時拋出 KeyError。
+
+        Returns:
+            tuple: (文章列表, 下一頁游標或 None)。
+        """
+        if self.cache.ready:
+            return self.cache.list(
+                user_id=user_id, tag=tag, category=category, limit=limit, cursor=cursor, fields=fields
+            )
+
+        query = self.collection
+        if user_id:
+            query = query.where('user_id', '==', user_id)
+        if tag:
+            query = query.where('tags', 'array_contains', tag)
+        if category:
+            query = query.where('category', '==', category)
+        if fields:
+            # 在 Firestore 端投影，未選取的欄位不會被傳輸
+            query = query.select(fields)
+
+        next_cursor = None
+        if limit is not None:
+            query = query.order_by('published_at', direction=firestore.Query.DESCENDING)
+            if cursor:
+                cursor_doc = await self.collection.document(cursor).get()
+                if not cursor_doc.exists:
+                    raise KeyError(cursor)
+                query = query.start_after(cursor_doc)
+            docs = [doc async for doc in query.limit(limit).stream()]
+            if len(docs) == limit:
+                next_cursor = docs[-1].id
+        else:
+            docs = [doc async for doc in query.stream()]
+
+        articles = []
+        for doc in docs:
+            article = doc.to_dict()
+            article['id'] = doc.id
+            articles.append(article)
+        return articles, next_cursor
+
+
+class ImageStorage:
+    """
+    Firebase Storage 的非同步包裝；上傳與刪除在 blocking_io_executor 中執行。
+
+    圖片以 images/{uid}/{內容 SHA-256}/{generation}-{版本}.{副檔名} 存放，同一位使用者重複上傳相同內容時直接沿用既有版本。
+    image_refs/{uid}_{digest} 記錄引用次數與目前的 generation：查詢與加減引用都在交易中進行。
+    引用歸零時先將記錄標記為 deleted（tombstone）並提交，之後才刪除該 generation 的檔案；
+    刪除進行中再次上傳相同內容會產生新的 generation，不會與正在刪除的檔案衝突。
+    """
+
+    # 上傳管線產生的版本：images/{uid}/{image_id}/[{generation}-]{variant}.{ext}；
+    # image_id 為 64 字元的內容雜湊，或是舊版的 32 字元隨機 ID；舊版檔名沒有 generation
+    VARIANT_BLOB = re.compile(r"^(images/([^/]+)/([0-9a-f]{32}|[0-9a-f]{64})/)(?:([0-9a-f]{12})-)?[^/]+$")
+    # 每份引用記錄保留的已處理釋放 ID 數量
+    RELEASE_HISTORY = 50
+
+    def __init__(self, bucket, db, chunk_size=None):
+        self.bucket = bucket
+        self.client = db
+        self.refs = db.collection('image_refs')
+        self.chunk_size = chunk_size
+        self.url_prefix = f"https://storage.googleapis.com/{bucket.name}/"
+
+    def blob_name(self, image_url):
+        """由公開 URL 取得 blob 名稱；非本 bucket 的 URL 回傳 None。"""
+        if not image_url.startswith(self.url_prefix):
+            return None
+        return urllib.parse.unquote(image_url[len(self.url_prefix):])
+
+    @staticmethod
+    def new_generation():
+        """每次實際上傳使用的檔名前綴。"""
+        return secrets.token_hex(6)
+
+    @staticmethod
+    def content_directory(uid, digest):
+        return f"images/{uid}/{digest}/"
+
+    @classmethod
+    def content_prefix(cls, uid, digest, generation):
+        return f"{cls.content_directory(uid, digest)}{generation}-"
+
+    def _ref(self, uid, digest):
+        return self.refs.document(f"{uid}_{digest}")
+
+    async def acquire(self, uid, digest):
+        """
+        若使用者已上傳過相同內容且尚未刪除，在交易中增加引用次數並回傳既有版本的 URL；否則回傳 None。
+        """
+        ref = self._ref(uid, digest)
+
+        @firestore_async.async_transactional
+        async def _acquire(transaction):
+            snapshot = await ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return None
+            data = snapshot.to_dict()
+            if data.get("status", "active") != "active" or not data.get("variants"):
+                return None
+            transaction.update(ref, {"refs": (data.get("refs") or 0) + 1})
+            return data["variants"]
+
+        return await _acquire(self.client.transaction())
+
+    async def register(self, uid, digest, generation, urls):
+        """
+        記錄新上傳的圖片。並行上傳相同內容時，先提交的版本勝出：
+        後到者只增加引用次數並回傳既有版本的 URL，自己上傳的 generation 則刪除。
+
+        Returns:
+            dict: 實際生效的版本 URL。
+        """
+        ref = self._ref(uid, digest)
+
+        @firestore_async.async_transactional
+        async def _register(transaction):
+            snapshot = await ref.get(transaction=transaction)
+            data = snapshot.to_dict() if snapshot.exists else {}
+            if data.get("status", "active") == "active" and data.get("variants"):
+                transaction.update(ref, {"refs": (data.get("refs") or 0) + 1})
+                return data["variants"]
+            transaction.set(ref, {
+                "uid": uid,
+                "digest": digest,
+                "generation": generation,
+                "variants": urls,
+                "status": "active",
+                "refs": 1,
+                "released_by": data.get("released_by") or [],
+                "created_at": firestore_async.SERVER_TIMESTAMP,
+            })
+            return urls
+
+        effective = await _register(self.client.transaction())
+        if effective is not urls:
+            try:
+                await self._delete_generation(self.content_directory(uid, digest), generation)
+            except NotFound:
+                pass
+            except Exception as e:
+                logger.warning(f"刪除重複上傳的圖片版本時出錯：{e}")
+        return effective
+
+    async def _release(self, uid, digest, generation, release_id=None):
+        """
+        引用次數減一；回傳是否已無引用、可以刪除該 generation 的檔案。
+        歸零時在同一個交易中寫入 tombstone（status 為 deleted），之後的 acquire 不會再沿用這些檔案。
+
+        release_id 為背景工作 ID：同一個工作重複執行時（例如刪除 outbox 失敗後重新載入），
+        只會減一次引用，不會誤刪其他文章仍在使用的圖片。
+        """
+        ref = self._ref(uid, digest)
+
+        @firestore_async.async_transactional
+        async def _decrement(transaction):
+            snapshot = await ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return True
+            data = snapshot.to_dict()
+            if data.get("generation") != generation or data.get("status", "active") != "active":
+                # 這個 generation 已經釋放完畢（之後可能又重新上傳了相同內容）
+                return True
+            released_by = data.get("released_by") or []
+            if release_id is not None and release_id in released_by:
+                return False
+            refs = (data.get("refs") or 0) - 1
+            update = {"refs": max(refs, 0)}
+            if release_id is not None:
+                update["released_by"] = (released_by + [release_id])[-self.RELEASE_HISTORY:]
+            if refs <= 0:
+                update["status"] = "deleted"
+                update["deleted_at"] = firestore_async.SERVER_TIMESTAMP
+            transaction.update(ref, update)
+            return refs <= 0
+
+        return await _decrement(self.client.transaction())
+
+    def _upload_variant(self, blob_name, data, content_type):
+        blob = self.bucket.blob(blob_name)
+        # 超過單次上傳上限的檔案改以 chunk_size 分段的可續傳上傳
+        blob.chunk_size = self.chunk_size
+        blob.cache_control = VARIANT_CACHE_CONTROL
+        blob.upload_from_string(data, content_type=content_type, predefined_acl="publicRead")
+        return blob.public_url
+
+    async def upload_variants(self, prefix, variants):
+        """
+        並行上傳 ImagePipeline 產生的所有版本。
+
+        Returns:
+            dict: 版本名稱 -> {格式: 公開 URL}。
+        """
+        uploads = []
+        for name, outputs in variants.items():
+            for fmt, (data, _, _) in outputs.items():
+                _, content_type, extension = FORMATS[fmt]
+                blob_name = f"{prefix}{name}.{extension}"
+                uploads.append((name, fmt, run_blocking(self._upload_variant, blob_name, data, content_type)))
+        urls = await asyncio.gather(*(upload for _, _, upload in uploads))
+        result = {}
+        for (name, fmt, _), url in zip(uploads, urls):
+            result.setdefault(name, {})[fmt] = url
+        return result
+
+    async def _delete_generation(self, directory, generation):
+        """刪除 directory 下屬於同一個 generation 的所有版本（generation 為 None 時為舊版檔名）。"""
+        def _delete_variants():
+            blobs = []
+            for blob in self.bucket.list_blobs(prefix=directory):
+                match = self.VARIANT_BLOB.match(blob.name)
+                if match is not None and match.group(4) == generation:
+                    blobs.append(blob)
+            if not blobs:
+                raise NotFound(f"No such object: {directory}{generation or ''}")
+            self.bucket.delete_blobs(blobs)
+        await run_blocking(_delete_variants)
+
+    async def delete(self, blob_name, release_id=None):
+        """
+        刪除圖片；上傳管線產生的版本會連同同一次上傳的其他版本一起刪除。
+        release_id 用於讓重複執行的背景工作只釋放一次引用（見 _release）。
+
+        Returns:
+            bool: 是否實際刪除了檔案；內容雜湊的圖片仍有其他引用時回傳 False。
+        """
+        match = self.VARIANT_BLOB.match(blob_name)
+        if match is None:
+            await run_blocking(self.bucket.blob(blob_name).delete)
+            return True
+        uid, image_id, generation = match.group(2), match.group(3), match.group(4)
+        if len(image_id) == 64 and not await self._release(uid, image_id, generation, release_id):
+            return False
+        await self._delete_generation(match.group(1), generation)
+        return True
+
+
+# 背景工作佇列：文章刪除後的圖片清理等工作先寫入 jobs 集合（outbox），再於背景重試執行
+JOB_QUEUE_CONCURRENCY = int(os.getenv("JOB_QUEUE_CONCURRENCY", "4"))
+JOB_QUEUE_MAX_RETRIES = int(os.getenv("JOB_QUEUE_MAX_RETRIES", "5"))
+job_queue = JobQueue(
+    db_async,
+    concurrency=JOB_QUEUE_CONCURRENCY,
+    max_retries=JOB_QUEUE_MAX_RETRIES
+)
+
+user_repository = UserRepository(db_async, user_profiles)
+article_repository = ArticleRepository(db_async, article_cache, job_queue)
+# Storage 可續傳上傳的分段大小，須為 256 KB 的倍數
+IMAGE_UPLOAD_CHUNK_SIZE = int(os.getenv("IMAGE_UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+image_storage = ImageStorage(bucket, db_async, chunk_size=IMAGE_UPLOAD_CHUNK_SIZE)
+
+# 圖片解碼與縮放交給工作行程
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", "2"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_MAX_UPLOAD_MB = int(os.getenv("IMAGE_MAX_UPLOAD_MB", "20"))
+image_pipeline = ImagePipeline(workers=IMAGE_PROCESS_WORKERS, quality=IMAGE_QUALITY)
+
+@app.on_event("startup")
+def start_image_pipeline():
+    image_pipeline.start()
+
+@app.on_event("shutdown")
+def stop_image_pipeline():
+    image_pipeline.stop()
+
+# 密碼雜湊交給工作行程；排隊請求超過上限時直接回應 503
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_BCRYPT_ROUNDS = int(os.getenv("PASSWORD_BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32"))
+password_hasher = PasswordHasher(
+    workers=PASSWORD_HASH_WORKERS,
+    rounds=PASSWORD_BCRYPT_ROUNDS,
+    max_pending=PASSWORD_HASH_MAX_PENDING
+)
+
+@app.on_event("startup")
+def start_password_hasher():
+    password_hasher.start()
+
+@app.on_event("shutdown")
+def stop_password_hasher():
+    password_hasher.stop()
+
+async def cleanup_image(payload, job_id):
+    """背景工作：刪除（或釋放引用）文章的圖片；圖片已不存在視為完成。"""
+    blob_name = image_storage.blob_name(payload["image_url"])
+    if blob_name is None:
+        return
+    try:
+        await image_storage.delete(blob_name, release_id=job_id)
+    except NotFound:
+        logger.warning(f"圖片不存在，無需刪除: {payload['image_url']}")
+
+job_queue.register("delete_image", cleanup_image)
+
+@app.on_event("startup")
+async def start_job_queue():
+    await job_queue.start()
+
+@app.on_event("shutdown")
+async def stop_job_queue():
+    # 須在 blocking_io_executor 關閉前停止，讓進行中的 Storage 刪除能完成
+    await job_queue.stop()
+
+@app.on_event("shutdown")
+def stop_blocking_io_executor():
+    blocking_io_executor.shutdown(wait=False)
+
 # 載入環境變數
 try:
     load_dotenv()
@@ -80,15 +588,39 @@ except Exception as e:
     
 MODEL = "openai/chatgpt-4o-latest"  # 這裡可以根據需求切換模型
 
+# RAG 各階段耗時統計（階段名稱 -> LatencyStats）
+rag_stage_latency = {}
+
 # 定義驗證依賴項
 security = HTTPBearer()
 
+# ID token 驗證：快取已驗證的 token，簽章憑證由背景執行緒更新
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CHECK_REVOKED = os.getenv("TOKEN_CHECK_REVOKED", "false").lower() == "true"
+TOKEN_REVOCATION_TTL = float(os.getenv("TOKEN_REVOCATION_TTL", "300"))
+id_token_certs = CertificateStore()
+token_verifier = CachedTokenVerifier(
+    cred_dict['project_id'],
+    id_token_certs,
+    check_revoked=TOKEN_CHECK_REVOKED,
+    revocation_ttl=TOKEN_REVOCATION_TTL,
+    cache_size=TOKEN_CACHE_SIZE
+)
+
+@app.on_event("startup")
+def start_id_token_certs():
+    id_token_certs.start()
+
+@app.on_event("shutdown")
+def stop_id_token_certs():
+    id_token_certs.stop()
+
 # 函式區
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
     try:
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = await token_verifier.verify_async(token, blocking_io_executor)
         logger.info(f"驗證成功，使用者 UID: {decoded_token['uid']}")
         return decoded_token
     except auth.InvalidIdTokenError as e:
@@ -115,22 +647,44 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
         
 
 # 新增 Turnstile 驗證函數
+# siteverify 的 token 只能使用一次，因此只在連線階段失敗時重試
+TURNSTILE_TIMEOUT = float(os.getenv("TURNSTILE_TIMEOUT", "5"))
+turnstile_upstream = outbound.register(HTTPUpstream(
+    "turnstile",
+    base_url="https://challenges.cloudflare.com",
+    connect_timeout=3.0,
+    read_timeout=TURNSTILE_TIMEOUT,
+    **upstream_policy()
+))
+
+@app.on_event("startup")
+def start_upstreams():
+    start_outbound_clients()
+
+@app.on_event("shutdown")
+async def close_upstreams():
+    await close_outbound_clients()
+
 async def verify_turnstile_token(token: str) -> bool:
     """驗證 Turnstile token"""
     secret_key = os.getenv('CLOUDFLARE_SECRET_KEY')
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            'https://challenges.cloudflare.com/turnstile/v0/siteverify',
+    try:
+        response = await turnstile_upstream.request(
+            "POST",
+            "/turnstile/v0/siteverify",
             data={
                 'secret': secret_key,
                 'response': token
             }
-        ) as response:
-            result = await response.json()
-            return result.get('success', False)
+        )
+        result = response.json()
+    except (CircuitOpenError, httpx.HTTPError) as e:
+        logger.error(f"Turnstile 驗證服務無法使用：{e}")
+        raise HTTPException(status_code=503, detail="人機驗證服務暫時無法使用，請稍後再試")
+    return result.get('success', False)
 
 
-def verify_owner_or_admin(resource_owner: str, current_user: dict, operation: str = "操作此資源"):
+async def verify_owner_or_admin(resource_owner: str, current_user: dict, operation: str = "操作此資源"):
     """
     檢查資源是否屬於 current_user，
     若不是則確認 current_user 是否具有 admin 權限，
@@ -142,15 +696,14 @@ def verify_owner_or_admin(resource_owner: str, current_user: dict, operation: st
       operation: 動作描述，用於錯誤訊息 (預設為 "操作此資源")。
     """
     if resource_owner != current_user["uid"]:
-        user_doc = users_collection.document(current_user["uid"]).get()
-        if not user_doc.exists:
+        user_data = await user_repository.get_profile(current_user["uid"])
+        if user_data is None:
             raise HTTPException(status_code=404, detail="找不到使用者資料")
-        user_data = user_doc.to_dict()
         if user_data.get("role", "") != "admin":
             raise HTTPException(status_code=403, detail=f"您沒有權限{operation}")
 
 
-def verify_image_permission(image_url: str, current_user: dict):
+async def verify_image_permission(image_url: str, current_user: dict):
     """
     檢查圖片是否屬於 current_user，
     若否則確認 current_user 是否具有 admin 權限，
@@ -159,10 +712,9 @@ def verify_image_permission(image_url: str, current_user: dict):
     這裡透過檢查 image_url 中是否包含 current_user 的 uid 來判斷資源是否為本人所有。
     """
     if current_user["uid"] not in image_url:
-        user_doc = users_collection.document(current_user["uid"]).get()
-        if not user_doc.exists:
+        user_data = await user_repository.get_profile(current_user["uid"])
+        if user_data is None:
             raise HTTPException(status_code=404, detail="找不到使用者資料")
-        user_data = user_doc.to_dict()
         if user_data.get("role", "") != "admin":
             logger.warning(f"使用者 {current_user['uid']} 嘗試刪除非本人圖片: {image_url}")
             raise HTTPException(status_code=403, detail="您無權刪除此圖片")
@@ -183,17 +735,25 @@ async def login(request: LoginRequest):
     password = request.password
 
     # 從 Firestore 中查詢使用者
-    user_doc = users_collection.document(username).get()
+    user_data = await user_repository.get_account(username)
     
-    if user_doc.exists:
-        user_data = user_doc.to_dict()
-        stored_password_hash = user_data.get('password').encode('utf-8')
-        
-        # 驗證密碼
-        if bcrypt.checkpw(password.encode('utf-8'), stored_password_hash):
+    if user_data is not None:
+        # 驗證密碼（在工作行程中執行，不阻塞事件迴圈）
+        try:
+            valid, new_hash = await password_hasher.verify(password, user_data.get('password'))
+        except HasherBusyError:
+            raise HTTPException(status_code=503, detail="登入請求過多，請稍後再試", headers={"Retry-After": "1"})
+
+        if valid:
+            if new_hash is not None:
+                # bcrypt cost 已調整，寫回新的雜湊；失敗不影響本次登入
+                try:
+                    await user_repository.update(username, {'password': new_hash})
+                except Exception as e:
+                    logger.warning(f"更新使用者 {username} 的密碼雜湊時出錯：{e}")
             try:
-                # 生成自訂的 Firebase 令牌
-                custom_token = auth.create_custom_token(username)
+                # 生成自訂的 Firebase 令牌（RSA 簽章交給執行緒池）
+                custom_token = await run_blocking(auth.create_custom_token, username)
                 return {"token": custom_token.decode('utf-8')}
             except Exception as e:
                 raise HTTPException(status_code=500, detail=f"生成令牌時出錯: {str(e)}")
@@ -217,42 +777,82 @@ async def signup(request: SignupRequest):
     password = request.password
 
     # 檢查使用者是否已存在
-    user_doc = users_collection.document(username).get()
-    if user_doc.exists:
+    if await user_repository.get_account(username) is not None:
         raise HTTPException(status_code=400, detail="使用者名稱已存在")
 
-    # 生成密碼哈希
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    # 生成密碼哈希（在工作行程中執行）
+    try:
+        hashed_password = await password_hasher.hash(password)
+    except HasherBusyError:
+        raise HTTPException(status_code=503, detail="註冊請求過多，請稍後再試", headers={"Retry-After": "1"})
 
     # 在 Firestore 中創建新使用者
-    users_collection.document(username).set({
+    await user_repository.create(username, {
         'username': username,
-        'password': hashed_password.decode('utf-8')  # 儲存為字串
+        'password': hashed_password  # 儲存為字串
     })
 
     try:
         # 生成自訂的 Firebase 令牌
-        custom_token = auth.create_custom_token(username)
+        custom_token = await run_blocking(auth.create_custom_token, username)
         return {"token": custom_token.decode('utf-8')}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"生成令牌時出錯:{e}")
 
+# 文章可投影的欄位；列表頁可用 fields= 省略 content
+ARTICLE_FIELDS = ("title", "content", "tags", "image_url", "user_id", "category", "published_at")
+ARTICLES_MAX_PAGE_SIZE = 100
+
 @app.get("/articles")
-def get_articles(user_id: Optional[str] = None):
+async def get_articles(
+    request: Request,
+    user_id: Optional[str] = None,
+    tag: Optional[str] = None,
+    category: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    """
+    取得文章列表。
+
+    - user_id / tag / category：篩選條件。
+    - limit：每頁文章數（上限 100），依 published_at 由新到舊排序；未指定時回傳全部文章。
+    - cursor：上一頁回傳的 next_cursor。
+    - fields：以逗號分隔要回傳的欄位，例如 fields=title,tags,published_at。
+    回應帶有 ETag，客戶端以 If-None-Match 重新請求且內容未變時回傳 304。
+    """
+    selected = None
+    if fields:
+        selected = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = set(selected) - set(ARTICLE_FIELDS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"不支援的欄位：{', '.join(sorted(unknown))}")
+
+    if limit is not None or cursor:
+        limit = max(1, min(limit or ARTICLES_MAX_PAGE_SIZE, ARTICLES_MAX_PAGE_SIZE))
+
     try:
-        if user_id:
-            query = articles_collection.where('user_id', '==', user_id)
-        else:
-            query = articles_collection.stream()
-        articles = []
-        for doc in query:
-            article = doc.to_dict()
-            article['id'] = doc.id
-            articles.append(article)
-        return {"articles": articles}
+        try:
+            articles, next_cursor = await article_repository.list(
+                user_id=user_id, tag=tag, category=category, limit=limit, cursor=cursor, fields=selected
+            )
+        except KeyError:
+            raise HTTPException(status_code=400, detail="無效的分頁游標")
+        payload = jsonable_encoder({"articles": articles, "next_cursor": next_cursor})
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"獲取文章時出錯: {e}")
 
+    body = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    etag = '"' + hashlib.sha1(body.encode("utf-8")).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")] or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 
 class ChatRequest(BaseModel):
     query: str
@@ -270,11 +870,13 @@ async def chat(
     web_search: bool = False,
     rag: bool = False,
     token: str = None,  # 從 query parameters 獲取 token
+    persist: bool = True,  # 由伺服器保存查詢與回答；自行 POST /chat/history 的舊版前端可傳 false
 ):
     """
     修改後的聊天端點，使用 SSE 流式回傳生成的回應內容。
     當啟用 RAG 時，後端會依序回傳當前處理狀態，包括：
     「判斷語句...」、「翻譯查詢...」、「查詢資料庫...」等進度訊息。
+    串流結束（或用戶中斷）時，伺服器會直接保存查詢與（部分）回答，前端不必再上傳。
     """
     # 驗證 token
     if not token:
@@ -284,7 +886,7 @@ async def chat(
         )
     
     try:
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = await token_verifier.verify_async(token, blocking_io_executor)
         logger.info(f"驗證成功，使用者 UID: {decoded_token['uid']}")
     except Exception as e:
         logger.error(f"驗證令牌失敗: {e}")
@@ -298,22 +900,33 @@ async def chat(
         logger.error(f"Token uid 與 user_id 不符: {decoded_token['uid']} != {user_id}")
         raise HTTPException(status_code=403, detail="Token uid 與 user_id 不符")
     
-    # 根據 user_id 從 Firestore 取得該使用者最新的 5 筆聊天記錄作為上下文
+    # 根據 user_id 取得該使用者最新的 5 筆聊天記錄作為上下文（優先使用行程內緩衝區）
     try:
-        chat_history_doc = db.collection('chat_histories').document(user_id).get()
-        if chat_history_doc.exists:
-            data = chat_history_doc.to_dict()
-            messages = data.get("messages", [])
-            messages_sorted = sorted(messages, key=lambda m: m["timestamp"]) if messages else []
-            user_context = messages_sorted[-5:]
-        else:
-            user_context = []
+        user_context = await chat_history_store.recent_async(user_id, 5)
     except Exception as e:
         logger.error(f"取得聊天記錄失敗: {e}")
         user_context = []
+
+    if persist:
+        save_chat_message(decoded_token["uid"], query, is_bot=False, source="stream")
     
+    # 語意回答快取：網路搜尋的結果具時效性，一律不使用快取；
+    # 回答會參考最近的對話，只與上下文相同的請求共用
+    query_embedding = None
+    cached_answer = None
+    context_key = context_fingerprint(user_context)
+    if ANSWER_CACHE_ENABLED and not web_search:
+        try:
+            query_embedding = await load_query_embedding_async(query)
+            cached_answer = answer_cache.lookup(query_embedding, model, rag, context_key)
+        except Exception as e:
+            logger.error(f"查詢回答快取失敗: {e}")
+
     # 根據參數選擇不同的 SSE 回傳邏輯
-    if web_search:
+    if cached_answer is not None:
+        logger.info("命中語意回答快取，重播先前的回答。")
+        stream_generator = replay_answer_stream(cached_answer, chunk_size=ANSWER_CACHE_CHUNK_SIZE)
+    elif web_search:
         logger.info("啟用網路搜尋功能，不受 RAG 參數影響。")
         async def web_search_event_generator():
             yield "data: 正在進行網路搜尋\n\n"
@@ -322,59 +935,105 @@ async def chat(
         stream_generator = web_search_event_generator()
     elif rag:
         async def rag_event_generator():
+            timings = StageTimings(rag_stage_latency)
             # 回傳判斷語句狀態
             yield "data: 正在判斷語句\n\n"
-            sex_related = is_sex_related(query, model)
-            if sex_related:
-                yield "data: 正在翻譯查詢\n\n"
-                # 執行查詢翻譯
-                translated_query = await translate_text_async(query)
-                yield f"data: 查詢翻譯完成：{translated_query}\n\n"
-                yield "data: 正在生成查詢嵌入\n\n"
-                # 同時產生中文與英文查詢嵌入（非同步）
-                query_embedding_cn_task = asyncio.create_task(load_query_embedding_async(query))
-                query_embedding_en_task = asyncio.create_task(load_query_embedding_async(translated_query))
-                query_embedding_cn, query_embedding_en = await asyncio.gather(query_embedding_cn_task, query_embedding_en_task)
-                
-                # 設定 RAG 檢索參數
-                dataset_id = "Eros_AI_RAG"
-                table_id = "combined_embeddings"
-                project_id = "eros-ai-446307"
-                
-                yield "data: 正在查詢資料庫\n\n"
-                similar_docs_cn_task = retrieve_similar_documents_async(
-                    query_embedding_cn, dataset_id, table_id, project_id, top_n=2
-                )
-                similar_docs_en_task = retrieve_similar_documents_async(
-                    query_embedding_en, dataset_id, table_id, project_id, top_n=3
+            # 判斷語句的同時，推測性地開始翻譯與中文嵌入/檢索；若判斷為非性相關則取消
+            classify_task = asyncio.create_task(timings.track("classify", is_sex_related_async(query, model)))
+            translate_task = asyncio.create_task(timings.track("translate", translate_text_async(query)))
+            if RAG_COMBINED_QUERY:
+                # 合併查詢模式：推測階段只產生中文嵌入，翻譯完成後以單一查詢同時檢索中英文
+                similar_docs_cn_task = asyncio.create_task(
+                    timings.track("embed_cn", load_query_embedding_async(query))
                 )
-                similar_docs_cn, similar_docs_en = await asyncio.gather(similar_docs_cn_task, similar_docs_en_task)
-                yield "data: 資料庫查詢完成，開始生成回答\n\n"
-                # 將資料庫結果交由 generate_response_stream 產生最終回答
-                async for event in generate_response_stream(
-                    similar_docs_cn,
-                    similar_docs_en,
-                    query,
-                    user_context,
-                    model,
-                    web_search=False
-                ):
-                    yield event
             else:
-                yield "data: 問題非性相關，直接生成回答\n\n"
-                async for event in generate_direct_response_stream(query, user_context, model):
+                similar_docs_cn_task = asyncio.create_task(
+                    timings.track("retrieve_cn", retrieve_for_query_async(query, top_n=2))
+                )
+            similar_docs_en_task = None
+            response_stream = None
+            try:
+                sex_related = await classify_task
+                if sex_related:
+                    yield "data: 正在翻譯查詢\n\n"
+                    translated_query = await translate_task
+                    yield f"data: 查詢翻譯完成：{translated_query}\n\n"
+                    yield "data: 正在生成查詢嵌入\n\n"
+                    if RAG_COMBINED_QUERY:
+                        query_embedding_en = await timings.track(
+                            "embed_en", load_query_embedding_async(translated_query)
+                        )
+                        query_embedding_cn = await similar_docs_cn_task
+                        yield "data: 正在查詢資料庫\n\n"
+                        similar_docs_cn, similar_docs_en = await timings.track(
+                            "retrieve", retrieve_bilingual_async(query_embedding_cn, query_embedding_en, 2, 3)
+                        )
+                    else:
+                        similar_docs_en_task = asyncio.create_task(
+                            timings.track("retrieve_en", retrieve_for_query_async(translated_query, top_n=3))
+                        )
+                        yield "data: 正在查詢資料庫\n\n"
+                        similar_docs_cn, similar_docs_en = await asyncio.gather(similar_docs_cn_task, similar_docs_en_task)
+                    yield "data: 資料庫查詢完成，開始生成回答\n\n"
+                    # 將資料庫結果交由 generate_response_stream 產生最終回答
+                    response_stream = generate_response_stream(
+                        similar_docs_cn,
+                        similar_docs_en,
+                        query,
+                        user_context,
+                        model,
+                        web_search=False
+                    )
+                else:
+                    translate_task.cancel()
+                    similar_docs_cn_task.cancel()
+                    yield "data: 問題非性相關，直接生成回答\n\n"
+                    response_stream = generate_direct_response_stream(query, user_context, model)
+                first_token = True
+                async for event in response_stream:
+                    if first_token:
+                        timings.mark("first_token")
+                        first_token = False
                     yield event
-                    
+            finally:
+                # 用戶中斷或發生錯誤時，取消仍在進行的推測階段
+                for task in (classify_task, translate_task, similar_docs_cn_task, similar_docs_en_task):
+                    if task is None:
+                        continue
+                    if not task.done():
+                        task.cancel()
+                    elif not task.cancelled():
+                        task.exception()  # 標記例外已取回，避免被取消流程的錯誤產生未處理警告
+                if response_stream is not None:
+                    await response_stream.aclose()
+                logger.info(f"RAG 階段耗時：{timings.summary()}")
+
         stream_generator = rag_event_generator()
     else:
         logger.info("未啟用 RAG，直接生成回答。")
         stream_generator = generate_direct_response_stream(query, user_context, model)
 
+    if query_embedding is not None and cached_answer is None:
+        # 完整生成的回答寫入快取，中途中斷或上游失敗的回答不保存
+        stream_generator = collect_answer_stream(
+            stream_generator,
+            lambda answer: answer_cache.store(query_embedding, model, rag, answer, context_key)
+        )
+
+    if persist:
+        # 完整回答在送出 end 事件前保存；用戶中斷時保存已產生的部分回答
+        save_answer = lambda answer: save_chat_message(decoded_token["uid"], answer, is_bot=True, source="stream")
+        stream_generator = collect_answer_stream(stream_generator, save_answer, on_abort=save_answer)
+
     async def event_generator():
-        async for event in stream_generator:
-            if await request.is_disconnected():
-                break
-            yield event
+        try:
+            async for event in stream_generator:
+                if await request.is_disconnected():
+                    break
+                yield event
+        finally:
+            # 用戶中斷時關閉整條產生器鏈，連帶停止上游 OpenRouter 串流
+            await stream_generator.aclose()
 
     return EventSourceResponse(
         event_generator(),
@@ -394,43 +1053,36 @@ class ChatMessage(BaseModel):
     timestamp: datetime.datetime
 
 @app.post("/chat/history")
-def save_chat_history(message: ChatMessage, user: dict = Depends(verify_token)):
+async def save_chat_history(message: ChatMessage, user: dict = Depends(verify_token)):
     try:
         logger.info(f"保存聊天記錄，使用者 UID: {user['uid']}")
 
         # 確保 timestamp 是 datetime 對象
         if isinstance(message.timestamp, str):
             message.timestamp = datetime.datetime.fromisoformat(message.timestamp)
-        
-        # 將訊息轉換為資料字典
-        message_data = {
-            'message': message.message,
-            'is_bot': message.is_bot,
-            'timestamp': message.timestamp
-        }
 
-        # 儲存到 Firestore，使用 merge=True 以合併資料
-        chat_history_ref = db.collection('chat_histories').document(user['uid'])
-        chat_history_ref.set({
-            'messages': firestore.ArrayUnion([message_data])
-        }, merge=True)
-        
-        logger.info(f"成功保存訊息！")
+
+        # 放入寫入佇列，由背景執行緒批次寫入 Firestore
+        if save_chat_message(user['uid'], message.message, message.is_bot, source="post", timestamp=message.timestamp):
+            logger.info("訊息已加入寫入佇列")
+        else:
+            logger.info("訊息已由 /chat 串流保存，略過重複寫入")
         return {"status": "success"}
     except Exception as e:
         logger.error(f"儲存聊天記錄時出錯：{str(e)}")
         raise HTTPException(status_code=500, detail=f"儲存聊天記錄時出錯：{str(e)}")
 
 @app.get("/chat/history")
-def get_chat_history(user: dict = Depends(verify_token)):
+async def get_chat_history(limit: int = 100, before: Optional[str] = None, user: dict = Depends(verify_token)):
+    """
+    分頁取得聊天記錄，由新到舊翻頁；將回傳的 next_cursor 作為 before 參數取得更早的訊息。
+    """
     try:
-        chat_history_ref = db.collection('chat_histories').document(user['uid'])
-        doc = chat_history_ref.get()
-        
-        if not doc.exists:
-            return {"messages": []}
-            
-        return doc.to_dict()
+        limit = max(1, min(limit, 500))
+        messages, next_cursor = await chat_history_store.page_async(user['uid'], limit=limit, before=before)
+        return {"messages": messages, "next_cursor": next_cursor}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="無效的分頁游標")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"獲取聊天記錄時出錯：{str(e)}")
 
@@ -447,38 +1099,34 @@ class Article(BaseModel):
 
 # 發布新文章的端點
 @app.post("/articles", dependencies=[Depends(verify_token)], status_code=201)
-def create_article(article: Article, user: dict = Depends(verify_token)):
+async def create_article(article: Article, user: dict = Depends(verify_token)):
     try:
         article_dict = article.dict()
         # 強制使用者 ID 為當前驗證成功的使用者（避免讓前端傳入任意值）
         article_dict['user_id'] = user['uid']
         # 將 datetime 轉換為 Firestore 的 SERVER_TIMESTAMP
         article_dict['published_at'] = firestore.SERVER_TIMESTAMP
-        doc_ref = articles_collection.add(article_dict)
-        article_id = doc_ref[1].id
+        article_id = await article_repository.create(article_dict)
         return {"id": article_id, "message": "文章發布成功"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"發布文章時出錯: {e}")
 
 # 編輯現有文章的端點
 @app.put("/articles/{article_id}", dependencies=[Depends(verify_token)])
-def update_article(article_id: str, article: Article, user: dict = Depends(verify_token)):
+async def update_article(article_id: str, article: Article, user: dict = Depends(verify_token)):
     try:
-        # 取得文章資料
-        doc_ref = articles_collection.document(article_id)
-        doc = doc_ref.get()
-        if not doc.exists:
+        # 取得文章資料（優先使用文章快取）
+        article_data = await article_repository.get(article_id)
+        if article_data is None:
             raise HTTPException(status_code=404, detail="找不到該文章")
-        
-        article_data = doc.to_dict()
 
         # 先檢查是否屬於本人，否則檢查是否有 admin 權限
-        verify_owner_or_admin(article_data.get("user_id"), user, operation="修改此文章")
+        await verify_owner_or_admin(article_data.get("user_id"), user, operation="修改此文章")
         
         # 更新文章
         article_dict = article.dict(exclude_unset=True)
         article_dict["published_at"] = datetime.datetime.utcnow()
-        doc_ref.update(article_dict)
+        await article_repository.update(article_id, article_dict)
         return {"message": "文章更新成功"}
     except HTTPException as he:
         raise he
@@ -487,50 +1135,86 @@ def update_article(article_id: str, article: Article, user: dict = Depends(verif
 
 @app.post("/upload_image")
 async def upload_image(image: UploadFile = File(...), user: dict = Depends(verify_token)):
+    """
+    上傳圖片：在工作行程中產生 thumb / medium / original 版本（WebP 與 JPEG），
+    回傳 image_url（medium 的 WebP）與所有版本的 URL。
+    相同內容重複上傳時不再處理與上傳，直接回傳既有版本並增加引用次數。
+    """
     if not image.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="請上傳有效的圖片檔案。")
     
+    # 分段讀取上傳內容並同時計算雜湊，超過上限立即中止
+    max_bytes = IMAGE_MAX_UPLOAD_MB * 1024 * 1024
+    digest = hashlib.sha256()
+    chunks = []
+    size = 0
+    while True:
+        chunk = await image.read(IMAGE_UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(status_code=413, detail=f"圖片不可超過 {IMAGE_MAX_UPLOAD_MB} MB。")
+        digest.update(chunk)
+        chunks.append(chunk)
+    digest = digest.hexdigest()
+    
     try:
-        # 生成唯一的檔案名稱
-        file_extension = os.path.splitext(image.filename)[1]
-        blob = bucket.blob(f"images/{user['uid']}/{datetime.datetime.utcnow().isoformat()}_{image.filename}")
+        urls = await image_storage.acquire(user['uid'], digest)
+        if urls is not None:
+            return {"image_url": urls["medium"]["webp"], "variants": urls}
+    except Exception as e:
+        # 引用記錄讀取失敗時照常上傳；每次上傳使用新的 generation，不會覆寫既有檔案
+        logger.warning(f"查詢圖片引用記錄時出錯：{e}")
 
-        # 上傳圖片到 Firebase Storage
-        blob.upload_from_file(image.file, content_type=image.content_type)
-        # 設定公開讀取權限
-        blob.make_public()
+    try:
+        variants = await image_pipeline.render(b"".join(chunks))
+    except InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=f"無法處理的圖片：{e}")
+    
+    try:
+        # 同一次上傳的所有版本使用同一個 generation 前綴，刪除時一併移除
+        generation = image_storage.new_generation()
+        prefix = image_storage.content_prefix(user['uid'], digest, generation)
+        urls = await image_storage.upload_variants(prefix, variants)
+        urls = await image_storage.register(user['uid'], digest, generation, urls)
 
-        return {"image_url": blob.public_url}
+        return {"image_url": urls["medium"]["webp"], "variants": urls}
     except Exception as e:
         logger.error(f"上傳圖片時出錯: {str(e)}")
         raise HTTPException(status_code=500, detail="上傳圖片時發生錯誤。")
 
 # 刪除文章 API
+def article_cleanup_jobs(doc_data):
+    """文章刪除後需在背景執行的清理工作。"""
+    image_url = doc_data.get("image_url")
+    if not image_url or image_storage.blob_name(image_url) is None:
+        return []
+    # 只清理屬於文章作者的圖片，避免刪除文章時連帶刪除他人的圖片
+    owner = doc_data.get("user_id")
+    if not owner or owner not in image_url:
+        logger.warning(f"文章圖片不屬於作者 {owner}，略過清理: {image_url}")
+        return []
+    return [("delete_image", {"image_url": image_url})]
+
 @app.delete("/articles/{article_id}")
-def delete_article(article_id: str, user: dict = Depends(verify_token)):
+async def delete_article(article_id: str, user: dict = Depends(verify_token)):
     try:
-        doc_ref = articles_collection.document(article_id)
-        # 檢查文章是否存在
-        doc_snapshot = doc_ref.get()
-        if not doc_snapshot.exists:
+        # 檢查文章是否存在（優先使用文章快取）
+        doc_data = await article_repository.get(article_id)
+        if doc_data is None:
             raise HTTPException(status_code=404, detail="找不到該文章")
         
-        doc_data = doc_snapshot.to_dict()
-        
         # 檢查文章是否屬於本人，否則需有 admin 權限才能操作
-        verify_owner_or_admin(doc_data.get("user_id"), user, operation="刪除此文章")
-        
-        # 刪除文章前，若包含圖片則先刪除圖片
-        if "image_url" in doc_data and doc_data["image_url"] is not None:
-            bucket_url_prefix = f"https://storage.googleapis.com/{bucket.name}/"
-            if doc_data["image_url"].startswith(bucket_url_prefix):
-                delete_image(DeleteImageRequest(image_url=doc_data["image_url"]), user)
+        await verify_owner_or_admin(doc_data.get("user_id"), user, operation="刪除此文章")
         
-        # 刪除文章
-        doc_ref.delete()
+        # 刪除文章；圖片清理與刪除一起寫入 outbox，由背景工作佇列執行
+        await article_repository.delete(article_id, article_cleanup_jobs(doc_data))
         logger.info(f"使用者 {user['uid']} 刪除了文章 {article_id}")
         return {"message": "文章刪除成功"}
         
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"刪除文章時出錯: {str(e)}")
         raise HTTPException(status_code=500, detail=f"刪除文章時出錯: {str(e)}")
@@ -542,23 +1226,22 @@ class DeleteImageRequest(BaseModel):
     image_url: str
 
 @app.delete("/delete_image")
-def delete_image(request: DeleteImageRequest, user: dict = Depends(verify_token)):
+async def delete_image(request: DeleteImageRequest, user: dict = Depends(verify_token)):
     image_url = request.image_url
     
     # 檢查圖片權限：若圖片非本人所有，則需 admin 權限
-    verify_image_permission(image_url, user)
+    await verify_image_permission(image_url, user)
     
-    bucket_url_prefix = f"https://storage.googleapis.com/{bucket.name}/"
-    if not image_url.startswith(bucket_url_prefix):
+    # 取得 blob 的相對路徑（已進行 percent decode）
+    blob_name = image_storage.blob_name(image_url)
+    if blob_name is None:
         logger.error(f"圖片 URL 格式錯誤: {image_url}")
         raise HTTPException(status_code=400, detail="圖片 URL 格式錯誤")
     
-    # 取得 blob 的相對路徑，並進行 percent decode
-    blob_name = image_url.replace(bucket_url_prefix, "")
-    blob_name = urllib.parse.unquote(blob_name)
     try:
-        blob = bucket.blob(blob_name)
-        blob.delete()
+        if not await image_storage.delete(blob_name):
+            logger.info(f"使用者 {user['uid']} 釋放了圖片引用，仍有其他引用: {image_url}")
+            return {"message": "圖片仍被其他內容使用，已移除此次引用"}
 
         logger.info(f"使用者 {user['uid']} 成功刪除了圖片: {image_url}")
         return {"message": "圖片刪除成功"}
@@ -575,15 +1258,14 @@ class RoleRequest(BaseModel):
     role: str
 
 @app.get("/user/role")
-def get_user_role(user: dict = Depends(verify_token)):
+async def get_user_role(user: dict = Depends(verify_token)):
     """
     取得當前使用者的角色
     """
     try:
-        # 從 Firestore 取得使用者資料，文件 id 預設為 token 中的 uid
-        user_doc = users_collection.document(user['uid']).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
+        # 取得使用者資料（優先使用快取），文件 id 預設為 token 中的 uid
+        user_data = await user_repository.get_profile(user['uid'])
+        if user_data is not None:
             return {"role": user_data.get("role", "")}
         else:
             raise HTTPException(status_code=404, detail="找不到使用者資料")
@@ -591,13 +1273,13 @@ def get_user_role(user: dict = Depends(verify_token)):
         raise HTTPException(status_code=500, detail=f"取得使用者角色時出錯：{str(e)}")
 
 @app.post("/user/role")
-def set_user_role(request: RoleRequest, user: dict = Depends(verify_token)):
+async def set_user_role(request: RoleRequest, user: dict = Depends(verify_token)):
     """
     更新當前使用者的角色
     """
     try:
         # 更新使用者文件內的 role 欄位
-        users_collection.document(user['uid']).update({"role": request.role})
+        await user_repository.update(user['uid'], {"role": request.role})
         return {"message": "使用者角色更新成功"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新使用者角色時出錯：{str(e)}")
@@ -605,14 +1287,18 @@ def set_user_role(request: RoleRequest, user: dict = Depends(verify_token)):
 
 # 新增刪除聊天紀錄 API
 @app.delete("/chat/history")
-def delete_chat_history(user: dict = Depends(verify_token)):
+async def delete_chat_history(user: dict = Depends(verify_token)):
     """
     刪除當前使用者的聊天紀錄
     """
     try:
-        chat_history_ref = db.collection('chat_histories').document(user['uid'])
-        chat_history_ref.delete()
+        # 先等待此使用者尚未寫入的訊息，避免刪除後又被寫回
+        if not await chat_history_writer.wait_idle_async(user['uid']):
+            raise HTTPException(status_code=503, detail="聊天紀錄仍在寫入中，請稍後再試")
+        await chat_history_store.delete_async(user['uid'])
         return {"message": "聊天紀錄刪除成功"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"刪除聊天紀錄時出錯：{str(e)}")
 
@@ -622,14 +1308,13 @@ class AvatarRequest(BaseModel):
     avatar: str  # 使用上傳圖片 /upload_image 回傳的圖片 URL
 
 @app.get("/user/avatar")
-def get_user_avatar(user: dict = Depends(verify_token)):
+async def get_user_avatar(user: dict = Depends(verify_token)):
     """
     取得當前使用者的頭像 URL
     """
     try:
-        user_doc = users_collection.document(user['uid']).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
+        user_data = await user_repository.get_profile(user['uid'])
+        if user_data is not None:
             return {"avatar": user_data.get("avatar", None)}
         else:
             raise HTTPException(status_code=404, detail="找不到使用者資料")
@@ -637,19 +1322,19 @@ def get_user_avatar(user: dict = Depends(verify_token)):
         raise HTTPException(status_code=500, detail=f"取得頭像時出錯：{str(e)}")
 
 @app.post("/user/avatar")
-def set_user_avatar(request: AvatarRequest, user: dict = Depends(verify_token)):
+async def set_user_avatar(request: AvatarRequest, user: dict = Depends(verify_token)):
     """
     更新當前使用者的頭像 URL
     注意：上傳圖片請使用已實作的 /upload_image，獲取圖片公開 URL 後，再透過此 API 更新頭像。
     """
     try:
-        users_collection.document(user['uid']).update({"avatar": request.avatar})
+        await user_repository.update(user['uid'], {"avatar": request.avatar})
         return {"message": "使用者頭像更新成功"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新頭像時出錯：{str(e)}")
 
 @app.post("/user/create")
-def create_user(user: dict = Depends(verify_token)):
+async def create_user(user: dict = Depends(verify_token)):
     """
     創造用戶文件 API
     使用者經過驗證後，會以 user["uid"] 為文件 ID，
@@ -657,10 +1342,9 @@ def create_user(user: dict = Depends(verify_token)):
     """
     try:
         user_uid = user["uid"]
-        user_doc_ref = users_collection.document(user_uid)
         
         # 若該使用者已存在則回傳錯誤訊息
-        if user_doc_ref.get().exists:
+        if await user_repository.get_profile(user_uid) is not None:
             raise HTTPException(status_code=400, detail="用戶已存在")
         
         # 建立用戶文件，填入預設頭像與角色
@@ -668,7 +1352,7 @@ def create_user(user: dict = Depends(verify_token)):
             "avatar": "/images/default-avatar.png",
             "role": "user"
         }
-        user_doc_ref.set(user_data)
+        await user_repository.create(user_uid, user_data)
         logger.info(f"用戶 {user_uid} 創建成功。")
         return {"message": "用戶建立成功", "uid": user_uid}
     except Exception as e:
@@ -678,11 +1362,10 @@ def create_user(user: dict = Depends(verify_token)):
 # Admin 權限檢查輔助函數
 async def check_admin_permission(user: dict) -> bool:
     try:
-        user_doc = users_collection.document(user['uid']).get()
-        if not user_doc.exists:
+        user_data = await user_repository.get_profile(user['uid'])
+        if user_data is None:
             raise HTTPException(status_code=404, detail="找不到使用者資料")
         
-        user_data = user_doc.to_dict()
         if user_data.get('role') != 'admin':
             raise HTTPException(
                 status_code=403,
@@ -696,15 +1379,51 @@ async def check_admin_permission(user: dict) -> bool:
 
 # Admin API：取得所有使用者的聊天記錄
 @app.get("/admin/chat_histories")
-async def get_all_chat_histories(user: dict = Depends(verify_token)):
+async def get_all_chat_histories(
+    user: dict = Depends(verify_token),
+    format: str = "json",
+    user_id: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    cursor: Optional[str] = None,
+):
+    """
+    取得所有使用者的聊天記錄。
+
+    format=ndjson 時以串流方式逐頁匯出，每行一則訊息（記憶體用量固定），並支援：
+    - user_id：只匯出此使用者。
+    - since / until：訊息時間範圍（ISO 8601）。
+    - cursor：每行記錄都帶有 cursor，中斷後以最後收到的 cursor 重新請求即可續傳。
+    """
     await check_admin_permission(user)
+
+    if format == "ndjson":
+        start_uid, after = None, None
+        if cursor:
+            try:
+                start_uid, _, position = cursor.partition("|")
+                after = parse_cursor(position)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="無效的匯出游標")
+            if user_id and start_uid != user_id:
+                raise HTTPException(status_code=400, detail="匯出游標與 user_id 不符")
+        return StreamingResponse(
+            export_chat_histories_ndjson(user_id, since, until, start_uid, after),
+            media_type="application/x-ndjson",
+            headers={"Cache-Control": "no-cache"}
+        )
+    if format != "json":
+        raise HTTPException(status_code=400, detail="format 僅支援 json 或 ndjson")
+
     try:
         chat_histories = []
         # 獲取所有聊天記錄
-        chat_docs = db.collection('chat_histories').stream()
+        chat_docs = chat_history_store.async_collection.stream()
         
-        for doc in chat_docs:
+        async for doc in chat_docs:
             chat_history = doc.to_dict()
+            chat_history.pop('recent', None)
+            chat_history['messages'] = [m async for _, m in chat_history_store.iter_messages_async(doc.id)]
             chat_history['user_id'] = doc.id  # 添加使用者 ID
             chat_histories.append(chat_history)
             
@@ -712,23 +1431,68 @@ async def get_all_chat_histories(user: dict = Depends(verify_token)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"獲取所有聊天記錄時出錯：{str(e)}")
 
+async def export_chat_histories_ndjson(user_id, since, until, start_uid=None, after=None):
+    """
+    逐位使用者、逐頁讀取訊息並產生 NDJSON，同一時間只保留一頁資料在記憶體中。
+    """
+    async def user_ids():
+        if user_id:
+            yield user_id
+        else:
+            async for uid in chat_history_store.iter_user_ids_async(start_at=start_uid):
+                yield uid
+
+    exported = 0
+    try:
+        async for uid in user_ids():
+            resume_after = after if uid == start_uid else None
+            async for position, message in chat_history_store.iter_messages_async(
+                uid, since=since, until=until, after=resume_after
+            ):
+                # 游標含文件 ID，同一時間的多則訊息續傳時不會遺漏或重複
+                record = dict(
+                    message, user_id=uid, timestamp=position[0].isoformat(),
+                    cursor=f"{uid}|{format_cursor(position)}"
+                )
+                exported += 1
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+    except Exception as e:
+        # 回應標頭已送出，只能以最後一行告知錯誤；客戶端可用最後的 cursor 續傳
+        logger.error(f"匯出聊天記錄時出錯（已匯出 {exported} 則）：{e}")
+        yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+
 # Admin API：取得所有使用者資料
+ADMIN_USERS_MAX_PAGE_SIZE = 1000  # Firebase Auth list_users 單頁上限
+DEFAULT_USER_PROFILE = {
+    'role': 'user',
+    'avatar': '/images/default-avatar.png'
+}
+
 @app.get("/admin/users")
-async def get_all_users(user: dict = Depends(verify_token)):
+async def get_all_users(
+    background_tasks: BackgroundTasks,
+    user: dict = Depends(verify_token),
+    limit: int = ADMIN_USERS_MAX_PAGE_SIZE,
+    page_token: Optional[str] = None,
+):
+    """
+    分頁取得使用者資料：每次只列出一頁 Firebase Auth 使用者，並以一次 get_all 讀取對應的 Firestore 文件。
+    將回傳的 next_page_token 作為 page_token 參數取得下一頁。
+    缺少 Firestore 文件的使用者會在回應送出後以批次寫入補建。
+    """
     await check_admin_permission(user)
     try:
         users = []
-        # 先從 Firebase Auth 獲取所有使用者
-        auth_users_iterator = auth.list_users()
+        limit = max(1, min(limit, ADMIN_USERS_MAX_PAGE_SIZE))
+        # Firebase Auth 沒有非同步 API，交給執行緒池
+        page = await run_blocking(auth.list_users, page_token=page_token, max_results=limit)
         
-        # 獲取所有 Firestore 使用者資料並建立映射
-        firestore_users = {}
-        user_docs = users_collection.stream()
-        for doc in user_docs:
-            firestore_users[doc.id] = doc.to_dict()
+        # 只讀取本頁使用者的 Firestore 文件
+        firestore_users = await user_repository.get_profiles([auth_user.uid for auth_user in page.users])
         
         # 遍歷 Firebase Auth 使用者並合併資料
-        for auth_user in auth_users_iterator.iterate_all():
+        missing_uids = []
+        for auth_user in page.users:
             user_data = {
                 'uid': auth_user.uid,
                 'email': auth_user.email,
@@ -736,25 +1500,36 @@ async def get_all_users(user: dict = Depends(verify_token)):
             }
             
             # 如果在 Firestore 中有對應資料，則合併
-            if auth_user.uid in firestore_users:
-                firestore_data = firestore_users[auth_user.uid]
+            firestore_data = firestore_users.get(auth_user.uid)
+            if firestore_data is not None:
                 user_data.update(firestore_data)
             else:
-                # 如果在 Firestore 中沒有資料，設置預設值
-                user_data['role'] = 'user'
-                # 在 Firestore 中創建新的使用者文件
-                users_collection.document(auth_user.uid).set({
-                    'role': 'user',
-                    'avatar': '/images/default-avatar.png'
-                })
+                # 如果在 Firestore 中沒有資料，設置預設值，文件稍後補建
+                user_data['role'] = DEFAULT_USER_PROFILE['role']
+                missing_uids.append(auth_user.uid)
             
             users.append(user_data)
+
+        if missing_uids:
+            background_tasks.add_task(backfill_user_profiles, missing_uids)
             
-        return {"users": users}
+        return {"users": users, "next_page_token": page.next_page_token or None}
+    except auth.UnexpectedResponseError as e:
+        raise HTTPException(status_code=502, detail=f"讀取 Firebase Auth 使用者時出錯：{str(e)}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"無效的分頁參數：{str(e)}")
     except Exception as e:
         logger.error(f"獲取所有使用者資料時出錯：{str(e)}")
         raise HTTPException(status_code=500, detail=f"獲取所有使用者資料時出錯：{str(e)}")
 
+async def backfill_user_profiles(uids):
+    """為缺少 Firestore 文件的使用者以批次寫入建立預設資料。"""
+    try:
+        await user_repository.create_many(uids, DEFAULT_USER_PROFILE)
+        logger.info(f"已為 {len(uids)} 位使用者補建 Firestore 文件")
+    except Exception as e:
+        logger.error(f"補建使用者文件時出錯：{e}")
+
 # Admin API：設定其他使用者的角色
 @app.put("/admin/users/{target_uid}/role")
 async def set_user_role_by_admin(
@@ -765,8 +1540,7 @@ async def set_user_role_by_admin(
     await check_admin_permission(current_user)
     try:
         # 檢查目標使用者是否存在
-        target_user_doc = users_collection.document(target_uid).get()
-        if not target_user_doc.exists:
+        if await user_repository.get_profile(target_uid) is None:
             raise HTTPException(status_code=404, detail="找不到目標使用者")
         
         # 防止管理員移除自己的權限
@@ -777,9 +1551,80 @@ async def set_user_role_by_admin(
             )
         
         # 更新使用者角色
-        users_collection.document(target_uid).update({"role": request.role})
+        await user_repository.update(target_uid, {"role": request.role})
         return {"message": f"使用者 {target_uid} 的角色已更新為 {request.role}"}
     except HTTPException as he:
         raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新使用者角色時出錯：{str(e)}")
+
+# Admin API：取得快取與效能統計
+@app.get("/admin/metrics")
+async def get_metrics(user: dict = Depends(verify_token)):
+    await check_admin_permission(user)
+    return {
+        "embedding_cache": embedding_cache.stats(),
+        "embedding_batches": {name: batcher.stats() for name, batcher in embedding_batchers.items()},
+        "translation_cache": translation_cache.stats(),
+        "translation_batches": translation_batcher.stats(),
+        "topic_classifier": topic_classifier.stats(),
+        "rag_stage_latency": {name: stats.stats() for name, stats in rag_stage_latency.items()},
+        "generation_streams": stream_stats(),
+        "answer_cache": answer_cache.stats(),
+        "chat_history_writes": chat_history_writer.stats(),
+        "article_cache": article_cache.stats(),
+        "token_verifier": token_verifier.stats(),
+        "user_profiles": user_profiles.stats(),
+        "image_pipeline": image_pipeline.stats(),
+        "jobs": job_queue.stats(),
+        "password_hasher": password_hasher.stats(),
+        "upstreams": outbound.stats(),
+    }
+
+# Admin API：批次刪除文章
+ADMIN_BULK_DELETE_MAX = 500
+ADMIN_BULK_DELETE_CONCURRENCY = int(os.getenv("ADMIN_BULK_DELETE_CONCURRENCY", "8"))
+
+class BulkDeleteArticlesRequest(BaseModel):
+    article_ids: List[str]
+
+@app.delete("/admin/articles")
+async def bulk_delete_articles(request: BulkDeleteArticlesRequest, user: dict = Depends(verify_token)):
+    """
+    批次刪除文章：以有限的並行數刪除文件，圖片清理交給背景工作佇列。
+    """
+    await check_admin_permission(user)
+    article_ids = list(dict.fromkeys(request.article_ids))
+    if len(article_ids) > ADMIN_BULK_DELETE_MAX:
+        raise HTTPException(status_code=400, detail=f"一次最多刪除 {ADMIN_BULK_DELETE_MAX} 篇文章")
+
+    semaphore = asyncio.Semaphore(ADMIN_BULK_DELETE_CONCURRENCY)
+
+    async def _delete(article_id):
+        async with semaphore:
+            doc_data = await article_repository.get(article_id)
+            if doc_data is None:
+                return False
+            await article_repository.delete(article_id, article_cleanup_jobs(doc_data))
+            return True
+
+    results = await asyncio.gather(*(_delete(article_id) for article_id in article_ids), return_exceptions=True)
+    deleted, not_found, failed = [], [], {}
+    for article_id, result in zip(article_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"批次刪除文章 {article_id} 時出錯：{result}")
+            failed[article_id] = str(result)
+        elif result:
+            deleted.append(article_id)
+        else:
+            not_found.append(article_id)
+    logger.info(f"管理員 {user['uid']} 批次刪除了 {len(deleted)} 篇文章")
+    return {"deleted": deleted, "not_found": not_found, "failed": failed}
+
+# Admin API：清空語意回答快取
+@app.delete("/admin/answer_cache")
+async def purge_answer_cache(user: dict = Depends(verify_token)):
+    await check_admin_permission(user)
+    purged = answer_cache.purge()
+    logger.info(f"管理員 {user['uid']} 清空了回答快取（{purged} 筆）")
+    return {"message": "回答快取已清空", "purged": purged}
@@ -0,0 +1,83 @@
+"""
+輕量的行程內延遲統計，供 /admin/metrics 回報。
+"""
+import time
+import threading
+from collections import deque
+
+
+class LatencyStats:
+    """
+    記錄延遲的次數、平均值、最大值，以及最近 window 筆樣本的 p50 / p95。
+
+    Args:
+        window (int): 計算百分位數時保留的最近樣本數。
+    """
+
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._recent = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self._recent.append(seconds)
+
+    def stats(self):
+        with self._lock:
+            recent = sorted(self._recent)
+            count, total, maximum = self.count, self.total, self.max
+
+        def percentile(p):
+            if not recent:
+                return 0.0
+            return recent[min(len(recent) - 1, int(p * len(recent)))] * 1000
+
+        return {
+            "count": count,
+            "avg_ms": total / count * 1000 if count else 0.0,
+            "p50_ms": percentile(0.5),
+            "p95_ms": percentile(0.95),
+            "max_ms": maximum * 1000,
+        }
+
+
+class StageTimings:
+    """
+    記錄單次請求中各階段的起訖時間（相對於請求開始），並彙整到共用的 LatencyStats。
+
+    Args:
+        registry (dict): 階段名稱 -> LatencyStats，由呼叫端共用。
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def record(self, name, start, end=None):
+        end = time.perf_counter() if end is None else end
+        self.stages[name] = (start - self.started, end - self.started)
+        self.registry.setdefault(name, LatencyStats()).observe(end - start)
+
+    def mark(self, name):
+        """記錄從請求開始到現在的時間點（例如首個 token）。"""
+        self.record(name, self.started)
+
+    async def track(self, name, awaitable):
+        """等待 awaitable 並記錄其耗時；被取消的階段不列入統計。"""
+        start = time.perf_counter()
+        result = await awaitable
+        self.record(name, start)
+        return result
+
+    def summary(self):
+        return ", ".join(
+            f"{name} {start * 1000:.0f}→{end * 1000:.0f}ms"
+            for name, (start, end) in sorted(self.stages.items(), key=lambda item: item[1])
+        )
@@ -0,0 +1,100 @@
+"""
+將舊版聊天記錄（chat_histories/{uid} 文件中的 messages 陣列）搬移到訊息子集合。
+
+每則訊息以內容雜湊作為文件 ID，重複執行不會產生重複訊息；
+最後以交易將舊訊息合併進 recent、以 Increment 累加 message_count（保留搬移前已寫入新結構的訊息），
+移除 messages 陣列並標記 migrated。
+
+用法：
+    python migrate_chat_histories.py [--dry-run] [--recent-size 20]
+"""
+import argparse
+import json
+import logging
+import os
+
+import firebase_admin
+from dotenv import load_dotenv
+from firebase_admin import credentials, firestore
+
+from chat_history_store import _legacy_messages, _merge_messages, _sorted_messages, message_id
+
+logger = logging.getLogger(__name__)
+
+# Firestore 單一批次最多 500 個寫入操作
+BATCH_LIMIT = 500
+
+
+def migrate_user(db, snapshot, recent_size, dry_run=False):
+    """
+    搬移單一使用者的聊天記錄。
+
+    Returns:
+        int: 搬移的訊息數量。
+    """
+    messages = _sorted_messages(snapshot.to_dict().get("messages", []))
+    if dry_run:
+        return len(messages)
+
+    summary_ref = snapshot.reference
+    messages_ref = summary_ref.collection("messages")
+    for start in range(0, len(messages), BATCH_LIMIT):
+        batch = db.batch()
+        for message in messages[start:start + BATCH_LIMIT]:
+            batch.set(messages_ref.document(message_id(message)), message)
+        batch.commit()
+    written = {message_id(message) for message in messages}
+
+    @firestore.transactional
+    def _finish(transaction):
+        current = summary_ref.get(transaction=transaction)
+        data = current.to_dict() if current.exists else {}
+        if "messages" not in data or data.get("migrated"):
+            # 其他執行已完成搬移
+            return 0
+        legacy = _legacy_messages(data)
+        for message in legacy:
+            if message_id(message) not in written:
+                # 批次寫入之後才追加到舊陣列的訊息
+                transaction.set(messages_ref.document(message_id(message)), message)
+        transaction.update(summary_ref, {
+            "recent": _merge_messages(data.get("recent", []), legacy)[-recent_size:],
+            "message_count": firestore.Increment(len(legacy)),
+            "migrated": True,
+            "updated_at": firestore.SERVER_TIMESTAMP,
+            "messages": firestore.DELETE_FIELD,
+        })
+        return len(legacy)
+
+    return _finish(db.transaction())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="將 chat_histories 的 messages 陣列搬移到訊息子集合")
+    parser.add_argument("--collection", default="chat_histories")
+    parser.add_argument("--recent-size", type=int, default=int(os.getenv("CHAT_RECENT_SIZE", "20")))
+    parser.add_argument("--dry-run", action="store_true", help="只統計需要搬移的數量，不寫入")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    cred = credentials.Certificate(json.loads(os.getenv("GOOGLE_CREDENTIALS")))
+    firebase_admin.initialize_app(cred)
+    db = firestore.client()
+
+    users = 0
+    total = 0
+    for snapshot in db.collection(args.collection).stream():
+        if "messages" not in (snapshot.to_dict() or {}):
+            continue
+        count = migrate_user(db, snapshot, args.recent_size, dry_run=args.dry_run)
+        users += 1
+        total += count
+        logger.info(f"{snapshot.id}: {count} 則訊息")
+
+    action = "需要搬移" if args.dry_run else "已搬移"
+    logger.info(f"{action} {users} 位使用者、共 {total} 則訊息")
+
+
+if __name__ == "__main__":
+    main()
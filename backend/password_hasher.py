@@ -0,0 +1,160 @@
+"""
+密碼雜湊服務。
+
+bcrypt 每次計算需要數百毫秒的 CPU，直接在 async 端點中呼叫會卡住同一個 worker 上所有的 SSE 串流；
+這裡把雜湊與驗證交給獨立的工作行程。排隊中的請求超過上限時立即拒絕（撞庫攻擊時不讓佇列無限增長），
+登入成功且既有雜湊的 cost 與目前設定不同時，順便以新的 cost 重新雜湊。
+"""
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+from metrics import LatencyStats
+
+logger = logging.getLogger('uvicorn.error')
+
+
+class HasherBusyError(RuntimeError):
+    """排隊中的雜湊請求已達上限。"""
+
+
+def bcrypt_cost(hashed):
+    """由 $2b$12$... 格式的雜湊取出 cost；無法解析時回傳 None。"""
+    try:
+        return int(hashed.split(b"$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def hash_password(password, rounds):
+    """在工作行程中產生 bcrypt 雜湊。"""
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def check_password(password, hashed, rounds):
+    """
+    在工作行程中驗證密碼；驗證成功且 cost 與 rounds 不同時一併產生新雜湊。
+
+    Returns:
+        tuple: (是否正確, 新雜湊或 None)。
+    """
+    if not bcrypt.checkpw(password, hashed):
+        return False, None
+    if bcrypt_cost(hashed) != rounds:
+        return True, hash_password(password, rounds)
+    return True, None
+
+
+class PasswordHasher:
+    """
+    以行程池執行 bcrypt 的非同步介面。
+
+    Args:
+        workers (int): 工作行程數量。
+        rounds (int): 新雜湊使用的 bcrypt cost。
+        max_pending (int): 允許同時進行（含排隊）的請求數，超過時拋出 HasherBusyError。
+    """
+
+    def __init__(self, workers=2, rounds=12, max_pending=32):
+        self.workers = workers
+        self.rounds = rounds
+        self.max_pending = max_pending
+        self._executor = None
+        self._pending = 0
+        self.hashed = 0
+        self.verified = 0
+        self.rehashed = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.latency = LatencyStats()
+
+    def start(self):
+        if self._executor is None:
+            # 與圖片管線相同，使用 spawn 避免 fork 帶有 gRPC 執行緒的主行程
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _restart(self, broken):
+        if self._executor is broken:
+            broken.shutdown(wait=False)
+            self._executor = None
+            self.restarts += 1
+            logger.warning("密碼雜湊工作行程異常結束，重新建立行程池")
+        self.start()
+
+    async def _submit(self, fn, *args):
+        if self._pending >= self.max_pending:
+            self.rejected += 1
+            raise HasherBusyError("密碼驗證請求過多")
+        self.start()
+        self._pending += 1
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        executor = self._executor
+        try:
+            return await loop.run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            # 工作行程異常結束後整個行程池都無法再使用，重建後重試一次
+            self._restart(executor)
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+            self.latency.observe(loop.time() - started)
+
+    async def hash(self, password):
+        """
+        產生密碼雜湊。
+
+        Returns:
+            str: bcrypt 雜湊字串。
+
+        Raises:
+            HasherBusyError: 排隊中的請求已達上限。
+        """
+        hashed = await self._submit(hash_password, password.encode('utf-8'), self.rounds)
+        self.hashed += 1
+        return hashed.decode('utf-8')
+
+    async def verify(self, password, hashed):
+        """
+        驗證密碼。
+
+        Returns:
+            tuple: (是否正確, 需要寫回的新雜湊字串或 None)。
+
+        Raises:
+            HasherBusyError: 排隊中的請求已達上限。
+        """
+        ok, new_hash = await self._submit(
+            check_password, password.encode('utf-8'), hashed.encode('utf-8'), self.rounds
+        )
+        self.verified += 1
+        if new_hash is not None:
+            self.rehashed += 1
+            return ok, new_hash.decode('utf-8')
+        return ok, None
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "rounds": self.rounds,
+            "pending": self._pending,
+            "max_pending": self.max_pending,
+            "hashed": self.hashed,
+            "verified": self.verified,
+            "rehashed": self.rehashed,
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+            "latency": self.latency.stats(),
+        }
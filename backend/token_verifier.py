@@ -0,0 +1,238 @@
+"""
+Firebase ID token 驗證與快取。
+
+- 已驗證的 token 以 SHA-256 雜湊為鍵快取解碼結果，存活時間不超過 token 本身的 exp。
+- Google 的簽章憑證由背景執行緒依 Cache-Control 提前更新，請求路徑上只做本地 RSA 驗章；
+  只有遇到未知的 kid（金鑰輪替）時才會同步重新下載。
+- 可選擇檢查 token 是否已被撤銷；撤銷檢查的結果另以較短的 revocation_ttl 快取。
+"""
+import re
+import time
+import asyncio
+import json
+import hashlib
+import logging
+import threading
+
+from firebase_admin import auth
+from google.auth import jwt
+from google.auth.transport import requests as google_requests
+
+from cache import LRUCache
+
+logger = logging.getLogger('uvicorn.error')
+
+ID_TOKEN_CERT_URL = "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+ID_TOKEN_ISSUER_PREFIX = "https://securetoken.google.com/"
+
+
+class CertificateStore:
+    """
+    在記憶體中保存 Google 的 ID token 簽章憑證，並以背景執行緒在過期前更新。
+
+    Args:
+        cert_url (str): 憑證下載網址。
+        refresh_margin (float): 在憑證過期前多少秒更新。
+        retry_interval (float): 下載失敗時的重試間隔秒數。
+        fetch_fn (callable): 下載函式，回傳 (憑證 dict, 存活秒數)；預設透過 HTTP 下載。
+    """
+
+    def __init__(self, cert_url=ID_TOKEN_CERT_URL, refresh_margin=600, retry_interval=60, fetch_fn=None):
+        self.cert_url = cert_url
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.fetch_fn = fetch_fn or self._fetch
+        self.certs = {}
+        self.expires_at = 0.0
+        self.last_refresh = 0.0
+        self.refreshes = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _fetch(self):
+        response = google_requests.Request()(url=self.cert_url, method="GET")
+        if response.status != 200:
+            raise RuntimeError(f"下載憑證失敗：HTTP {response.status}")
+        max_age = 3600
+        match = re.search(r"max-age=(\d+)", response.headers.get("cache-control", ""))
+        if match:
+            max_age = int(match.group(1))
+        return json.loads(response.data.decode("utf-8")), max_age
+
+    def refresh(self):
+        """立即重新下載憑證。"""
+        with self._lock:
+            self.last_refresh = time.time()
+            certs, max_age = self.fetch_fn()
+            self.certs = certs
+            self.expires_at = time.time() + max_age
+            self.refreshes += 1
+
+    def get(self, key_id):
+        """
+        取得指定 kid 的憑證；找不到時同步重新下載一次（金鑰輪替），
+        但最多每 retry_interval 秒一次，避免偽造的 kid 造成大量下載。
+        """
+        cert = self.certs.get(key_id)
+        if cert is None and time.time() - self.last_refresh >= self.retry_interval:
+            self.refresh()
+            cert = self.certs.get(key_id)
+        return cert
+
+    def start(self):
+        """下載憑證並啟動背景更新執行緒。"""
+        if self._thread is not None:
+            return
+        try:
+            self.refresh()
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"初次下載 ID token 憑證失敗，稍後重試：{e}")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="id-token-certs", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            if self.certs:
+                wait = max(self.expires_at - self.refresh_margin - time.time(), self.retry_interval)
+            else:
+                wait = self.retry_interval
+            if self._stop.wait(wait):
+                return
+            try:
+                self.refresh()
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"更新 ID token 憑證失敗：{e}")
+
+    def stats(self):
+        return {
+            "keys": len(self.certs),
+            "expires_in": max(self.expires_at - time.time(), 0.0),
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+        }
+
+
+class CachedTokenVerifier:
+    """
+    驗證 Firebase ID token 並快取解碼結果。
+
+    Args:
+        project_id (str): Firebase 專案 ID，用於檢查 aud 與 iss。
+        certs (CertificateStore): 簽章憑證。
+        check_revoked (bool): 是否檢查 token 是否已被撤銷或使用者已停用。
+        revocation_ttl (float): 啟用撤銷檢查時，驗證結果最多快取的秒數。
+        cache_size (int): 最多快取的 token 數量；0 表示不快取。
+    """
+
+    def __init__(self, project_id, certs, check_revoked=False, revocation_ttl=300, cache_size=10000):
+        self.project_id = project_id
+        self.certs = certs
+        self.check_revoked = check_revoked
+        self.revocation_ttl = revocation_ttl
+        self.cache = LRUCache(maxsize=cache_size) if cache_size else None
+
+    @staticmethod
+    def cache_key(token):
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def verify(self, token):
+        """
+        驗證 ID token。
+
+        Args:
+            token (str): Firebase ID token。
+
+        Returns:
+            dict: 解碼後的 token，包含 uid。
+
+        Raises:
+            auth.ExpiredIdTokenError: token 已過期。
+            auth.InvalidIdTokenError: token 無效。
+            auth.RevokedIdTokenError: token 已被撤銷（需啟用 check_revoked）。
+            auth.UserDisabledError: 使用者已停用（需啟用 check_revoked）。
+        """
+        key = self.cache_key(token) if self.cache is not None else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                if cached["exp"] > time.time():
+                    return dict(cached)
+                self.cache.pop(key)
+
+        decoded = self._verify_uncached(token)
+        if self.check_revoked:
+            self._check_revoked(decoded)
+
+        if key is not None:
+            ttl = decoded["exp"] - time.time()
+            if self.check_revoked:
+                ttl = min(ttl, self.revocation_ttl)
+            if ttl > 0:
+                self.cache.set(key, decoded, ttl=ttl)
+        return dict(decoded)
+
+    async def verify_async(self, token, executor=None):
+        """
+        verify 的非同步版本：快取命中時直接回傳，未命中時的驗章與撤銷檢查交給 executor 執行。
+        """
+        if self.cache is not None:
+            cached = self.cache.get(self.cache_key(token))
+            if cached is not None and cached["exp"] > time.time():
+                return dict(cached)
+        return await asyncio.get_running_loop().run_in_executor(executor, self.verify, token)
+
+    def _verify_uncached(self, token):
+        if not self.certs.certs:
+            # 憑證尚未下載成功時退回 Firebase Admin SDK 的驗證流程
+            return auth.verify_id_token(token)
+
+        try:
+            header = jwt.decode_header(token)
+            cert = self.certs.get(header.get("kid"))
+            if cert is None:
+                raise auth.InvalidIdTokenError("找不到 token 的簽章憑證")
+            claims = jwt.decode(token, certs={header.get("kid"): cert}, audience=self.project_id)
+        except auth.InvalidIdTokenError:
+            raise
+        except Exception as e:
+            try:
+                unverified = jwt.decode(token, verify=False)
+            except Exception:
+                unverified = {}
+            if unverified.get("exp", float("inf")) <= time.time():
+                raise auth.ExpiredIdTokenError("ID token 已過期", e)
+            raise auth.InvalidIdTokenError(f"ID token 無效：{e}", cause=e)
+
+        if header.get("alg") != "RS256":
+            raise auth.InvalidIdTokenError("ID token 的簽章演算法錯誤")
+        if claims.get("iss") != ID_TOKEN_ISSUER_PREFIX + self.project_id:
+            raise auth.InvalidIdTokenError("ID token 的發行者錯誤")
+        subject = claims.get("sub")
+        if not isinstance(subject, str) or not subject or len(subject) > 128:
+            raise auth.InvalidIdTokenError("ID token 的 sub 欄位錯誤")
+        claims["uid"] = subject
+        return claims
+
+    def _check_revoked(self, decoded):
+        user = auth.get_user(decoded["uid"])
+        if user.disabled:
+            raise auth.UserDisabledError("使用者已停用")
+        valid_since = user.tokens_valid_after_timestamp
+        if valid_since and decoded["iat"] * 1000 < valid_since:
+            raise auth.RevokedIdTokenError("ID token 已被撤銷")
+
+    def stats(self):
+        return {
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "check_revoked": self.check_revoked,
+            "certs": self.certs.stats(),
+        }
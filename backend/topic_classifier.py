@@ -0,0 +1,190 @@
+"""
+非同步主題分類器：判斷問題是否與性或性知識相關。
+
+依序嘗試下列層級，前一層能明確判斷時就不再往下：
+
+1. 結果快取：相同（正規化後）問題直接回傳先前的判斷。
+2. 關鍵字：命中明確的正向 / 反向關鍵字。
+3. 嵌入相似度：與已標記的範例問題比較，差距夠大時直接判斷。
+   RAG 流程本來就需要中文查詢嵌入，經由嵌入快取共用，幾乎不增加成本。
+4. LLM：只有前面都無法判斷的模糊問題才呼叫模型。
+"""
+import asyncio
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('uvicorn.error')
+
+# 只收錄不會出現在無關問題中的詞：「高潮」（劇情高潮）、「菜花」（蔬菜）、「處女」（處女座）
+# 等一詞多義的詞，以及「性病」（慢性病）、「性交」（異性交往）等容易誤配子字串的詞，交給嵌入相似度與 LLM 判斷
+POSITIVE_KEYWORDS = (
+    "性愛", "性行為", "做愛", "性知識", "性教育", "性慾", "性欲", "性傳染",
+    "陰莖", "陰道", "陰蒂", "陰唇", "睪丸", "包皮", "勃起", "射精", "早洩", "自慰", "手淫",
+    "前戲", "口交", "肛交", "避孕", "保險套", "避孕藥", "事後藥", "懷孕", "月經", "經期",
+    "生理期", "初夜", "HPV", "梅毒", "愛滋",
+)
+
+NEGATIVE_KEYWORDS = (
+    "天氣", "股票", "程式碼", "寫程式", "食譜", "匯率", "數學題", "翻譯這句",
+)
+
+POSITIVE_EXEMPLARS = (
+    "第一次做愛會痛嗎？",
+    "怎麼讓伴侶更有感覺？",
+    "戴套還會懷孕嗎？",
+    "如何正確使用保險套？",
+    "女生怎麼比較容易高潮？",
+    "男生持久度不好怎麼辦？",
+    "月經來可以發生關係嗎？",
+    "私密處癢是不是感染？",
+    "自慰太頻繁會傷身體嗎？",
+    "怎麼跟另一半聊床上的需求？",
+    "事後避孕藥有副作用嗎？",
+    "如何預防性病？",
+)
+
+NEGATIVE_EXEMPLARS = (
+    "今天台北天氣如何？",
+    "幫我寫一段 Python 程式",
+    "推薦一家好吃的拉麵店",
+    "如何準備期末考？",
+    "美元兌台幣匯率是多少？",
+    "幫我規劃日本旅遊行程",
+    "怎麼煮番茄炒蛋？",
+    "最近有什麼好看的電影？",
+    "如何提升工作效率？",
+    "貓咪不吃飯怎麼辦？",
+    "履歷應該怎麼寫？",
+    "你好，你是誰？",
+)
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class TopicClassifier:
+    """
+    分層判斷問題是否與性相關。
+
+    Args:
+        embed_fn (callable): 非同步嵌入函式，接收文字回傳向量。
+        llm_fn (callable): 非同步 LLM 判斷函式，接收 (query, model) 回傳 bool，失敗時拋出例外。
+        cache (LRUCache): 判斷結果快取。
+        normalize_fn (callable): 問題正規化函式，用於快取鍵與關鍵字比對。
+        positive_threshold (float): 與正向範例的最高相似度需達此值才可直接判定為相關。
+        margin (float): 正負範例最高相似度的差距需超過此值才可直接判斷。
+    """
+
+    def __init__(self, embed_fn, llm_fn, cache, normalize_fn,
+                 positive_threshold=0.75, margin=0.08,
+                 positive_keywords=POSITIVE_KEYWORDS, negative_keywords=NEGATIVE_KEYWORDS,
+                 positive_exemplars=POSITIVE_EXEMPLARS, negative_exemplars=NEGATIVE_EXEMPLARS):
+        self.embed_fn = embed_fn
+        self.llm_fn = llm_fn
+        self.cache = cache
+        self.normalize_fn = normalize_fn
+        self.positive_threshold = positive_threshold
+        self.margin = margin
+        self.positive_keywords = tuple(normalize_fn(k) for k in positive_keywords)
+        self.negative_keywords = tuple(normalize_fn(k) for k in negative_keywords)
+        self.positive_exemplars = positive_exemplars
+        self.negative_exemplars = negative_exemplars
+        self._exemplar_matrices = None
+        self._exemplar_lock = None
+        self.decisions = {"cache": 0, "keyword": 0, "embedding": 0, "llm": 0}
+        self.llm_errors = 0
+
+    def classify_by_keywords(self, normalized_query):
+        """
+        以關鍵字判斷；無法判斷時回傳 None。
+        """
+        if any(k in normalized_query for k in self.positive_keywords):
+            return True
+        if any(k in normalized_query for k in self.negative_keywords):
+            return False
+        return None
+
+    async def _get_exemplar_matrices(self):
+        if self._exemplar_matrices is None:
+            # 延遲建立鎖，確保綁定到實際執行的事件迴圈
+            if self._exemplar_lock is None:
+                self._exemplar_lock = asyncio.Lock()
+            async with self._exemplar_lock:
+                if self._exemplar_matrices is None:
+                    vectors = await asyncio.gather(
+                        *[self.embed_fn(text) for text in self.positive_exemplars + self.negative_exemplars]
+                    )
+                    matrix = _normalize_rows(np.asarray(vectors, dtype=np.float32))
+                    split = len(self.positive_exemplars)
+                    self._exemplar_matrices = (matrix[:split], matrix[split:])
+        return self._exemplar_matrices
+
+    async def classify_by_embedding(self, query):
+        """
+        以與範例問題的嵌入相似度判斷；差距不足以判斷時回傳 None。
+        """
+        positive, negative = await self._get_exemplar_matrices()
+        vector = np.asarray(await self.embed_fn(query), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        vector /= norm
+        best_positive = float(np.max(positive @ vector))
+        best_negative = float(np.max(negative @ vector))
+        if best_positive >= self.positive_threshold and best_positive - best_negative >= self.margin:
+            return True
+        if best_negative - best_positive >= self.margin:
+            return False
+        return None
+
+    async def classify(self, query, model):
+        """
+        判斷問題是否與性相關。
+
+        Args:
+            query (str): 用戶的查詢。
+            model (str): LLM 判斷時使用的模型。
+
+        Returns:
+            bool: 如果問題與性相關，返回 True，否則返回 False。
+        """
+        normalized = self.normalize_fn(query)
+        cached = self.cache.get(normalized)
+        if cached is not None:
+            self.decisions["cache"] += 1
+            return cached
+
+        result = self.classify_by_keywords(normalized)
+        tier = "keyword"
+        if result is None:
+            try:
+                result = await self.classify_by_embedding(query)
+                tier = "embedding"
+            except Exception as e:
+                logger.warning(f"嵌入分類失敗，改用 LLM 判斷：{e}")
+        if result is None:
+            try:
+                result = await self.llm_fn(query, model)
+            except Exception as e:
+                # 失敗的判斷不寫入快取，下次再重新詢問
+                logger.error(f"判斷性相關性時出錯：{e}")
+                self.llm_errors += 1
+                return False
+            tier = "llm"
+
+        self.decisions[tier] += 1
+        self.cache.set(normalized, result)
+        return result
+
+    def stats(self):
+        total = sum(self.decisions.values())
+        return {
+            "decisions": dict(self.decisions),
+            "llm_ratio": self.decisions["llm"] / total if total else 0.0,
+            "llm_errors": self.llm_errors,
+            "cache_size": len(self.cache),
+        }
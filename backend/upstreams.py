@@ -0,0 +1,342 @@
+"""
+對外呼叫的共用韌性層。
+
+每個上游服務（OpenRouter、Vertex AI、Google Translate、Turnstile）各有一個 Upstream：
+
+- 斷路器：連續失敗達門檻後直接拒絕呼叫（CircuitOpenError），reset_timeout 秒後放行一個試探請求。
+- 重試：暫時性錯誤以帶隨機抖動的指數退避重試；只有冪等的呼叫會在送出後重試，
+  連線階段的錯誤（請求尚未送達）則一律可以重試，但讀取逾時等送出後的錯誤除外。
+- 統計：每個上游的延遲、錯誤、重試與斷路次數，供 /admin/metrics 回報。
+
+HTTPUpstream 另外持有一個長期存活的 httpx.AsyncClient（keep-alive 連線池與連線 / 讀取逾時），
+由 UpstreamRegistry 在應用程式啟動時建立、關閉時釋放。
+"""
+import time
+import random
+import asyncio
+import logging
+import threading
+
+import httpx
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+
+from metrics import LatencyStats
+
+logger = logging.getLogger('uvicorn.error')
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+class CircuitOpenError(RuntimeError):
+    """上游的斷路器開啟中，呼叫被直接拒絕。"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} 暫時無法使用，{retry_after:.1f} 秒後重試")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    連續失敗計數的斷路器（closed → open → half_open → closed）。
+
+    Args:
+        name (str): 上游名稱，用於錯誤訊息。
+        failure_threshold (int): 連續失敗幾次後開啟。
+        reset_timeout (float): 開啟後多少秒放行試探請求。
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Raises:
+            CircuitOpenError: 斷路器開啟中，或半開狀態下已有試探請求進行中。
+        """
+        with self._lock:
+            if self.state == "closed":
+                return
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if self.state == "open" and remaining <= 0:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return
+            raise CircuitOpenError(self.name, max(remaining, 0.0))
+
+    def release_probe(self):
+        """試探請求被取消時呼叫，讓下一個請求可以再試探。"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info(f"上游 {self.name} 已恢復")
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                logger.warning(f"上游 {self.name} 連續失敗 {self.failures} 次，{self.reset_timeout} 秒內直接拒絕呼叫")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.opens += 1
+            self._probing = False
+
+
+class Upstream:
+    """
+    單一上游服務的呼叫政策。
+
+    Args:
+        name (str): 上游名稱。
+        retryable (tuple): 暫時性錯誤的例外類型，會計入斷路器；冪等的呼叫遇到時會重試。
+        connect_errors (tuple): 請求尚未送達上游的例外類型，任何呼叫遇到時都可重試。
+        read_errors (tuple): 請求可能已被上游處理的例外類型；即使是 connect_errors 的子類別
+            （例如 openai.APITimeoutError 繼承自 APIConnectionError），非冪等的呼叫也不重試。
+        retries (int): 最多重試次數。
+        backoff (float): 第一次重試的退避上限秒數，之後每次加倍。
+        max_backoff (float): 退避秒數上限。
+        failure_threshold (int): 斷路器開啟的連續失敗次數。
+        reset_timeout (float): 斷路器開啟後放行試探請求的秒數。
+    """
+
+    def __init__(self, name, retryable=(), connect_errors=(), read_errors=(), retries=2, backoff=0.2,
+                 max_backoff=2.0, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.retryable = tuple(retryable) + tuple(connect_errors)
+        self.connect_errors = tuple(connect_errors)
+        self.read_errors = tuple(read_errors)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.latency = LatencyStats()
+        self.calls = 0
+        self.errors = 0
+        self.retried = 0
+        self.rejected = 0
+
+    def start(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+    def _before_attempt(self):
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            self.rejected += 1
+            raise
+        self.calls += 1
+        return time.perf_counter()
+
+    def _after_failure(self, error, started, idempotent, attempt):
+        """
+        記錄一次失敗，回傳重試前要等待的秒數；不應重試時回傳 None。
+        """
+        self.latency.observe(time.perf_counter() - started)
+        if not isinstance(error, self.retryable):
+            # 用戶端錯誤（例如 4xx）代表上游仍正常運作
+            self.breaker.record_success()
+            return None
+        self.errors += 1
+        self.breaker.record_failure()
+        # 先排除送出後的錯誤，再判斷是否為連線階段的錯誤
+        not_sent = isinstance(error, self.connect_errors) and not isinstance(error, self.read_errors)
+        can_retry = idempotent or not_sent
+        if not can_retry or attempt >= self.retries or self.breaker.state != "closed":
+            return None
+        self.retried += 1
+        # full jitter：避免多個請求在同一時間一起重試
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _after_success(self, started):
+        self.latency.observe(time.perf_counter() - started)
+        self.breaker.record_success()
+
+    async def call(self, fn, *args, idempotent=False, **kwargs):
+        """
+        以此上游的政策執行非同步呼叫 await fn(*args, **kwargs)。
+
+        Raises:
+            CircuitOpenError: 斷路器開啟中。
+        """
+        attempt = 0
+        while True:
+            started = self._before_attempt()
+            try:
+                result = await fn(*args, **kwargs)
+            except asyncio.CancelledError:
+                self.breaker.release_probe()
+                raise
+            except Exception as e:
+                delay = self._after_failure(e, started, idempotent, attempt)
+                if delay is None:
+                    raise
+                logger.warning(f"呼叫 {self.name} 失敗，{delay:.2f} 秒後重試：{e}")
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self._after_success(started)
+            return result
+
+    def call_sync(self, fn, *args, idempotent=False, **kwargs):
+        """call 的同步版本，供在執行緒池中執行的 SDK 呼叫使用。"""
+        attempt = 0
+        while True:
+            started = self._before_attempt()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._after_failure(e, started, idempotent, attempt)
+                if delay is None:
+                    raise
+                logger.warning(f"呼叫 {self.name} 失敗，{delay:.2f} 秒後重試：{e}")
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._after_success(started)
+            return result
+
+    def stats(self):
+        return {
+            "state": self.breaker.state,
+            "calls": self.calls,
+            "errors": self.errors,
+            "retried": self.retried,
+            "rejected": self.rejected,
+            "breaker_opens": self.breaker.opens,
+            "latency": self.latency.stats(),
+        }
+
+
+class UpstreamStatusError(httpx.HTTPStatusError):
+    """上游回應 5xx 或 429，視為暫時性錯誤。"""
+
+
+class HTTPUpstream(Upstream):
+    """
+    以共用 httpx.AsyncClient 呼叫的 HTTP 上游。
+
+    Args:
+        name (str): 上游名稱。
+        base_url (str): 基底網址。
+        max_connections (int): 連線池大小（同時也是保持 keep-alive 的連線數）。
+        connect_timeout (float): 建立連線的逾時秒數。
+        read_timeout (float): 讀取回應的逾時秒數。
+        **kwargs: 傳給 Upstream 的重試與斷路器設定。
+    """
+
+    def __init__(self, name, base_url="", max_connections=20, connect_timeout=5.0, read_timeout=30.0, **kwargs):
+        kwargs.setdefault("retryable", (httpx.TimeoutException, httpx.NetworkError,
+                                        httpx.RemoteProtocolError, UpstreamStatusError))
+        kwargs.setdefault("connect_errors", (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+        kwargs.setdefault("read_errors", (httpx.ReadTimeout, httpx.WriteTimeout))
+        super().__init__(name, **kwargs)
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._client = None
+
+    @property
+    def client(self):
+        """共用的 httpx.AsyncClient；尚未啟動時建立。"""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections
+                ),
+                timeout=self.timeout
+            )
+        return self._client
+
+    def start(self):
+        self.client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _send(self, method, url, **kwargs):
+        response = await self.client.request(method, url, **kwargs)
+        if response.status_code >= 500 or response.status_code == 429:
+            raise UpstreamStatusError(
+                f"{self.name} 回應 HTTP {response.status_code}", request=response.request, response=response
+            )
+        return response
+
+    async def request(self, method, url, idempotent=None, **kwargs):
+        """
+        送出 HTTP 請求；5xx 與 429 視為失敗。未指定 idempotent 時依 HTTP 方法判斷。
+
+        Returns:
+            httpx.Response: 上游回應。
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        return await self.call(self._send, method, url, idempotent=idempotent, **kwargs)
+
+
+class UpstreamRegistry:
+    """所有上游的集合；啟動時建立連線池，關閉時釋放，並彙整統計。"""
+
+    def __init__(self):
+        self.upstreams = {}
+
+    def register(self, upstream):
+        self.upstreams[upstream.name] = upstream
+        return upstream
+
+    def get(self, name):
+        return self.upstreams[name]
+
+    def start(self):
+        for upstream in self.upstreams.values():
+            upstream.start()
+
+    async def aclose(self):
+        for upstream in self.upstreams.values():
+            try:
+                await upstream.aclose()
+            except Exception as e:
+                logger.warning(f"關閉上游 {upstream.name} 的連線時出錯：{e}")
+
+    def stats(self):
+        return {name: upstream.stats() for name, upstream in self.upstreams.items()}
+
+
+def pooled_authorized_session(credentials, pool_size=10, connect_timeout=5.0, read_timeout=30.0):
+    """
+    建立供 google-cloud 同步客戶端使用的 AuthorizedSession：
+    以固定大小的 keep-alive 連線池連線，並為每個請求套用連線 / 讀取逾時。
+    """
+    class _TimeoutSession(AuthorizedSession):
+        def request(self, method, url, data=None, headers=None, max_allowed_time=None, timeout=None, **kwargs):
+            return super().request(
+                method, url, data=data, headers=headers, max_allowed_time=max_allowed_time,
+                timeout=(connect_timeout, read_timeout), **kwargs
+            )
+
+    session = _TimeoutSession(credentials)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    return session
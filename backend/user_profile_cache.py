@@ -0,0 +1,111 @@
+"""
+使用者資料（role、avatar 等）快取。
+
+權限檢查與 /user/role、/user/avatar 都只需要 users/{uid} 的少數欄位，
+以 LRU + TTL 快取後，同一位使用者的連續請求不必每次讀取 Firestore。
+本行程寫入使用者資料時會同步更新快取（put / update / invalidate）；
+其他行程或 Firebase 主控台所做的修改，最晚在 TTL 到期後生效。
+不對 users 集合掛快照監聽器，以免每次啟動或重新連線都讀取整個集合（含密碼雜湊）。
+"""
+import threading
+
+from cache import LRUCache
+
+# 不放進快取的欄位
+PRIVATE_FIELDS = ("password",)
+
+# 使用者文件不存在時快取的標記
+_NOT_FOUND = {}
+
+
+def _public(data):
+    return {key: value for key, value in data.items() if key not in PRIVATE_FIELDS}
+
+
+class UserProfileCache:
+    """
+    以 uid 為鍵的使用者資料快取。
+
+    Args:
+        collection (AsyncCollectionReference): users 集合（非同步客戶端）。
+        maxsize (int): 最多快取的使用者數量。
+        ttl (float): 項目存活秒數，也是其他行程的修改最長的延遲時間。
+        not_found_ttl (float): 使用者文件不存在時的快取秒數。
+    """
+
+    def __init__(self, collection, maxsize=10000, ttl=300, not_found_ttl=30):
+        self.collection = collection
+        self.not_found_ttl = not_found_ttl
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    async def get_async(self, uid):
+        """
+        取得使用者資料。
+
+        Args:
+            uid (str): 使用者 UID。
+
+        Returns:
+            dict: 使用者資料（不含密碼等私密欄位）；文件不存在時回傳 None。
+        """
+        data = self.cache.get(uid)
+        if data is None:
+            data = self._store(uid, await self.collection.document(uid).get())
+        return dict(data) if data is not _NOT_FOUND else None
+
+    async def get_many_async(self, uids, client):
+        """
+        批次取得多位使用者的資料：快取未命中的部分以一次 get_all 讀取。
+
+        Args:
+            uids (list): 使用者 UID 列表。
+            client (firestore.AsyncClient): 執行 get_all 的非同步客戶端。
+
+        Returns:
+            dict: uid -> 使用者資料；文件不存在時為 None。
+        """
+        profiles = {}
+        missing = []
+        for uid in uids:
+            data = self.cache.get(uid)
+            if data is None:
+                missing.append(uid)
+            else:
+                profiles[uid] = dict(data) if data is not _NOT_FOUND else None
+        if missing:
+            references = [self.collection.document(uid) for uid in missing]
+            async for snapshot in client.get_all(references):
+                data = self._store(snapshot.id, snapshot)
+                profiles[snapshot.id] = dict(data) if data is not _NOT_FOUND else None
+        return profiles
+
+    def _store(self, uid, snapshot):
+        if snapshot.exists:
+            data = _public(snapshot.to_dict())
+            self.cache.set(uid, data)
+        else:
+            data = _NOT_FOUND
+            self.cache.set(uid, data, ttl=self.not_found_ttl)
+        return data
+
+    def put(self, uid, data):
+        """寫入整份使用者資料（建立文件後呼叫）。"""
+        self.cache.set(uid, _public(data))
+
+    def update(self, uid, fields):
+        """合併部分欄位（更新文件後呼叫）；尚未快取時不做任何事。"""
+        with self._lock:
+            data = self.cache.peek(uid)
+            if data is None:
+                return
+            if data is _NOT_FOUND:
+                self.cache.pop(uid)
+                return
+            self.cache.set(uid, dict(data, **_public(fields)))
+
+    def invalidate(self, uid):
+        self.cache.pop(uid)
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,495 @@
+"""
+本地向量檢索引擎。
+
+將 BigQuery `combined_embeddings` 資料表快照成記憶體映射（mmap）的 float32 矩陣，
+並以獨立的 SQLite 檔案保存 id / title / url / content 等中繼資料，
+查詢時只需一次矩陣乘法即可取得 top-k 餘弦相似度結果。
+
+快照目錄結構：
+
+    VECTOR_INDEX_DIR/
+      CURRENT                 # 目前使用中的快照版本名稱
+      <version>/
+        embeddings.npy        # (n, dim) float32，已做 L2 正規化
+        metadata.sqlite       # rowid 與矩陣列號一一對應
+        ivf_*.npy             # 選用：IVF 粗分群 + int8 殘差量化的近似索引
+
+發布新快照時先寫入暫存目錄再 rename，最後以 os.replace 原子性地更新 CURRENT，
+執行中的行程會在下次查詢時偵測到並熱切換，不會讀到寫一半的檔案。
+
+語料變大時可改用 IVF 近似檢索：以球面 k-means 將向量分成 nlist 群，
+每個向量只保存相對群中心的 int8 殘差；查詢時只掃描最接近的 nprobe 群，
+再以原始 float32 向量重新排序少量候選以補回量化誤差。
+"""
+import os
+import time
+import shutil
+import sqlite3
+import logging
+import threading
+import datetime
+
+import numpy as np
+
+logger = logging.getLogger('uvicorn.error')
+
+CURRENT_FILE = "CURRENT"
+EMBEDDINGS_FILE = "embeddings.npy"
+METADATA_FILE = "metadata.sqlite"
+IVF_FILES = ("centroids", "codes", "scales", "offsets", "rows")
+
+
+def _normalize_rows(matrix):
+    """將矩陣每一列做 L2 正規化，零向量維持為零。"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _chunked_argmax(matrix, centroids, chunk_size=65536):
+    """分塊計算每一列最接近的群中心，避免一次配置 (n, nlist) 的大矩陣。"""
+    assign = np.empty(matrix.shape[0], dtype=np.int32)
+    for start in range(0, matrix.shape[0], chunk_size):
+        block = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+        assign[start:start + chunk_size] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+class IVFIndex:
+    """
+    IVF 粗分群 + int8 殘差量化的近似最近鄰索引。
+
+    向量依所屬群集排序後連續存放，第 i 群的資料位於 offsets[i]:offsets[i + 1]；
+    每個向量近似為 centroid + scale * code，code 為 int8 殘差。
+    """
+
+    def __init__(self, centroids, codes, scales, offsets, rows):
+        self.centroids = centroids
+        self.codes = codes
+        self.scales = scales
+        self.offsets = offsets
+        self.rows = rows
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in IVF_FILES)
+
+    @classmethod
+    def build(cls, matrix, nlist=None, n_iter=10, sample_size=None, seed=0):
+        """
+        由已正規化的向量矩陣建立 IVF 索引。
+
+        Args:
+            matrix (np.ndarray): (n, dim) float32 矩陣，可為 mmap。
+            nlist (int): 群集數量，預設為 4 * sqrt(n)。
+            n_iter (int): k-means 迭代次數。
+            sample_size (int): k-means 訓練樣本數，預設為 nlist * 64。
+            seed (int): 隨機種子。
+
+        Returns:
+            IVFIndex: 建立完成的索引。
+        """
+        n = matrix.shape[0]
+        nlist = max(1, min(n, nlist or int(4 * np.sqrt(n))))
+        rng = np.random.default_rng(seed)
+        sample_size = min(n, sample_size or nlist * 64)
+        sample = np.asarray(matrix[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+
+        # 球面 k-means：向量皆已正規化，以內積作為相似度
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(n_iter):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            counts = np.bincount(assign, minlength=nlist)
+            empty = counts == 0
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[~empty]
+            sums = np.zeros_like(centroids)
+            sums[~empty] = np.add.reduceat(sample[np.argsort(assign, kind='stable')], starts, axis=0)
+            # 空群集重新以隨機樣本初始化
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            centroids = _normalize_rows(sums)
+
+        assign = _chunked_argmax(matrix, centroids)
+        rows = np.argsort(assign, kind='stable').astype(np.int64)
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=nlist)))).astype(np.int64)
+
+        dim = matrix.shape[1]
+        codes = np.empty((n, dim), dtype=np.int8)
+        scales = np.empty(n, dtype=np.float32)
+        chunk_size = 65536
+        for start in range(0, n, chunk_size):
+            block_rows = rows[start:start + chunk_size]
+            residual = np.asarray(matrix[np.sort(block_rows)], dtype=np.float32)
+            # 還原為 rows 的順序
+            residual = residual[np.argsort(np.argsort(block_rows))]
+            residual -= centroids[assign[block_rows]]
+            scale = np.abs(residual).max(axis=1) / 127.0
+            scale[scale == 0] = 1.0
+            codes[start:start + chunk_size] = np.round(residual / scale[:, None]).astype(np.int8)
+            scales[start:start + chunk_size] = scale
+        return cls(centroids.astype(np.float32), codes, scales, offsets, rows)
+
+    def save(self, path):
+        for name in IVF_FILES:
+            np.save(os.path.join(path, f"ivf_{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, path):
+        """載入快照目錄中的 IVF 檔案；不存在時回傳 None。"""
+        if not os.path.exists(os.path.join(path, "ivf_centroids.npy")):
+            return None
+        arrays = {
+            name: np.load(os.path.join(path, f"ivf_{name}.npy"), mmap_mode='r')
+            for name in IVF_FILES
+        }
+        # 群中心與 offsets 很小且每次查詢都會用到，直接讀入記憶體
+        arrays["centroids"] = np.array(arrays["centroids"])
+        arrays["offsets"] = np.array(arrays["offsets"])
+        return cls(**arrays)
+
+    def search(self, query, top_n=10, nprobe=8, exact_matrix=None, rerank=4):
+        """
+        只掃描最接近的 nprobe 群，以量化後的向量估算內積。
+
+        Args:
+            query (np.ndarray): 已正規化的查詢向量。
+            top_n (int): 返回的數量。
+            nprobe (int): 掃描的群集數量，越大召回率越高、速度越慢。
+            exact_matrix (np.ndarray): 原始 float32 矩陣；提供時以其重新排序候選。
+            rerank (int): 重新排序的候選數量為 top_n * rerank。
+
+        Returns:
+            tuple: (矩陣列號陣列, 相似度陣列)，依相似度遞減排序。
+        """
+        nprobe = max(1, min(nprobe, self.nlist))
+        centroid_scores = self.centroids @ query
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+        positions = np.concatenate([
+            np.arange(self.offsets[c], self.offsets[c + 1]) for c in probes
+        ])
+        if positions.size == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        # x ≈ c + s * code  =>  q·x ≈ q·c + s * (code·q)
+        list_ids = np.repeat(probes, np.diff(self.offsets)[probes])
+        scores = centroid_scores[list_ids] + self.scales[positions] * (
+            self.codes[positions].astype(np.float32) @ query
+        )
+
+        n_candidates = min(positions.size, top_n * max(1, rerank) if exact_matrix is not None else top_n)
+        candidates = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+        row_ids = np.asarray(self.rows[positions[candidates]])
+        if exact_matrix is not None:
+            order = np.argsort(row_ids)
+            row_ids = row_ids[order]
+            scores = np.asarray(exact_matrix[row_ids], dtype=np.float32) @ query
+        else:
+            scores = scores[candidates]
+        k = min(top_n, row_ids.size)
+        top = np.argsort(-scores)[:k]
+        return row_ids[top], scores[top]
+
+
+class Snapshot:
+    """
+    單一版本的唯讀快照：mmap 的向量矩陣與 SQLite 中繼資料。
+    """
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode='r')
+        self.ivf = IVFIndex.load(path)
+        self._conn = sqlite3.connect(
+            f"file:{os.path.join(path, METADATA_FILE)}?mode=ro",
+            uri=True,
+            check_same_thread=False
+        )
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    def fetch_metadata(self, row_ids):
+        """
+        依矩陣列號取得文檔中繼資料。
+
+        Args:
+            row_ids (list): 矩陣列號。
+
+        Returns:
+            dict: 列號 -> 中繼資料字典。
+        """
+        if not row_ids:
+            return {}
+        placeholders = ",".join("?" * len(row_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT rowid, id, title, url, content FROM documents WHERE rowid IN ({placeholders})",
+                [int(r) + 1 for r in row_ids]
+            ).fetchall()
+        return {
+            rowid - 1: {"id": doc_id, "title": title, "url": url, "content": content}
+            for rowid, doc_id, title, url, content in rows
+        }
+
+    def search(self, query_embedding, top_n=10, nprobe=None, rerank=4):
+        """
+        以單次矩陣乘法計算查詢向量與所有文檔的餘弦相似度並取 top-k。
+        指定 nprobe 且快照含 IVF 索引時改用近似檢索。
+
+        Args:
+            query_embedding (list): 查詢的嵌入向量。
+            top_n (int): 返回的相似文檔數量。
+            nprobe (int): IVF 掃描的群集數量；None 表示精確檢索。
+            rerank (int): IVF 候選重新排序倍數。
+
+        Returns:
+            list: 相似文檔的列表，格式與 BigQuery 版本相同。
+        """
+        n = len(self)
+        if n == 0 or top_n <= 0:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        query = query / norm
+        if nprobe and self.ivf is not None:
+            top, top_scores = self.ivf.search(
+                query, top_n, nprobe=nprobe, exact_matrix=self.embeddings, rerank=rerank
+            )
+        else:
+            scores = self.embeddings @ query
+            k = min(top_n, n)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            top_scores = scores[top]
+        metadata = self.fetch_metadata(top.tolist())
+        documents = []
+        for row_id, score in zip(top.tolist(), top_scores.tolist()):
+            doc = metadata.get(row_id)
+            if doc is None:
+                continue
+            doc["cosine_similarity"] = float(score)
+            documents.append(doc)
+        return documents
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class LocalVectorIndex:
+    """
+    持有目前的快照並負責熱重新載入。
+
+    查詢時最多每 `reload_interval` 秒檢查一次 CURRENT 檔案，
+    若版本改變則在呼叫端的執行緒中載入新快照，再以單一參考指派完成切換。
+    建立實例、maybe_reload 與 search 都會讀取檔案，不應在事件迴圈中直接呼叫。
+    """
+
+    def __init__(self, index_dir, reload_interval=30.0, nprobe=None):
+        self.index_dir = index_dir
+        self.reload_interval = reload_interval
+        self.nprobe = nprobe
+        self._snapshot = None
+        self._last_check = 0.0
+        self._reload_lock = threading.Lock()
+        self.maybe_reload(force=True)
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def available(self):
+        return self._snapshot is not None
+
+    def _read_current_version(self):
+        try:
+            with open(os.path.join(self.index_dir, CURRENT_FILE), encoding='utf-8') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def maybe_reload(self, force=False):
+        """
+        若 CURRENT 指向的版本與目前載入的不同，則載入新快照並原子性切換。
+
+        Args:
+            force (bool): 忽略檢查間隔立即檢查。
+
+        Returns:
+            bool: 是否切換到新的快照。
+        """
+        now = time.monotonic()
+        if not force and now - self._last_check < self.reload_interval:
+            return False
+        if not self._reload_lock.acquire(blocking=False):
+            # 其他執行緒正在載入，沿用舊快照即可
+            return False
+        try:
+            self._last_check = now
+            version = self._read_current_version()
+            current = self._snapshot
+            if version is None or (current is not None and current.version == version):
+                return False
+            try:
+                new_snapshot = Snapshot(os.path.join(self.index_dir, version), version)
+            except Exception as e:
+                logger.error(f"載入向量快照 {version} 失敗：{e}")
+                return False
+            self._snapshot = new_snapshot
+            logger.info(f"向量快照已切換至 {version}（{len(new_snapshot)} 筆文檔）")
+            # 舊快照不主動關閉：進行中的查詢仍可能持有其參考，交由 GC 回收
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def search(self, query_embedding, top_n=10):
+        self.maybe_reload()
+        snapshot = self._snapshot
+        if snapshot is None:
+            raise RuntimeError(f"向量索引目錄 {self.index_dir} 中沒有可用的快照")
+        return snapshot.search(query_embedding, top_n, nprobe=self.nprobe)
+
+
+def publish_snapshot(index_dir, rows, total_rows, keep=2, ivf_nlist=None):
+    """
+    將文檔寫成新的快照版本並原子性發布。
+
+    Args:
+        index_dir (str): 快照根目錄。
+        rows (iterable): 產生 (id, title, url, content, embedding) 的可迭代物件。
+        total_rows (int): 文檔總數，用於預先配置 mmap 矩陣。
+        keep (int): 保留的歷史版本數量（含新版本）。
+        ivf_nlist (int): 若提供則一併建立 IVF 近似索引；0 表示自動決定群集數量。
+
+    Returns:
+        str: 新快照的版本名稱。
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    version = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+    tmp_path = os.path.join(index_dir, f".{version}.tmp")
+    os.makedirs(tmp_path)
+
+    conn = sqlite3.connect(os.path.join(tmp_path, METADATA_FILE))
+    conn.execute("CREATE TABLE documents (id TEXT, title TEXT, url TEXT, content TEXT)")
+    matrix = None
+    count = 0
+    try:
+        for doc_id, title, url, content, embedding in rows:
+            if count >= total_rows:
+                break
+            vector = np.asarray(embedding, dtype=np.float32)
+            if matrix is None:
+                matrix = np.lib.format.open_memmap(
+                    os.path.join(tmp_path, EMBEDDINGS_FILE),
+                    mode='w+',
+                    dtype=np.float32,
+                    shape=(total_rows, vector.shape[0])
+                )
+            matrix[count] = vector
+            conn.execute(
+                "INSERT INTO documents (rowid, id, title, url, content) VALUES (?, ?, ?, ?, ?)",
+                (count + 1, str(doc_id), title, url, content)
+            )
+            count += 1
+        conn.commit()
+    finally:
+        conn.close()
+
+    if matrix is None:
+        shutil.rmtree(tmp_path)
+        raise ValueError("沒有任何文檔可寫入快照")
+    if count < total_rows:
+        # 實際筆數少於預期時，截斷成正確大小
+        trimmed = np.array(matrix[:count])
+        del matrix
+        np.save(os.path.join(tmp_path, EMBEDDINGS_FILE), _normalize_rows(trimmed))
+    else:
+        matrix[:] = _normalize_rows(matrix)
+        matrix.flush()
+        del matrix
+
+    if ivf_nlist is not None:
+        embeddings = np.load(os.path.join(tmp_path, EMBEDDINGS_FILE), mmap_mode='r')
+        IVFIndex.build(embeddings, nlist=ivf_nlist or None).save(tmp_path)
+        del embeddings
+
+    final_path = os.path.join(index_dir, version)
+    os.rename(tmp_path, final_path)
+    current_tmp = os.path.join(index_dir, f".{CURRENT_FILE}.tmp")
+    with open(current_tmp, "w", encoding='utf-8') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(current_tmp, os.path.join(index_dir, CURRENT_FILE))
+    logger.info(f"已發布向量快照 {version}（{count} 筆文檔）")
+
+    _prune_snapshots(index_dir, keep)
+    return version
+
+
+def _prune_snapshots(index_dir, keep):
+    """刪除超出保留數量的舊版本快照。"""
+    versions = sorted(
+        name for name in os.listdir(index_dir)
+        if not name.startswith(".") and os.path.isdir(os.path.join(index_dir, name))
+    )
+    for name in versions[:-keep]:
+        shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+
+def build_snapshot_from_bigquery(client_bq, project_id, dataset_id, table_id, index_dir, ivf_nlist=None):
+    """
+    從 BigQuery 讀取整張嵌入資料表並發布為新的本地快照。
+
+    Args:
+        client_bq (bigquery.Client): BigQuery 客戶端。
+        project_id (str): GCP 專案 ID。
+        dataset_id (str): BigQuery 資料集 ID。
+        table_id (str): BigQuery 資料表 ID。
+        index_dir (str): 快照根目錄。
+        ivf_nlist (int): 若提供則一併建立 IVF 近似索引。
+
+    Returns:
+        str: 新快照的版本名稱。
+    """
+    query = f"""
+    SELECT id, title, url, content, embedding
+    FROM `{project_id}.{dataset_id}.{table_id}`
+    """
+    results = client_bq.query(query).result()
+    rows = ((row.id, row.title, row.url, row.content, row.embedding) for row in results)
+    return publish_snapshot(index_dir, rows, results.total_rows, ivf_nlist=ivf_nlist)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="從 BigQuery 建立並發布本地向量快照")
+    parser.add_argument("--project", default="eros-ai-446307")
+    parser.add_argument("--dataset", default="Eros_AI_RAG")
+    parser.add_argument("--table", default="combined_embeddings")
+    parser.add_argument("--index-dir", default=None)
+    parser.add_argument("--ivf-nlist", type=int, default=None,
+                        help="一併建立 IVF 近似索引的群集數量（0 表示自動）")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from google.cloud import bigquery
+    from ai_module import credentials, VECTOR_INDEX_DIR
+
+    client_bq = bigquery.Client(project=args.project, credentials=credentials)
+    try:
+        build_snapshot_from_bigquery(
+            client_bq, args.project, args.dataset, args.table, args.index_dir or VECTOR_INDEX_DIR,
+            ivf_nlist=args.ivf_nlist
+        )
+    finally:
+        client_bq.close()